@@ -1,5 +1,7 @@
 import sys
-from link_prediction_analysis import construct_ref_data, count_entity_freq_per_train_graph
+from link_prediction_analysis import construct_ref_data
+from utils.predictions import load_predictions
+from utils.frequency import TemporalCountIndex, prediction_frequencies, group_ranks_by_frequency
 import pickle
 import os
 from sklearn.linear_model import LinearRegression
@@ -31,75 +33,6 @@ def key_based_sort_dict(inp):
     return {k: v for k, v in sorted(inp.items(), key=lambda item: item[0])}
 
 
-def obj_metric_freq(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_obj_rel_counts, freq_obj_counts, freq_rel_counts):
-    triple_count = 0
-    obj_count = 0
-    rel_count = 0
-    obj_rel_count = 0
-    ent_pair_count = 0
-    upper = time + 1 if not bidirectional else min(max_time_step + 1, time + train_seq_len)
-    for t in range(max(0, time - train_seq_len + 1), upper):
-        if t == time: continue
-        triple_count += triple_freq_per_time_step[(s, r, o)][t]
-        ent_pair_count += ent_pair_freq_per_time_step[(s, o)][t]
-        obj_rel_count += obj_rel_freq_per_time_step[(o, r)][t]
-        obj_count += obj_freq_per_time_step[o][t]
-        rel_count += rel_freq_per_time_step[r][t]
-
-    freq_triple_counts[triple_count].append(rank)
-    freq_ent_pair_counts[ent_pair_count].append(rank)
-    freq_obj_rel_counts[obj_rel_count].append(rank)
-    freq_obj_counts[obj_count].append(rank)
-    freq_rel_counts[rel_count].append(rank)
-
-
-def sub_metric_freq(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_sub_rel_counts, freq_sub_counts, freq_rel_counts):
-    triple_count = 0
-    sub_count = 0
-    rel_count = 0
-    sub_rel_count = 0
-    ent_pair_count = 0
-    upper = time + 1 if not bidirectional else min(max_time_step + 1, time + train_seq_len)
-    for t in range(max(0, time - train_seq_len + 1), upper):
-        if t == time: continue
-        triple_count += triple_freq_per_time_step[(s, r, o)][t]
-        ent_pair_count += ent_pair_freq_per_time_step[(s, o)][t]
-        sub_rel_count += sub_rel_freq_per_time_step[(s, r)][t]
-        sub_count += sub_freq_per_time_step[s][t]
-        rel_count += rel_freq_per_time_step[r][t]
-
-    freq_triple_counts[triple_count].append(rank)
-    freq_ent_pair_counts[ent_pair_count].append(rank)
-    freq_sub_rel_counts[sub_rel_count].append(rank)
-    freq_sub_counts[sub_count].append(rank)
-    freq_rel_counts[rel_count].append(rank)
-
-
-def obj_repeat_freq(r, o, time, rank, freq_obj_rel_counts, freq_obj_counts):
-    obj_count = 0
-    obj_rel_count = 0
-    upper = time + 1 if not bidirectional else min(max_time_step + 1, time + train_seq_len)
-    for t in range(max(0, time - train_seq_len + 1), upper):
-        if t == time: continue
-        obj_rel_count += obj_rel_freq_per_time_step[(o, r)][t]
-        obj_count += obj_freq_per_time_step[o][t]
-
-    freq_obj_rel_counts[obj_rel_count].append(rank)
-    freq_obj_counts[obj_count].append(rank)
-
-def sub_repeat_freq(s, r, time, rank, freq_sub_rel_counts, freq_sub_counts):
-    sub_count = 0
-    sub_rel_count = 0
-    upper = time + 1 if not bidirectional else min(max_time_step + 1, time + train_seq_len)
-    for t in range(max(0, time - train_seq_len + 1), upper):
-        if t == time: continue
-        sub_rel_count += sub_rel_freq_per_time_step[(s, r)][t]
-        sub_count += sub_freq_per_time_step[s][t]
-
-    freq_sub_rel_counts[sub_rel_count].append(rank)
-    freq_sub_counts[sub_count].append(rank)
-
-
 def group_ranks(metric):
     # pdb.set_trace()
     metric = key_based_sort_dict(metric)
@@ -127,10 +60,13 @@ def group_ranks(metric):
 
 
 def calc_hit_10_per_score(predictions):
-    freq_sub_rel_counts = defaultdict(list)
-    freq_obj_rel_counts = defaultdict(list)
-    freq_sub_counts = defaultdict(list)
-    freq_obj_counts = defaultdict(list)
+    quadruples, sub_query, ranks = predictions.arrays()
+    frequencies = prediction_frequencies(count_index, quadruples, train_seq_len, bidirectional, max_time_step)
+    obj_query = ~sub_query
+    freq_sub_rel_counts = group_ranks_by_frequency(frequencies['sub_rel'][sub_query], ranks[sub_query])
+    freq_sub_counts = group_ranks_by_frequency(frequencies['sub'][sub_query], ranks[sub_query])
+    freq_obj_rel_counts = group_ranks_by_frequency(frequencies['obj_rel'][obj_query], ranks[obj_query])
+    freq_obj_counts = group_ranks_by_frequency(frequencies['obj'][obj_query], ranks[obj_query])
 
     freq_sub_rel_counts_metric = dict()
     freq_obj_rel_counts_metric = dict()
@@ -142,13 +78,6 @@ def calc_hit_10_per_score(predictions):
     freq_sub_counts_per_rank_count = dict()
     freq_obj_counts_per_rank_count = dict()
 
-    for i, pred in enumerate(predictions):
-        # print(pred)
-        s, r, o, time, mode, rank = tuple(pred)
-        if mode == 's':
-            sub_repeat_freq(s, r, time, rank, freq_sub_rel_counts, freq_sub_counts)
-        else:
-            obj_repeat_freq(r, o, time, rank, freq_obj_rel_counts, freq_obj_counts)
     if binning:
         freq_sub_rel_counts = group_ranks(freq_sub_rel_counts)
         freq_obj_rel_counts = group_ranks(freq_obj_rel_counts)
@@ -172,13 +101,16 @@ def calc_hit_10_per_score(predictions):
 
 
 def pred_metric_per_freq(predictions):
-    freq_triple_counts = defaultdict(list)
-    freq_ent_pair_counts = defaultdict(list)
-    freq_sub_rel_counts = defaultdict(list)
-    freq_obj_rel_counts = defaultdict(list)
-    freq_sub_counts = defaultdict(list)
-    freq_obj_counts = defaultdict(list)
-    freq_rel_counts = defaultdict(list)
+    quadruples, sub_query, ranks = predictions.arrays()
+    frequencies = prediction_frequencies(count_index, quadruples, train_seq_len, bidirectional, max_time_step)
+    obj_query = ~sub_query
+    freq_triple_counts = group_ranks_by_frequency(frequencies['triple'], ranks)
+    freq_ent_pair_counts = group_ranks_by_frequency(frequencies['ent_pair'], ranks)
+    freq_rel_counts = group_ranks_by_frequency(frequencies['rel'], ranks)
+    freq_sub_rel_counts = group_ranks_by_frequency(frequencies['sub_rel'][obj_query], ranks[obj_query])
+    freq_sub_counts = group_ranks_by_frequency(frequencies['sub'][obj_query], ranks[obj_query])
+    freq_obj_rel_counts = group_ranks_by_frequency(frequencies['obj_rel'][sub_query], ranks[sub_query])
+    freq_obj_counts = group_ranks_by_frequency(frequencies['obj'][sub_query], ranks[sub_query])
 
     freq_triple_counts_metric = dict()
     freq_ent_pair_counts_metric = dict()
@@ -196,18 +128,6 @@ def pred_metric_per_freq(predictions):
     freq_obj_counts_per_rank_count = dict()
     freq_rel_counts_per_rank_count = dict()
 
-    for i, pred in enumerate(predictions):
-        # print(pred)
-        s, r, o, time, mode, rank = tuple(pred)
-        if mode == 's':
-            method = obj_metric_freq
-            method(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_obj_rel_counts,
-                   freq_obj_counts, freq_rel_counts)
-        else:
-            method = sub_metric_freq
-            method(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_sub_rel_counts,
-                   freq_sub_counts, freq_rel_counts)
-
     if binning:
         freq_triple_counts = group_ranks(freq_triple_counts)
         freq_ent_pair_counts = group_ranks(freq_ent_pair_counts)
@@ -319,8 +239,7 @@ if __name__ == '__main__':
     print(prediction_file)
     sub_rel_to_ob, obj_rel_to_sub, sub_to_ob, ob_to_sub, rel_to_ob, rel_to_sub = construct_ref_data(train_data)
 
-    triple_freq_per_time_step, ent_pair_freq_per_time_step, sub_freq_per_time_step, obj_freq_per_time_step, \
-    rel_freq_per_time_step, sub_rel_freq_per_time_step, obj_rel_freq_per_time_step = count_entity_freq_per_train_graph(train_data)
+    count_index = TemporalCountIndex(train_data, num_ents, num_rels)
 
     freq_sub_rel_sub_counts_metrics = []
     freq_sub_counts_sub_metrics = []
@@ -347,8 +266,7 @@ if __name__ == '__main__':
     freq_obj_counts_obj = []
 
     for path in paths:
-        with open(path, 'rb') as filehandle:
-            predictions = pickle.load(filehandle)
+        predictions = load_predictions(path)
         freq_sub_rel_sub_count_metric, freq_sub_count_sub_metric, freq_obj_rel_obj_count_metric, freq_obj_count_obj_metric, freq_sub_rel_count_sub, freq_obj_rel_count_obj, \
             freq_sub_count_sub, freq_obj_count_obj = calc_hit_10_per_score(predictions)
 
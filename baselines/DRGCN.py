@@ -39,7 +39,6 @@ class DRGCN(StaticRGCN):
                 norm = comp_deg_norm(sg)
                 sg.ndata.update({'id': g.ndata['id'], 'norm': torch.from_numpy(norm).view(-1, 1)})
                 sg.edata['type_s'] = rel[np.concatenate((graph_split_ids, graph_split_rev_ids))]
-                sg.ids = g.ids
                 sampled_graph_list.append(sg)
         time_embeds = []
         for t, g in zip(t_list, graph_train_list):
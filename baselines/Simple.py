@@ -9,25 +9,27 @@ import torch.nn.functional as F
 import torch
 from utils.CorrptTriples import CorruptTriples
 from utils.evaluation import EvaluationFilter
+from utils.utils import get_node_ids
 
 
 class SimpleEvaluationFilter(EvaluationFilter):
 
-    def calc_metrics_single_graph(self, ent_mean, ent_mean_inv, rel_enc_means, test_triplets, time, eval_bz=100):
+    def calc_metrics_single_graph(self, ent_mean, ent_mean_inv, rel_enc_means, test_triplets, graph, time, eval_bz=100):
         with torch.no_grad():
             s = test_triplets[:, 0]
             r = test_triplets[:, 1]
             o = test_triplets[:, 2]
             test_size = test_triplets.shape[0]
             num_ent = ent_mean.shape[0]
-            o_mask = self.mask_eval_set(test_triplets, test_size, num_ent, time, mode="tail")
-            s_mask = self.mask_eval_set(test_triplets, test_size, num_ent, time, mode="head")
+            o_mask = self.mask_eval_set(test_triplets, test_size, num_ent, time, graph, mode="tail")
+            s_mask = self.mask_eval_set(test_triplets, test_size, num_ent, time, graph, mode="head")
             # perturb object
             ranks_o = self.perturb_and_get_rank(ent_mean, ent_mean_inv, rel_enc_means, s, r, o, test_size, o_mask, eval_bz, mode='tail')
             # perturb subject
             ranks_s = self.perturb_and_get_rank(ent_mean, ent_mean_inv, rel_enc_means, s, r, o, test_size, s_mask, eval_bz, mode='head')
             ranks = torch.cat([ranks_s, ranks_o])
             ranks += 1 # change to 1-indexed
+            self.record_query_keys([test_triplets], [time])
 
             mrr = torch.mean(1.0 / ranks.float()).item()
             hit_1 = torch.mean((ranks <= 1).float()).item()
@@ -36,6 +38,22 @@ class SimpleEvaluationFilter(EvaluationFilter):
 
         return mrr, hit_1, hit_3, hit_10
 
+    def mask_eval_set(self, test_triplets, test_size, num_ent, time, graph, mode='tail'):
+        """
+        the filter of EvaluationFilter with its global entity columns mapped to the local nodes of graph, which the
+        SimplE scores are over; true entities that are not nodes of the graph have no score to mask
+        """
+        ptr, rows, cols = super(SimpleEvaluationFilter, self).mask_eval_set(test_triplets, test_size, num_ent, time, graph, mode)
+        node_ids = get_node_ids(graph, cols.device)
+        local = node_ids.new_full((max(int(node_ids.max()), int(cols.max()) if cols.shape[0] > 0 else 0) + 1,), -1)
+        local[node_ids] = torch.arange(node_ids.shape[0], device=node_ids.device)
+        cols = local[cols]
+        keep = cols >= 0
+        rows, cols = rows[keep], cols[keep]
+        ptr = np.zeros(test_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows.cpu().numpy(), minlength=test_size), out=ptr[1:])
+        return ptr, rows, cols
+
     def perturb_and_get_rank(self, ent_mean, ent_mean_inv, rel_enc_means, s, r, o, test_size, mask, batch_size=100, mode ='tail'):
         """ Perturb one element in the triplets
         """
@@ -57,10 +75,9 @@ class SimpleEvaluationFilter(EvaluationFilter):
 
             unmasked_score = self.calc_score(batch_s, batch_r, batch_o, mode=mode)
             # import pdb; pdb.set_trace()
-            masked_score = torch.where(mask[batch_start: batch_end], -10e6 * unmasked_score.new_ones(unmasked_score.shape), unmasked_score)
-            score = torch.sigmoid(masked_score)  # bsz, n_ent
+            masked_score = self.apply_eval_mask(unmasked_score, mask, batch_start, batch_end)  # bsz, n_ent
 
-            ranks.append(self.sort_and_rank(score, target))
+            ranks.append(self.sort_and_rank(masked_score, target))
         return torch.cat(ranks)
 
 
@@ -117,7 +134,7 @@ class SimplE(TKG_Non_Recurrent):
         g_list = [graph_dict[i.item()] for i in t_list]
         per_graph_ent_embeds, per_graph_ent_embeds_inv = self.get_per_graph_ent_embeds(g_list)
         triplets, labels = self.corrupter.sample_labels_val(g_list)
-        return self.calc_metrics(per_graph_ent_embeds, per_graph_ent_embeds_inv, t_list, triplets, labels)
+        return self.calc_metrics(per_graph_ent_embeds, per_graph_ent_embeds_inv, g_list, t_list, triplets, labels)
 
     def forward(self, t_list, reverse=False):
         kld_loss = 0
@@ -134,12 +151,12 @@ class SimplE(TKG_Non_Recurrent):
             i += 1
         return reconstruct_loss, kld_loss
 
-    def calc_metrics(self, per_graph_ent_embeds, per_graph_ent_embeds_inv, t_list, triplets, labels):
+    def calc_metrics(self, per_graph_ent_embeds, per_graph_ent_embeds_inv, g_list, t_list, triplets, labels):
         mrrs, hit_1s, hit_3s, hit_10s, losses = [], [], [], [], []
         i = 0
         for ent_embed, ent_embed_inv in zip(per_graph_ent_embeds, per_graph_ent_embeds_inv):
             if triplets[i].shape[0] == 0: continue
-            mrr, hit_1, hit_3, hit_10 = self.evaluater.calc_metrics_single_graph(ent_embed, ent_embed_inv, self.rel_embeds, triplets[i], t_list[i])
+            mrr, hit_1, hit_3, hit_10 = self.evaluater.calc_metrics_single_graph(ent_embed, ent_embed_inv, self.rel_embeds, triplets[i], g_list[i], t_list[i])
             loss = self.link_classification_loss(ent_embed, ent_embed_inv, self.rel_embeds, triplets[i], labels[i])
             mrrs.append(mrr)
             hit_1s.append(hit_1)
@@ -4,7 +4,7 @@ import numpy as np
 from utils.utils import comp_deg_norm, move_dgl_to_cuda
 from utils.scores import *
 from baselines.TKG_Non_Recurrent import TKG_Non_Recurrent
-from utils.utils import cuda, node_norm_to_edge_norm
+from utils.utils import cuda, node_norm_to_edge_norm, get_node_ids
 
 
 class StaticRGCN(TKG_Non_Recurrent):
@@ -53,8 +53,7 @@ class StaticRGCN(TKG_Non_Recurrent):
         else:
             all_embeds_g[:] = self.ent_encoder.forward_isolated(self.ent_embeds, t)[:]
 
-        for k, v in g.ids.items():
-            all_embeds_g[v] = convoluted_embeds[k]
+        all_embeds_g[get_node_ids(g, all_embeds_g.device)] = convoluted_embeds
         return all_embeds_g
 
     def get_per_graph_ent_embeds(self, t_list, graph_train_list, val=False):
@@ -76,7 +75,6 @@ class StaticRGCN(TKG_Non_Recurrent):
                 sg.ndata.update({'id': g.ndata['id'], 'norm': torch.from_numpy(node_norm).view(-1, 1)})
                 sg.edata['norm'] = node_norm_to_edge_norm(sg, torch.from_numpy(node_norm).view(-1, 1))
                 sg.edata['type_s'] = rel[total_idx]
-                sg.ids = g.ids
                 sampled_graph_list.append(sg)
         batched_graph = dgl.batch(sampled_graph_list)
         batched_graph.ndata['h'] = self.ent_embeds[batched_graph.ndata['id']].view(-1, self.embed_size)
@@ -90,7 +88,7 @@ class StaticRGCN(TKG_Non_Recurrent):
 
     def calc_metrics(self, per_graph_ent_embeds, g_list, t_list):
         mrrs, hit_1s, hit_3s, hit_10s, losses = [], [], [], [], []
-        ranks = []
+        eval_queries = []
         for g, t, ent_embed in zip(g_list, t_list, per_graph_ent_embeds):
             all_embeds_g = self.get_all_embeds_Gt(t, g, ent_embed)
             index_sample = torch.stack([g.edges()[0], g.edata['type_s'], g.edges()[1]]).transpose(0, 1)
@@ -99,14 +97,14 @@ class StaticRGCN(TKG_Non_Recurrent):
                 index_sample = cuda(index_sample)
                 label = cuda(label)
             if index_sample.shape[0] == 0: continue
-            rank = self.evaluater.calc_metrics_single_graph(ent_embed, self.rel_embeds, all_embeds_g, index_sample, g, t)
+            eval_queries.append((ent_embed, all_embeds_g, index_sample, g, t))
             loss = self.link_classification_loss(ent_embed, self.rel_embeds, index_sample, label)
-            ranks.append(rank)
             losses.append(loss.item())
 
-        try:
-            ranks = torch.cat(ranks)
-        except:
+        if len(eval_queries) > 0:
+            ent_embeds, all_embeds, samples, graphs, times = zip(*eval_queries)
+            ranks = self.evaluater.calc_metrics_batched(ent_embeds, self.rel_embeds, all_embeds, samples, graphs, times)
+        else:
             ranks = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
 
         return ranks, np.mean(losses)
@@ -1,5 +1,6 @@
 from utils.dataset import *
 from utils.args import process_args
+from utils.utils import get_node_ids
 import pdb
 import networkx as nx
 import matplotlib.pyplot as plt
@@ -103,7 +104,7 @@ def get_hist_edge_num(tim):
     idx2count = dict()
 
     print(tim)
-    cur_idx = train_graph_dict[tim].ids.values()
+    cur_idx = get_node_ids(train_graph_dict[tim]).tolist()
     for id in cur_idx:
         idx2count[id] = 0
     cur_graph = nx_train_graphs[tim]
@@ -135,7 +136,7 @@ def get_num_occurrence(tim):
     idx2count = dict()
 
     # print(tim)
-    cur_idx = train_graph_dict[tim].ids.values()
+    cur_idx = get_node_ids(train_graph_dict[tim]).tolist()
     for id in cur_idx:
         idx2count[id] = 0
 
@@ -162,7 +163,7 @@ def calc_entity_hist():
         print(tim)
         # graph = nx_graphs[tim]
         # pdb.set_trace()
-        cur_idx = train_graph_dict[tim].ids.values()
+        cur_idx = get_node_ids(train_graph_dict[tim]).tolist()
         entity_hist = defaultdict(lambda: defaultdict(list))
 
         for t in range(max(0, tim - args.train_seq_len, tim)):
@@ -194,7 +195,7 @@ def calc_entity_hist_future():
         print(tim)
         # graph = nx_graphs[tim]
         # pdb.set_trace()
-        cur_idx = train_graph_dict[tim].ids.values()
+        cur_idx = get_node_ids(train_graph_dict[tim]).tolist()
         entity_hist = defaultdict(lambda: defaultdict(list))
 
         for t in range(max(0, tim - int(args.train_seq_len / 2), min(len(total_times), tim + int(args.train_seq_len / 2)))):
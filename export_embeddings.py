@@ -0,0 +1,72 @@
+from utils.dataset import *
+from utils.args import process_args
+from utils.embedding_store import EmbeddingStoreWriter
+from models.DynamicRGCN import DynamicRGCN
+from models.BiDynamicRGCN import BiDynamicRGCN
+from models.SelfAttentionRGCN import SelfAttentionRGCN
+from models.BiSelfAttentionRGCN import BiSelfAttentionRGCN
+import glob
+import json
+import os.path
+
+
+def load_model(args):
+    # the checkpoint directory layout is the one test.py reads: config.json and checkpoints/*.ckpt
+    experiment_path = args.checkpoint_path
+    checkpoint_path = glob.glob(os.path.join(experiment_path, "checkpoints", "*.ckpt"))[0]
+    args.__dict__.update(dict(json.load(open(os.path.join(experiment_path, "config.json")))))
+    args.use_VAE = False
+    args.use_cuda = args.n_gpu >= 0 and torch.cuda.is_available()
+    if args.post_aggregation or args.post_ensemble or args.impute:
+        raise ValueError("embedding export only supports the plain recurrent and self-attention models")
+
+    module = {
+              "GRRGCN": DynamicRGCN,
+              "RRGCN": DynamicRGCN,
+              "SARGCN": SelfAttentionRGCN,
+              "BiSARGCN": BiSelfAttentionRGCN,
+              "BiGRRGCN": BiDynamicRGCN,
+              "BiRRGCN": BiDynamicRGCN,
+              }[args.module]
+    num_ents, num_rels = get_total_number(args.dataset, 'stat.txt')
+    graph_dict_train, graph_dict_val, graph_dict_test = build_interpolation_graphs(args)
+    model = module(args, num_ents, num_rels, graph_dict_train, graph_dict_val, graph_dict_test)
+
+    checkpoint = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
+    model.load_state_dict(checkpoint['state_dict'])
+    model.on_load_checkpoint(checkpoint)
+    if args.use_cuda:
+        model.cuda()
+    model.eval()
+    return model
+
+
+def export_embeddings(model, path, batch_size):
+    """
+    one pass over the timeline in time order, batch_size windows at a time. Every window restarts its recurrence
+    from an empty history as in evaluation, so each timestamp costs a full window of encoder passes, seq_len per
+    timestamp in all
+    """
+    times = list(model.graph_dict_train.keys())
+    writer = EmbeddingStoreWriter(path, times, model.num_ents, model.embed_size)
+    with torch.no_grad():
+        for start in range(0, len(times), batch_size):
+            t_list = torch.tensor(times[start: start + batch_size])
+            for t, all_embeds in zip(*model.export_embeds(t_list)):
+                writer.write(t, all_embeds.cpu().numpy())
+            print("exported {}/{} timestamps".format(min(start + batch_size, len(times)), len(times)))
+    writer.close(model.rel_embeds.detach().cpu().numpy(), meta={
+        'module': model.args.module,
+        'dataset': model.args.dataset,
+        'score_function': model.args.score_function,
+        'num_rels': model.num_rels,
+        'test_seq_len': model.test_seq_len,
+    })
+
+
+if __name__ == '__main__':
+    args = process_args()
+    torch.manual_seed(args.seed)
+    export_path = args.export_path or os.path.join(args.checkpoint_path, "embeddings")
+    model = load_model(args)
+    export_embeddings(model, export_path, args.batch_size)
@@ -1,6 +1,7 @@
 # from comet_ml import Experiment, ExistingExperiment
 from utils.dataset import *
 from utils.args import process_args
+from utils.utils import get_node_ids
 import json
 import pdb
 from utils.frequency import get_history_within_distance, count_entity_freq_per_train_graph
@@ -455,8 +456,8 @@ def get_true_head_and_tail_all():
     for t in times:
         for g in graph_dict_train[t], graph_dict_val[t], graph_dict_test[t]:
             # triples.append(torch.stack([g.edges()[0], g.edata['type_s'], g.edges()[1]]).transpose(0, 1))
-            subjects = [g.ids[x] for x in g.edges()[0].tolist()]
-            objects = [g.ids[x] for x in g.edges()[1].tolist()]
+            subjects = get_node_ids(g)[g.edges()[0]].tolist()
+            objects = get_node_ids(g)[g.edges()[1]].tolist()
             relations = g.edata['type_s'].tolist()
             for s, r, o in zip(subjects, relations, objects):
                 true_heads[t][(o, r)].append(s)
@@ -9,27 +9,11 @@ import collections
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LinearRegression
 from sklearn import metrics
-from utils.frequency import construct_ref_data, get_history_within_distance, count_entity_freq_per_train_graph
-
-def get_batch_graph_list(t_list, seq_len, graph_dict):
-    times = list(graph_dict.keys())
-    # time_unit = times[1] - times[0]  # compute time unit
-    time_list = []
-
-    t_list = t_list.sort(descending=True)[0]
-    g_list = []
-    # s_lst = [t/15 for t in times]
-    # print(s_lst)
-    for tim in t_list:
-        # length = int(tim / time_unit) + 1
-        # cur_seq_len = seq_len if seq_len <= length else length
-        length = times.index(tim) + 1
-        time_seq = times[length - seq_len:length] if seq_len <= length else times[:length]
-        time_list.append(([None] * (seq_len - len(time_seq))) + time_seq)
-        g_list.append(([None] * (seq_len - len(time_seq))) + [graph_dict[t] for t in time_seq])
-    t_batched_list = [list(x) for x in zip(*time_list)]
-    g_batched_list = [list(x) for x in zip(*g_list)]
-    return g_batched_list, t_batched_list
+from utils.frequency import construct_ref_data, get_history_within_distance, \
+    TemporalCountIndex, prediction_frequencies, group_ranks_by_frequency
+from utils.timeline import get_batch_graph_list
+from utils.predictions import load_predictions, group_ranks_by_keys
+
 
 def get_train_data_freq():
     # graph_dict_train, _, _ = build_interpolation_graphs(args)
@@ -72,19 +56,12 @@ def get_train_data_freq():
 
 
 def calc_per_entity_prediction(predictions):
-    per_entity_ranks = defaultdict(list)
-    per_entity_pair_ranks = defaultdict(list)
-    per_entity_rel_ranks = defaultdict(list)
-    for pred in predictions:
-        s, r, o, time, mode, rank = tuple(pred)
-        # pdb.set_trace()
-        per_entity_pair_ranks[(s, o)].append(rank)
-        if mode == 's':
-            per_entity_ranks[o].append(rank)
-            per_entity_rel_ranks[(o, r)].append(rank)
-        else:
-            per_entity_ranks[s].append(rank)
-            per_entity_rel_ranks[(s, r)].append(rank)
+    quadruples, sub_query, ranks = predictions.arrays()
+    # the known entity of a query is the object of subject queries and the subject of object queries
+    entity = np.where(sub_query, quadruples[:, 2], quadruples[:, 0])
+    per_entity_ranks = group_ranks_by_keys(ranks, entity)
+    per_entity_pair_ranks = group_ranks_by_keys(ranks, quadruples[:, 0], quadruples[:, 2])
+    per_entity_rel_ranks = group_ranks_by_keys(ranks, entity, quadruples[:, 1])
     return per_entity_ranks, per_entity_pair_ranks, per_entity_rel_ranks
 
 
@@ -162,66 +139,27 @@ def calc_metrics_per_time(ranks):
     return mrrs, hit_1s, hit_3s, hit_10s
 
 
-def obj_metric(s, r, o, time, rank, triple_counts, ent_pair_counts, obj_rel_counts, obj_counts, rel_counts, rank_sub):
-    triple_count = 0
-    obj_count = 0
-    rel_count = 0
-    obj_rel_count = 0
-    ent_pair_count = 0
-    for t in range(max(0, time - train_seq_len + 1), time + 1):
-        triple_count += triple_freq_per_time_step[(s, r, o)][t]
-        ent_pair_count += ent_pair_freq_per_time_step[(s, o)][t]
-        obj_rel_count += obj_rel_freq_per_time_step[(o, r)][t]
-        obj_count += obj_freq_per_time_step[o][t]
-        rel_count += rel_freq_per_time_step[r][t]
-    triple_counts[time] += triple_count
-    ent_pair_counts[time] += ent_pair_count
-    obj_rel_counts[time] += obj_rel_count
-    obj_counts[time] += obj_count
-    rel_counts[time] += rel_count
-    rank_sub[time].append(rank)
-
-
-def sub_metric(s, r, o, time, rank, triple_counts, ent_pair_counts, sub_rel_counts, sub_counts, rel_counts, rank_obj):
-    triple_count = 0
-    sub_count = 0
-    rel_count = 0
-    sub_rel_count = 0
-    ent_pair_count = 0
-    for t in range(max(0, time - train_seq_len + 1), time + 1):
-        triple_count += triple_freq_per_time_step[(s, r, o)][t]
-        ent_pair_count += ent_pair_freq_per_time_step[(s, o)][t]
-        sub_rel_count += sub_rel_freq_per_time_step[(s, r)][t]
-        sub_count += sub_freq_per_time_step[s][t]
-        rel_count += rel_freq_per_time_step[r][t]
-    triple_counts[time] += triple_count
-    ent_pair_counts[time] += ent_pair_count
-    sub_rel_counts[time] += sub_rel_count
-    sub_counts[time] += sub_count
-    rel_counts[time] += rel_count
-    rank_obj[time].append(rank)
+def sum_per_time(counts, times):
+    per_time = defaultdict(int)
+    uniq, inverse = np.unique(times, return_inverse=True)
+    for time, count in zip(uniq.tolist(), np.bincount(inverse, weights=counts, minlength=uniq.shape[0]).tolist()):
+        per_time[time] = int(count)
+    return per_time
 
 
 def pred_metric_per_time(predictions):
-    triple_counts = defaultdict(int)
-    ent_pair_counts = defaultdict(int)
-    sub_rel_counts = defaultdict(int)
-    obj_rel_counts = defaultdict(int)
-    sub_counts = defaultdict(int)
-    obj_counts = defaultdict(int)
-    rel_counts = defaultdict(int)
-    rank_sub = defaultdict(list)
-    rank_obj = defaultdict(list)
-
-    for i, pred in enumerate(predictions):
-        # print(pred)
-        s, r, o, time, mode, rank = tuple(pred)
-        if mode == 's':
-            obj_metric(s, r, o, time, rank, triple_counts, ent_pair_counts, obj_rel_counts, obj_counts, rel_counts,
-                       rank_sub)
-        else:
-            sub_metric(s, r, o, time, rank, triple_counts, ent_pair_counts, sub_rel_counts, sub_counts, rel_counts,
-                       rank_obj)
+    quadruples, sub_query, ranks = predictions.arrays()
+    frequencies = prediction_frequencies(count_index, quadruples, train_seq_len, exclude_target=False)
+    times, obj_query = quadruples[:, 3], ~sub_query
+    triple_counts = sum_per_time(frequencies['triple'], times)
+    ent_pair_counts = sum_per_time(frequencies['ent_pair'], times)
+    rel_counts = sum_per_time(frequencies['rel'], times)
+    sub_rel_counts = sum_per_time(frequencies['sub_rel'][obj_query], times[obj_query])
+    sub_counts = sum_per_time(frequencies['sub'][obj_query], times[obj_query])
+    obj_rel_counts = sum_per_time(frequencies['obj_rel'][sub_query], times[sub_query])
+    obj_counts = sum_per_time(frequencies['obj'][sub_query], times[sub_query])
+    rank_sub = group_ranks_by_frequency(times[sub_query], ranks[sub_query])
+    rank_obj = group_ranks_by_frequency(times[obj_query], ranks[obj_query])
 
     triple_counts = sort_dict(triple_counts)
     ent_pair_counts = sort_dict(ent_pair_counts)
@@ -254,144 +192,24 @@ def pred_metric_per_time(predictions):
     # plt.clf()
 
 
-def obj_metric_freq(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_obj_rel_counts, freq_obj_counts, freq_rel_counts):
-    triple_count = 0
-    obj_count = 0
-    rel_count = 0
-    obj_rel_count = 0
-    ent_pair_count = 0
-    upper = time + 1 if not bidirectional else min(max_time_step + 1, time + train_seq_len)
-    for t in range(max(0, time - train_seq_len + 1), upper):
-        if t == time: continue
-        triple_count += triple_freq_per_time_step[(s, r, o)][t]
-        ent_pair_count += ent_pair_freq_per_time_step[(s, o)][t]
-        obj_rel_count += obj_rel_freq_per_time_step[(o, r)][t]
-        obj_count += obj_freq_per_time_step[o][t]
-        rel_count += rel_freq_per_time_step[r][t]
-
-    freq_triple_counts[triple_count].append(rank)
-    freq_ent_pair_counts[ent_pair_count].append(rank)
-    freq_obj_rel_counts[obj_rel_count].append(rank)
-    freq_obj_counts[obj_count].append(rank)
-    freq_rel_counts[rel_count].append(rank)
-
-    # if obj_rel_count <= 10 and obj_rel_count > 0:
-    if False:
-        s_string = id2ent[s]
-        o_string = id2ent[o]
-        rel_string = id2rel[r]
-        print("At time {}, subject rank {}, triple: {}\t{}\t{}".format(time, rank, s_string, rel_string, o_string))
-        sub_lst_all = []
-        for t in range(max(0, time - train_seq_len + 1), time + 1):
-            sub_lst = obj_rel_to_sub[(o, r)][t]
-            if len(sub_lst) > 0:
-                sub_lst_all.extend(sub_lst)
-                print("At time {}".format(t))
-                for sub in sub_lst:
-                    print("{}\t{}\t{}".format(id2ent[sub], rel_string, o_string))
-        print("Answer {}in the history set".format("" if s in sub_lst_all else "not "))
-        if s in sub_lst_all:
-            pdb.set_trace()
-
-    '''
-    if obj_count <= 10 and obj_count > 0:
-        s_string = id2ent[s]
-        o_string = id2ent[o]
-        rel_string = id2rel[r]
-        print("At time {}, subject rank {}, triple: {}\t{}\t{}".format(time, rank, s_string, rel_string, o_string))
-        sub_lst_all = []
-        for t in range(max(0, time - train_seq_len + 1), time + 1):
-            sub_lst = ob_to_sub[o][t]
-            if len(sub_lst) > 0:
-                sub_lst_all.extend(sub_lst)
-                print("At time {}".format(t))
-                for sub in sub_lst:
-                    print("{}\t{}".format(id2ent[sub], o_string))
-        print("Answer {}in the history set".format("" if s in sub_lst_all else "not "))
-        pdb.set_trace()
-        '''
-
-
-def sub_metric_freq(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_sub_rel_counts, freq_sub_counts, freq_rel_counts):
-    triple_count = 0
-    sub_count = 0
-    rel_count = 0
-    sub_rel_count = 0
-    ent_pair_count = 0
-    upper = time + 1 if not bidirectional else min(max_time_step + 1, time + train_seq_len)
-    for t in range(max(0, time - train_seq_len + 1), upper):
-        if t == time: continue
-        triple_count += triple_freq_per_time_step[(s, r, o)][t]
-        ent_pair_count += ent_pair_freq_per_time_step[(s, o)][t]
-        sub_rel_count += sub_rel_freq_per_time_step[(s, r)][t]
-        sub_count += sub_freq_per_time_step[s][t]
-        rel_count += rel_freq_per_time_step[r][t]
-
-    freq_triple_counts[triple_count].append(rank)
-    freq_ent_pair_counts[ent_pair_count].append(rank)
-    freq_sub_rel_counts[sub_rel_count].append(rank)
-    freq_sub_counts[sub_count].append(rank)
-    freq_rel_counts[rel_count].append(rank)
-
-    # if sub_rel_count <= 10 and sub_rel_count > 0:
-    if False:
-        s_string = id2ent[s]
-        o_string = id2ent[o]
-        rel_string = id2rel[r]
-        print("At time {}, object rank {}, triple: {}\t{}\t{}".format(time, rank, s_string, rel_string, o_string))
-        obj_lst_all = []
-        for t in range(max(0, time - train_seq_len + 1), time + 1):
-            obj_lst = sub_rel_to_ob[(s, r)][t]
-            if len(obj_lst) > 0:
-                obj_lst_all.extend(obj_lst)
-                print("At time {}".format(t))
-                for obj in obj_lst:
-                    print("{}\t{}\t{}".format(o_string, rel_string, id2ent[obj]))
-        print("Answer {}in the history set".format("" if s in obj_lst_all else "not "))
-        pdb.set_trace()
-
-
-def obj_metric_freq_all(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_obj_rel_counts, freq_obj_counts, freq_rel_counts):
-    triple_count = np.sum(list(triple_freq_per_time_step[(s, r, o)].values()))
-    ent_pair_count = np.sum(list(ent_pair_freq_per_time_step[(s, o)].values()))
-    obj_rel_count = np.sum(list(obj_rel_freq_per_time_step[(o, r)].values()))
-    obj_count = np.sum(list(obj_freq_per_time_step[o].values()))
-    rel_count = np.sum(list(rel_freq_per_time_step[r].values()))
-
-    freq_triple_counts[triple_count].append(rank)
-    freq_ent_pair_counts[ent_pair_count].append(rank)
-    freq_obj_rel_counts[obj_rel_count].append(rank)
-    freq_obj_counts[obj_count].append(rank)
-    freq_rel_counts[rel_count].append(rank)
-
-
-def sub_metric_freq_all(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_sub_rel_counts, freq_sub_counts, freq_rel_counts):
-    triple_count = np.sum(list(triple_freq_per_time_step[(s, r, o)].values()))
-    ent_pair_count = np.sum(list(ent_pair_freq_per_time_step[(s, o)].values()))
-    sub_rel_count = np.sum(list(sub_rel_freq_per_time_step[(s, r)].values()))
-    sub_count = np.sum(list(sub_freq_per_time_step[s].values()))
-    rel_count = np.sum(list(rel_freq_per_time_step[r].values()))
-    # pdb.set_trace()
-
-    freq_triple_counts[triple_count].append(rank)
-    freq_ent_pair_counts[ent_pair_count].append(rank)
-    freq_sub_rel_counts[sub_rel_count].append(rank)
-    freq_sub_counts[sub_count].append(rank)
-    freq_rel_counts[rel_count].append(rank)
-
-
 def sort_dict(dictionary):
     return collections.OrderedDict(sorted(dictionary.items()))
 
 
 def pred_metric_per_freq(predictions):
-    freq_triple_counts = defaultdict(list)
-    freq_ent_pair_counts = defaultdict(list)
-    freq_sub_rel_counts = defaultdict(list)
-    freq_obj_rel_counts = defaultdict(list)
-    freq_sub_counts = defaultdict(list)
-    freq_obj_counts = defaultdict(list)
-    freq_rel_counts = defaultdict(list)
+    quadruples, sub_query, ranks = predictions.arrays()
+    if all:
+        frequencies = prediction_frequencies(count_index, quadruples)
+    else:
+        frequencies = prediction_frequencies(count_index, quadruples, train_seq_len, bidirectional, max_time_step)
+    obj_query = ~sub_query
+    freq_triple_counts = group_ranks_by_frequency(frequencies['triple'], ranks)
+    freq_ent_pair_counts = group_ranks_by_frequency(frequencies['ent_pair'], ranks)
+    freq_rel_counts = group_ranks_by_frequency(frequencies['rel'], ranks)
+    freq_sub_rel_counts = group_ranks_by_frequency(frequencies['sub_rel'][obj_query], ranks[obj_query])
+    freq_sub_counts = group_ranks_by_frequency(frequencies['sub'][obj_query], ranks[obj_query])
+    freq_obj_rel_counts = group_ranks_by_frequency(frequencies['obj_rel'][sub_query], ranks[sub_query])
+    freq_obj_counts = group_ranks_by_frequency(frequencies['obj'][sub_query], ranks[sub_query])
 
     freq_triple_counts_metric = dict()
     freq_ent_pair_counts_metric = dict()
@@ -409,16 +227,6 @@ def pred_metric_per_freq(predictions):
     freq_obj_counts_per_rank_count = dict()
     freq_rel_counts_per_rank_count = dict()
 
-    for i, pred in enumerate(predictions):
-        # print(pred)
-        s, r, o, time, mode, rank = tuple(pred)
-        if mode == 's':
-            method = obj_metric_freq_all if all else obj_metric_freq
-            method(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_obj_rel_counts, freq_obj_counts, freq_rel_counts)
-        else:
-            method = sub_metric_freq_all if all else sub_metric_freq
-            method(s, r, o, time, rank, freq_triple_counts, freq_ent_pair_counts, freq_sub_rel_counts, freq_sub_counts, freq_rel_counts)
-
     for freq_ranks, freq_metric, freq_rank_count in zip([freq_triple_counts, freq_ent_pair_counts, freq_sub_rel_counts, freq_obj_rel_counts, freq_sub_counts, freq_obj_counts, freq_rel_counts],
                                        [freq_triple_counts_metric, freq_ent_pair_counts_metric, freq_sub_rel_counts_metric, freq_obj_rel_counts_metric, freq_sub_counts_metric, freq_obj_counts_metric, freq_rel_counts_metric],
                                        [freq_triple_counts_per_rank_count, freq_ent_pair_counts_per_rank_count, freq_sub_rel_counts_per_rank_count, freq_obj_rel_counts_per_rank_count,
@@ -486,7 +294,7 @@ def per_graph_freq_entity_mrr(entity_freq_per_time_step, predictions):
 
 
 def calc_metrics(predictions):
-    ranks = np.array([pred[-1] for pred in predictions])
+    ranks = predictions.rank.astype(np.float64)
     mrr = np.mean(1 / ranks)
     hit_1 = np.mean((ranks <= 1))
     hit_3 = np.mean((ranks <= 3))
@@ -498,38 +306,15 @@ def calc_metrics(predictions):
 
 
 
-def obj_repeat_freq(r, o, time, rank, freq_obj_rel_counts, freq_obj_counts):
-    obj_count = 0
-    obj_rel_count = 0
-    upper = time + 1 if not bidirectional else min(max_time_step + 1, time + train_seq_len)
-    for t in range(max(0, time - train_seq_len + 1), upper):
-        if t == time: continue
-        obj_rel_count += obj_rel_freq_per_time_step[(o, r)][t]
-        obj_count += obj_freq_per_time_step[o][t]
-
-    freq_obj_rel_counts[obj_rel_count].append(rank)
-    freq_obj_counts[obj_count].append(rank)
-
-
-def sub_repeat_freq(s, r, time, rank, freq_sub_rel_counts, freq_sub_counts):
-    sub_count = 0
-    sub_rel_count = 0
-    upper = time + 1 if not bidirectional else min(max_time_step + 1, time + train_seq_len)
-    for t in range(max(0, time - train_seq_len + 1), upper):
-        if t == time: continue
-        sub_rel_count += sub_rel_freq_per_time_step[(s, r)][t]
-        sub_count += sub_freq_per_time_step[s][t]
-
-    freq_sub_rel_counts[sub_rel_count].append(rank)
-    freq_sub_counts[sub_count].append(rank)
-
-
 def calc_hit_10_per_score(predictions):
 
-    freq_sub_rel_counts = defaultdict(list)
-    freq_obj_rel_counts = defaultdict(list)
-    freq_sub_counts = defaultdict(list)
-    freq_obj_counts = defaultdict(list)
+    quadruples, sub_query, ranks = predictions.arrays()
+    frequencies = prediction_frequencies(count_index, quadruples, train_seq_len, bidirectional, max_time_step)
+    obj_query = ~sub_query
+    freq_sub_rel_counts = group_ranks_by_frequency(frequencies['sub_rel'][sub_query], ranks[sub_query])
+    freq_sub_counts = group_ranks_by_frequency(frequencies['sub'][sub_query], ranks[sub_query])
+    freq_obj_rel_counts = group_ranks_by_frequency(frequencies['obj_rel'][obj_query], ranks[obj_query])
+    freq_obj_counts = group_ranks_by_frequency(frequencies['obj'][obj_query], ranks[obj_query])
 
     freq_sub_rel_counts_metric = dict()
     freq_obj_rel_counts_metric = dict()
@@ -541,14 +326,6 @@ def calc_hit_10_per_score(predictions):
     freq_sub_counts_per_rank_count = dict()
     freq_obj_counts_per_rank_count = dict()
 
-    for i, pred in enumerate(predictions):
-        # print(pred)
-        s, r, o, time, mode, rank = tuple(pred)
-        if mode == 's':
-            sub_repeat_freq(s, r, time, rank, freq_sub_rel_counts, freq_sub_counts)
-        else:
-            obj_repeat_freq(r, o, time, rank, freq_obj_rel_counts, freq_obj_counts)
-
     for freq_ranks, freq_metric, freq_rank_count in zip([freq_sub_rel_counts, freq_obj_rel_counts, freq_sub_counts, freq_obj_counts],
                                        [freq_sub_rel_counts_metric, freq_obj_rel_counts_metric, freq_sub_counts_metric, freq_obj_counts_metric],
                                        [freq_sub_rel_counts_per_rank_count, freq_obj_rel_counts_per_rank_count, freq_sub_counts_per_rank_count, freq_obj_counts_per_rank_count]):
@@ -627,17 +404,16 @@ def calc_mrr_per_score():
 
 def max_two_models():
     other_prediction_file = args.temporal_checkpoint
-    with open(other_prediction_file, 'rb') as filehandle:
-        other_predictions = pickle.load(filehandle)
-    predictions_map = {}
-    ranks = []
-    for pred in predictions:
-        predictions_map[tuple(pred[:-2])] = pred[-1]
-    for pred in other_predictions:
-        rank = min(pred[-1], predictions_map[tuple(pred[:-2])])
-        ranks.append(rank)
-    # pdb.set_trace()
-    ranks = np.array(ranks)
+    other_predictions = load_predictions(other_prediction_file)
+    # every other prediction takes the better of its rank and the last rank of this model on the same quadruple
+    quadruples = np.concatenate([predictions.quadruples, other_predictions.quadruples])
+    keys, inverse = np.unique(quadruples, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    inverse, other_inverse = inverse[:len(predictions)], inverse[len(predictions):]
+    last = np.full(keys.shape[0], -1, dtype=np.int64)
+    np.maximum.at(last, inverse, np.arange(inverse.shape[0]))
+    assert (last[other_inverse] >= 0).all(), "predictions of the other model on unknown quadruples"
+    ranks = np.minimum(other_predictions.rank, predictions.rank[last[other_inverse]]).astype(np.float64)
     mrr = np.mean(1 / ranks)
     hit_1 = np.mean((ranks <= 1))
     hit_3 = np.mean((ranks <= 3))
@@ -676,8 +452,7 @@ if __name__ == '__main__':
     all = args.all
     if not os.path.exists(exp_folder):
         os.makedirs(exp_folder)
-    with open(prediction_file, 'rb') as filehandle:
-        predictions = pickle.load(filehandle)
+    predictions = load_predictions(prediction_file)
 
     train_data, train_times = load_quadruples(args.dataset, 'train.txt')
     max_time_step = len(train_times)
@@ -690,8 +465,7 @@ if __name__ == '__main__':
     # max_two_models()
     sub_rel_to_ob, obj_rel_to_sub, sub_to_ob, ob_to_sub, rel_to_ob, rel_to_sub = construct_ref_data(train_data)
     train_entity_freq, train_ent_rel_freq, train_ent_pair_freq = get_train_data_freq()
-    triple_freq_per_time_step, ent_pair_freq_per_time_step, sub_freq_per_time_step, obj_freq_per_time_step, \
-        rel_freq_per_time_step, sub_rel_freq_per_time_step, obj_rel_freq_per_time_step = count_entity_freq_per_train_graph(train_data)
+    count_index = TemporalCountIndex(train_data, num_ents, num_rels)
 
     calc_hit_10_per_score(predictions)
     pred_metric_per_freq(predictions)
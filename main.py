@@ -22,6 +22,7 @@ from models.aggregator import Aggregator
 from models.PostDynamicRGCN import ImputeDynamicRGCN, PostDynamicRGCN, PostEnsembleDynamicRGCN
 from models.PostBiDynamicRGCN import ImputeBiDynamicRGCN, PostBiDynamicRGCN, PostEnsembleBiDynamicRGCN
 from models.PostSelfAttentionRGCN import PostBiSelfAttentionRGCN, PostSelfAttentionRGCN
+from utils.memory import memory_tracker
 
 if __name__ == '__main__':
     args = process_args()
@@ -32,12 +33,14 @@ if __name__ == '__main__':
         args.__dict__.update(dict(args_json))
 
     use_cuda = args.use_cuda = args.n_gpu >= 0 and torch.cuda.is_available()
+    memory_tracker.configure(args.memory_diagnostics or args.memory_report is not None, args.memory_report, args.memory_sample_every)
     num_ents, num_rels = get_total_number(args.dataset, 'stat.txt')
 
     if args.dataset_dir == 'extrapolation':
         graph_dict_train, graph_dict_val, graph_dict_test = build_extrapolation_time_stamp_graph(args)
     elif args.dataset_dir == 'interpolation':
         graph_dict_train, graph_dict_val, graph_dict_test = build_interpolation_graphs(args)
+    memory_tracker.checkpoint('graphs')
 
     module = {
               "Simple": SimplE,
@@ -80,6 +83,8 @@ if __name__ == '__main__':
 
     # import pdb; pdb.set_trace()
     model = module(args, num_ents, num_rels, graph_dict_train, graph_dict_val, graph_dict_test)
+    memory_tracker.checkpoint('model')
+    memory_tracker.report_owners({'model': model})
 
     early_stop_callback = EarlyStopping(
         monitor='mrr',
@@ -1,10 +1,12 @@
 from models.BiRRGCN import BiRRGCN
 import numpy as np
-from utils.utils import move_dgl_to_cuda, cuda, filter_none
+from utils.utils import move_dgl_to_cuda, cuda, filter_none, get_node_ids
 from utils.scores import *
 from models.DynamicRGCN import DynamicRGCN
 import pdb
 from utils.evaluation import EvaluationFilter
+from utils.timeline import get_timeline
+from utils.profiler import profiler, profiled
 
 
 class BiDynamicRGCN(DynamicRGCN):
@@ -16,43 +18,17 @@ class BiDynamicRGCN(DynamicRGCN):
 
     @staticmethod
     def get_batch_graph_list(t_list, seq_len, graph_dict):
-        times = list(graph_dict.keys())
-        # time_unit = times[1] - times[0]  # compute time unit
-        t_list_forward = t_list.sort(descending=True)[0]
-        t_list_backward = t_list.sort(descending=False)[0]
-        time_list_forward = []
-        g_list_forward = []
-
-        time_list_backward = []
-        g_list_backward= []
-        num_times = len(times)
-
-        for tim in t_list_forward:
-            length_forward = times.index(tim) + 1
-            time_seq_forward = times[length_forward - seq_len:length_forward] if seq_len <= length_forward else times[:length_forward]
-            time_list_forward.append(([None] * (seq_len - len(time_seq_forward))) + time_seq_forward)
-            g_list_forward.append(([None] * (seq_len - len(time_seq_forward))) + [graph_dict[t] for t in time_seq_forward])
-
-        for tim in t_list_backward:
-            length_backward = times.index(tim)
-            time_seq_backward = times[length_backward:length_backward + seq_len] if seq_len <= num_times - length_backward else times[length_backward:]
-            time_seq_backward.reverse()
-            time_list_backward.append(([None] * (seq_len - len(time_seq_backward))) + time_seq_backward)
-            g_list_backward.append(([None] * (seq_len - len(time_seq_backward))) + [graph_dict[t] for t in time_seq_backward])
-
-        t_forward_batched_list = [list(x) for x in zip(*time_list_forward)]
-        g_forward_batched_list = [list(x) for x in zip(*g_list_forward)]
-
-        t_backward_batched_list = [list(x) for x in zip(*time_list_backward)]
-        g_backward_batched_list = [list(x) for x in zip(*g_list_backward)]
-
+        timeline = get_timeline(graph_dict)
+        g_forward_batched_list, t_forward_batched_list = timeline.get_batch_windows(t_list, seq_len, graph_dict)
+        g_backward_batched_list, t_backward_batched_list = timeline.get_batch_windows(t_list, seq_len, graph_dict, backward=True)
         return g_forward_batched_list, t_forward_batched_list, g_backward_batched_list, t_backward_batched_list
 
     def get_per_graph_ent_dropout_embeds_one_direction(self, cur_time_list, target_time_list, node_sizes, time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds, forward):
         batched_graph = self.get_batch_graph_dropout_embeds(filter_none(cur_time_list), target_time_list)
         if self.use_cuda:
             move_dgl_to_cuda(batched_graph)
-        first_layer_embeds, second_layer_embeds = self.ent_encoder.forward_one_direction(batched_graph, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor, cur_time_list, node_sizes, forward)
+        with profiler.scope('encoder'):
+            first_layer_embeds, second_layer_embeds = self.ent_encoder.forward_one_direction(batched_graph, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor, cur_time_list, node_sizes, forward)
 
         return first_layer_embeds.split(node_sizes), second_layer_embeds.split(node_sizes)
 
@@ -60,7 +36,8 @@ class BiDynamicRGCN(DynamicRGCN):
         batched_graph = self.get_batch_graph_embeds(g_batched_list_t, full=full, rate=rate)
         if self.use_cuda:
             move_dgl_to_cuda(batched_graph)
-        first_layer_embeds, second_layer_embeds = self.ent_encoder.forward_one_direction(batched_graph, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor, time_batched_list_t, node_sizes, forward)
+        with profiler.scope('encoder'):
+            first_layer_embeds, second_layer_embeds = self.ent_encoder.forward_one_direction(batched_graph, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor, time_batched_list_t, node_sizes, forward)
 
         return first_layer_embeds.split(node_sizes), second_layer_embeds.split(node_sizes)
 
@@ -69,8 +46,9 @@ class BiDynamicRGCN(DynamicRGCN):
         batched_graph = self.get_batch_graph_embeds(g_batched_list_t, full, rate)
         if self.use_cuda:
             move_dgl_to_cuda(batched_graph)
-        second_layer_embeds = self.ent_encoder(batched_graph, first_prev_graph_embeds_forward, second_prev_graph_embeds_forward, time_diff_tensor_forward,
-                                                                 first_prev_graph_embeds_backward, second_prev_graph_embeds_backward, time_diff_tensor_backward, time_batched_list_t, node_sizes)
+        with profiler.scope('encoder'):
+            second_layer_embeds = self.ent_encoder(batched_graph, first_prev_graph_embeds_forward, second_prev_graph_embeds_forward, time_diff_tensor_forward,
+                                                                     first_prev_graph_embeds_backward, second_prev_graph_embeds_backward, time_diff_tensor_backward, time_batched_list_t, node_sizes)
 
         return second_layer_embeds.split(node_sizes)
 
@@ -78,8 +56,8 @@ class BiDynamicRGCN(DynamicRGCN):
         seq_len = self.test_seq_len if val else self.train_seq_len
         bsz = len(g_batched_list[0])
         target_time_batched_list = time_batched_list[-1]
-        hist_embeddings = self.ent_embeds.new_zeros(bsz, 2, self.num_ents, self.embed_size)
-        start_time_tensor = self.ent_embeds.new_zeros(bsz, self.num_ents)
+        hist_embeddings = self.new_history_store(bsz)
+        start_time_tensor = hist_embeddings.start_time
         full = val or not self.args.random_dropout
         for cur_t in range(seq_len - 1):
             # if not forward: pdb.set_trace()
@@ -93,12 +71,12 @@ class BiDynamicRGCN(DynamicRGCN):
             else:
                 first_per_graph_ent_embeds, second_per_graph_ent_embeds = self.get_per_graph_ent_embeds_one_direction(g_batched_list_t, time_batched_list[cur_t], node_sizes,
                                                                                                                   time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds, forward, full=full, rate=0.8)
-            hist_embeddings = self.update_time_diff_hist_embeddings(first_per_graph_ent_embeds, second_per_graph_ent_embeds, start_time_tensor, g_batched_list_t, cur_t, bsz)
+            hist_embeddings.update(g_batched_list_t, cur_t, first_per_graph_ent_embeds, second_per_graph_ent_embeds)
         if not forward:
-            hist_embeddings = torch.flip(hist_embeddings, [0])
-            start_time_tensor = torch.flip(start_time_tensor, [0])
+            start_time_tensor = hist_embeddings.flip().start_time
         return hist_embeddings, start_time_tensor
 
+    @profiled('all_embeds')
     def get_all_embeds_Gt(self, convoluted_embeds, g, t, first_prev_graph_embeds_forward, second_prev_graph_embeds_forward, time_diff_tensor_forward,
                                                          first_prev_graph_embeds_backward, second_prev_graph_embeds_backward, time_diff_tensor_backward):
         all_embeds_g = self.ent_embeds.new_zeros(self.ent_embeds.shape)
@@ -107,8 +85,7 @@ class BiDynamicRGCN(DynamicRGCN):
         else:
             all_embeds_g = self.ent_encoder.forward_isolated(self.ent_embeds, first_prev_graph_embeds_forward, second_prev_graph_embeds_forward, time_diff_tensor_forward.unsqueeze(-1),
                                                                               first_prev_graph_embeds_backward, second_prev_graph_embeds_backward, time_diff_tensor_backward.unsqueeze(-1), t)
-        for k, v in g.ids.items():
-            all_embeds_g[v] = convoluted_embeds[k]
+        all_embeds_g[get_node_ids(g, all_embeds_g.device)] = convoluted_embeds
         return all_embeds_g
 
     def get_final_graph_embeds(self, g_batched_list_t, time_batched_list_t, seq_len, hist_embeddings_forward, start_time_tensor_forward, hist_embeddings_backward, start_time_tensor_backward, full):
@@ -180,9 +157,19 @@ class BiDynamicRGCN(DynamicRGCN):
                                                            full=True)
         return per_graph_ent_embeds, train_graphs, time_batched_list_t, hist_embeddings_forward, start_time_tensor_forward, hist_embeddings_backward, start_time_tensor_backward
 
+    def export_embeds(self, t_list):
+        per_graph_ent_embeds, train_graphs, time_batched_list_t, hist_embeddings_forward, start_time_tensor_forward, hist_embeddings_backward, start_time_tensor_backward = self.train_embed(t_list)
+        all_embeds = []
+        for i, (g, t, ent_embed) in enumerate(zip(train_graphs, time_batched_list_t, per_graph_ent_embeds)):
+            time_diff_tensor_forward = self.test_seq_len - 1 - start_time_tensor_forward[i]
+            time_diff_tensor_backward = self.test_seq_len - 1 - start_time_tensor_backward[i]
+            all_embeds.append(self.get_all_embeds_Gt(ent_embed, g, t, hist_embeddings_forward[i][0], hist_embeddings_forward[i][1], time_diff_tensor_forward,
+                                                     hist_embeddings_backward[i][0], hist_embeddings_backward[i][1], time_diff_tensor_backward))
+        return time_batched_list_t, all_embeds
+
     def calc_metrics(self, per_graph_ent_embeds, g_list, t_list, hist_embeddings_forward, start_time_tensor_forward, hist_embeddings_backward, start_time_tensor_backward, cur_t):
         mrrs, hit_1s, hit_3s, hit_10s, losses = [], [], [], [], []
-        ranks = []
+        eval_queries = []
         i = 0
         for g, t, ent_embed in zip(g_list, t_list, per_graph_ent_embeds):
             time_diff_tensor_forward = cur_t - start_time_tensor_forward[i]
@@ -196,14 +183,14 @@ class BiDynamicRGCN(DynamicRGCN):
                 index_sample = cuda(index_sample)
                 label = cuda(label)
             if index_sample.shape[0] == 0: continue
-            rank = self.evaluater.calc_metrics_single_graph(ent_embed, self.rel_embeds, all_embeds_g, index_sample, g, t)
+            eval_queries.append((ent_embed, all_embeds_g, index_sample, g, t))
             loss = self.link_classification_loss(ent_embed, self.rel_embeds, index_sample, label)
-            ranks.append(rank)
             losses.append(loss.item())
             i += 1
-        try:
-            ranks = torch.cat(ranks)
-        except:
+        if len(eval_queries) > 0:
+            ent_embeds, all_embeds, samples, graphs, times = zip(*eval_queries)
+            ranks = self.evaluater.calc_metrics_batched(ent_embeds, self.rel_embeds, all_embeds, samples, graphs, times)
+        else:
             ranks = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
 
         return ranks, np.mean(losses)
\ No newline at end of file
@@ -4,11 +4,14 @@ from utils.utils import filter_none
 import torch
 from models.RRGCN import RRGCN
 import numpy as np
-from utils.utils import move_dgl_to_cuda, comp_deg_norm, node_norm_to_edge_norm, cuda
+from utils.utils import move_dgl_to_cuda, comp_deg_norm, node_norm_to_edge_norm, cuda, get_node_ids
 from utils.scores import *
 import dgl
 from utils.DropEdge import DropEdge
+from utils.HistoryStore import HistoryStore
 from utils.evaluation import EvaluationFilter
+from utils.profiler import profiler, profiled
+from utils.memory import memory_tracker
 
 
 class DynamicRGCN(TKG_Module):
@@ -25,6 +28,7 @@ class DynamicRGCN(TKG_Module):
         if self.edge_dropout:
             self.drop_edge = DropEdge(args, graph_dict_train, graph_dict_val, graph_dict_test)
             self.drop_edge.pre_cal_drop_rate()
+            memory_tracker.checkpoint('drop_edge')
 
         nn.init.xavier_uniform_(self.ent_embeds, gain=nn.init.calculate_gain('relu'))
         nn.init.xavier_uniform_(self.rel_embeds, gain=nn.init.calculate_gain('relu'))
@@ -38,31 +42,26 @@ class DynamicRGCN(TKG_Module):
         time_diff_tensor = []
         for i, graph in enumerate(g_batched_list_t):
             node_idx = graph.ndata['id']
-            first_layer_prev_embeddings.append(history_embeddings[i][0][node_idx].view(-1, self.embed_size))
-            second_layer_prev_embeddings.append(history_embeddings[i][1][node_idx].view(-1, self.embed_size))
+            first_layer_prev_embeddings.append(history_embeddings.gather(i, 0, node_idx))
+            second_layer_prev_embeddings.append(history_embeddings.gather(i, 1, node_idx))
             time_diff_tensor.append(cur_t - start_time_tensor[i][node_idx])
 
         return torch.cat(first_layer_prev_embeddings), torch.cat(second_layer_prev_embeddings), torch.cat(time_diff_tensor)
 
-    def update_time_diff_hist_embeddings(self, first_per_graph_ent_embeds, second_per_graph_ent_embeds, start_time_tensor, g_batched_list_t, cur_t, bsz):
-        res = start_time_tensor.new_zeros(bsz, 2, self.num_ents, self.embed_size)
-        for i in range(len(first_per_graph_ent_embeds)):
-            idx = g_batched_list_t[i].ndata['id'].squeeze()
-            res[i][0][idx] = first_per_graph_ent_embeds[i]
-            res[i][1][idx] = second_per_graph_ent_embeds[i]
-            start_time_tensor[i][idx] = cur_t
-        return res
+    def new_history_store(self, bsz, num_layers=2):
+        return HistoryStore(bsz, num_layers, self.num_ents, self.embed_size, self.ent_embeds)
 
+    @profiled('all_embeds')
     def get_all_embeds_Gt(self, convoluted_embeds, g, t, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor):
         all_embeds_g = self.ent_embeds.new_zeros(self.ent_embeds.shape)
         if self.args.use_embed_for_non_active:
             all_embeds_g[:] = self.ent_embeds[:]
         else:
             all_embeds_g = self.ent_encoder.forward_isolated(self.ent_embeds, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor.unsqueeze(-1), t)
-        for k, v in g.ids.items():
-            all_embeds_g[v] = convoluted_embeds[k]
+        all_embeds_g[get_node_ids(g, all_embeds_g.device)] = convoluted_embeds
         return all_embeds_g
 
+    @profiled('graph_batching')
     def get_batch_graph_dropout_embeds(self, cur_time_lst, target_time_lst):
         sampled_graph_list = []
         for cur_time, target_time in zip(cur_time_lst, target_time_lst):
@@ -71,8 +70,10 @@ class DynamicRGCN(TKG_Module):
 
         batched_graph = dgl.batch(sampled_graph_list)
         batched_graph.ndata['h'] = self.ent_embeds[batched_graph.ndata['id']].view(-1, self.embed_size)
+        profiler.count('edges', batched_graph.number_of_edges())
         return batched_graph
 
+    @profiled('graph_batching')
     def get_batch_graph_embeds(self, g_batched_list_t, full, rate):
         if full:
             sampled_graph_list = g_batched_list_t
@@ -86,18 +87,19 @@ class DynamicRGCN(TKG_Module):
                 sg.ndata.update({'id': g.ndata['id'], 'norm': torch.from_numpy(node_norm).view(-1, 1)})
                 sg.edata['norm'] = node_norm_to_edge_norm(sg, torch.from_numpy(node_norm).view(-1, 1))
                 sg.edata['type_s'] = rel[total_idx]
-                sg.ids = g.ids
                 sampled_graph_list.append(sg)
 
         batched_graph = dgl.batch(sampled_graph_list)
         batched_graph.ndata['h'] = self.ent_embeds[batched_graph.ndata['id']].view(-1, self.embed_size)
+        profiler.count('edges', batched_graph.number_of_edges())
         return batched_graph
 
     def get_per_graph_ent_dropout_embeds(self, cur_time_list, target_time_list, node_sizes, time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds):
         batched_graph = self.get_batch_graph_dropout_embeds(filter_none(cur_time_list), target_time_list)
         if self.use_cuda:
             move_dgl_to_cuda(batched_graph)
-        first_layer_embeds, second_layer_embeds = self.ent_encoder(batched_graph, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor, cur_time_list, node_sizes)
+        with profiler.scope('encoder'):
+            first_layer_embeds, second_layer_embeds = self.ent_encoder(batched_graph, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor, cur_time_list, node_sizes)
 
         return first_layer_embeds.split(node_sizes), second_layer_embeds.split(node_sizes)
 
@@ -105,7 +107,8 @@ class DynamicRGCN(TKG_Module):
         batched_graph = self.get_batch_graph_embeds(g_batched_list_t, full, rate)
         if self.use_cuda:
             move_dgl_to_cuda(batched_graph)
-        first_layer_embeds, second_layer_embeds = self.ent_encoder(batched_graph, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor, time_batched_list_t, node_sizes)
+        with profiler.scope('encoder'):
+            first_layer_embeds, second_layer_embeds = self.ent_encoder(batched_graph, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor, time_batched_list_t, node_sizes)
 
         return first_layer_embeds.split(node_sizes), second_layer_embeds.split(node_sizes)
 
@@ -153,12 +156,23 @@ class DynamicRGCN(TKG_Module):
         _, per_graph_ent_embeds = self.get_per_graph_ent_embeds(train_graphs, time_list[-1], node_sizes, time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds, full=True)
         return per_graph_ent_embeds, train_graphs, time_list, hist_embeddings, start_time_tensor
 
+    def export_embeds(self, t_list):
+        """
+        entity embeddings scored at each timestamp of t_list, with the inactive entities filled in as in evaluation
+        :return: the timestamps in window order and one (num_ents, embed_size) tensor per timestamp
+        """
+        per_graph_ent_embeds, train_graphs, time_list, hist_embeddings, start_time_tensor = self.train_embed(t_list)
+        all_embeds = []
+        for i, (g, t, ent_embed) in enumerate(zip(train_graphs, time_list[-1], per_graph_ent_embeds)):
+            all_embeds.append(self.get_all_embeds_Gt(ent_embed, g, t, hist_embeddings[i][0], hist_embeddings[i][1], self.test_seq_len - 1 - start_time_tensor[i]))
+        return time_list[-1], all_embeds
+
     def pre_forward(self, g_batched_list, time_batched_list, val=False):
         seq_len = self.test_seq_len if val else self.train_seq_len
         bsz = len(g_batched_list[0])
         target_time_batched_list = time_batched_list[-1]
-        hist_embeddings = self.ent_embeds.new_zeros(bsz, 2, self.num_ents, self.embed_size)
-        start_time_tensor = self.ent_embeds.new_zeros(bsz, self.num_ents)
+        hist_embeddings = self.new_history_store(bsz)
+        start_time_tensor = hist_embeddings.start_time
         full = val or not self.args.random_dropout
         for cur_t in range(seq_len - 1):
             g_batched_list_t, node_sizes = self.get_val_vars(g_batched_list, cur_t)
@@ -170,7 +184,7 @@ class DynamicRGCN(TKG_Module):
             else:
                 first_per_graph_ent_embeds, second_per_graph_ent_embeds = self.get_per_graph_ent_embeds(g_batched_list_t, time_batched_list[cur_t], node_sizes,
                                                                                                         time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds, full=full, rate=0.8)
-            hist_embeddings = self.update_time_diff_hist_embeddings(first_per_graph_ent_embeds, second_per_graph_ent_embeds, start_time_tensor, g_batched_list_t, cur_t, bsz)
+            hist_embeddings.update(g_batched_list_t, cur_t, first_per_graph_ent_embeds, second_per_graph_ent_embeds)
         return hist_embeddings, start_time_tensor
 
     def forward(self, t_list, reverse=False):
@@ -195,7 +209,7 @@ class DynamicRGCN(TKG_Module):
 
     def calc_metrics(self, per_graph_ent_embeds, g_list, t_list, hist_embeddings, start_time_tensor, cur_t):
         mrrs, hit_1s, hit_3s, hit_10s, losses = [], [], [], [], []
-        ranks = []
+        eval_queries = []
         i = 0
         for g, t, ent_embed in zip(g_list, t_list, per_graph_ent_embeds):
             time_diff_tensor = cur_t - start_time_tensor[i]
@@ -207,14 +221,14 @@ class DynamicRGCN(TKG_Module):
                 index_sample = cuda(index_sample)
                 label = cuda(label)
             if index_sample.shape[0] == 0: continue
-            rank = self.evaluater.calc_metrics_single_graph(ent_embed, self.rel_embeds, all_embeds_g, index_sample, g, t)
+            eval_queries.append((ent_embed, all_embeds_g, index_sample, g, t))
             loss = self.link_classification_loss(ent_embed, self.rel_embeds, index_sample, label)
-            ranks.append(rank)
             losses.append(loss.item())
             i += 1
-        try:
-            ranks = torch.cat(ranks)
-        except:
+        if len(eval_queries) > 0:
+            ent_embeds, all_embeds, samples, graphs, times = zip(*eval_queries)
+            ranks = self.evaluater.calc_metrics_batched(ent_embeds, self.rel_embeds, all_embeds, samples, graphs, times)
+        else:
             ranks = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
 
         return ranks, np.mean(losses)
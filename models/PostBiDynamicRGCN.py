@@ -7,7 +7,7 @@ from utils.utils import filter_none
 import torch
 from models.RRGCN import RRGCN
 import numpy as np
-from utils.utils import move_dgl_to_cuda, comp_deg_norm, node_norm_to_edge_norm, cuda
+from utils.utils import move_dgl_to_cuda, comp_deg_norm, node_norm_to_edge_norm, cuda, get_node_ids
 from utils.scores import *
 import dgl
 from utils.DropEdge import DropEdge
@@ -32,10 +32,7 @@ class ImputeBiDynamicRGCN(BiDynamicRGCN, ImputeDynamicRGCN):
         all_embeds_g = self.ent_encoder.forward_isolated_impute(self.ent_embeds, first_prev_graph_embeds_forward_rec, second_prev_graph_embeds_forward_rec, time_diff_tensor_forward.unsqueeze(-1),
                                                                           first_prev_graph_embeds_backward_rec, second_prev_graph_embeds_backward_rec, time_diff_tensor_backward.unsqueeze(-1), t, second_embeds_forward_loc, second_embeds_backward_loc)
 
-        keys = np.array(list(g.ids.keys()))
-        values = np.array(list(g.ids.values()))
-
-        all_embeds_g[values] = convoluted_embeds[keys]
+        all_embeds_g[get_node_ids(g, all_embeds_g.device)] = convoluted_embeds
         return all_embeds_g
 
     def get_per_graph_ent_dropout_embeds_one_direction(self, cur_time_list, target_time_list, node_sizes, time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds, forward):
@@ -78,9 +75,10 @@ class ImputeBiDynamicRGCN(BiDynamicRGCN, ImputeDynamicRGCN):
         seq_len = self.test_seq_len if val else self.train_seq_len
         bsz = len(g_batched_list[0])
         target_time_batched_list = time_batched_list[-1]
-        hist_embeddings_loc = self.ent_embeds.new_zeros(bsz, self.num_ents, self.embed_size)
-        hist_embeddings_rec = self.ent_embeds.new_zeros(bsz, 2, self.num_ents, self.embed_size)
-        start_time_tensor = self.ent_embeds.new_zeros(bsz, self.num_ents)
+        # layers 0 and 1 are the recurrent embeddings, layer 2 the local ones
+        hist_embeddings_rec = self.new_history_store(bsz, num_layers=3)
+        hist_embeddings_loc = hist_embeddings_rec.layer(2)
+        start_time_tensor = hist_embeddings_rec.start_time
         full = val or not self.args.random_dropout
         for cur_t in range(seq_len - 1):
             g_batched_list_t, node_sizes = self.get_val_vars(g_batched_list, cur_t)
@@ -93,11 +91,9 @@ class ImputeBiDynamicRGCN(BiDynamicRGCN, ImputeDynamicRGCN):
             else:
                 second_local_embeds, first_per_graph_ent_embeds, second_per_graph_ent_embeds = self.get_per_graph_ent_embeds_one_direction(g_batched_list_t, time_batched_list[cur_t], node_sizes,
                                                                                                                   time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds, forward, full=full, rate=0.8)
-            hist_embeddings_loc, hist_embeddings_rec = self.update_time_diff_hist_embeddings(second_local_embeds, first_per_graph_ent_embeds, second_per_graph_ent_embeds, start_time_tensor, g_batched_list_t, cur_t, bsz)
+            hist_embeddings_rec.update(g_batched_list_t, cur_t, first_per_graph_ent_embeds, second_per_graph_ent_embeds, second_local_embeds)
         if not forward:
-            hist_embeddings_loc = torch.flip(hist_embeddings_loc, [0])
-            hist_embeddings_rec = torch.flip(hist_embeddings_rec, [0])
-            start_time_tensor = torch.flip(start_time_tensor, [0])
+            start_time_tensor = hist_embeddings_rec.flip().start_time
         return hist_embeddings_loc, hist_embeddings_rec, start_time_tensor
 
     def forward(self, t_list, reverse=False):
@@ -150,7 +146,7 @@ class ImputeBiDynamicRGCN(BiDynamicRGCN, ImputeDynamicRGCN):
     def calc_metrics(self, per_graph_ent_embeds, g_list, t_list, hist_embeddings_forward_loc, hist_embeddings_forward_rec, start_time_tensor_forward,
                                                     hist_embeddings_backward_loc, hist_embeddings_backward_rec, start_time_tensor_backward, cur_t):
         mrrs, hit_1s, hit_3s, hit_10s, losses = [], [], [], [], []
-        ranks = []
+        eval_queries = []
         i = 0
         for g, t, ent_embed in zip(g_list, t_list, per_graph_ent_embeds):
             time_diff_tensor_forward = cur_t - start_time_tensor_forward[i]
@@ -163,14 +159,14 @@ class ImputeBiDynamicRGCN(BiDynamicRGCN, ImputeDynamicRGCN):
                 index_sample = cuda(index_sample)
                 label = cuda(label)
             if index_sample.shape[0] == 0: continue
-            rank = self.evaluater.calc_metrics_single_graph(ent_embed, self.rel_embeds, all_embeds_g, index_sample, g, t)
+            eval_queries.append((ent_embed, all_embeds_g, index_sample, g, t))
             loss = self.link_classification_loss(ent_embed, self.rel_embeds, index_sample, label)
-            ranks.append(rank)
             losses.append(loss.item())
             i += 1
-        try:
-            ranks = torch.cat(ranks)
-        except:
+        if len(eval_queries) > 0:
+            ent_embeds, all_embeds, samples, graphs, times = zip(*eval_queries)
+            ranks = self.evaluater.calc_metrics_batched(ent_embeds, self.rel_embeds, all_embeds, samples, graphs, times)
+        else:
             ranks = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
 
         return ranks, np.mean(losses)
@@ -187,10 +183,8 @@ class PostBiDynamicRGCN(ImputeBiDynamicRGCN, PostDynamicRGCN):
         all_embeds_g_loc, all_embeds_g_rec = self.ent_encoder.forward_post_ensemble_isolated(self.ent_embeds, first_prev_graph_embeds_forward_rec, second_prev_graph_embeds_forward_rec, time_diff_tensor_forward.unsqueeze(-1),
                                                                           first_prev_graph_embeds_backward_rec, second_prev_graph_embeds_backward_rec, time_diff_tensor_backward.unsqueeze(-1), t, second_embeds_forward_loc, second_embeds_backward_loc)
 
-        keys = np.array(list(g.ids.keys()))
-        values = np.array(list(g.ids.values()))
-        all_embeds_g_loc[values] = convoluted_embeds_loc[keys]
-        all_embeds_g_rec[values] = convoluted_embeds_rec[keys]
+        all_embeds_g_loc[get_node_ids(g, all_embeds_g_loc.device)] = convoluted_embeds_loc
+        all_embeds_g_rec[get_node_ids(g, all_embeds_g_rec.device)] = convoluted_embeds_rec
         # for k, v in g.ids.items():
         #     all_embeds_g_loc[v] = convoluted_embeds_loc[k]
         #     all_embeds_g_rec[v] = convoluted_embeds_rec[k]
@@ -5,7 +5,7 @@ from utils.utils import filter_none
 import torch
 from models.RRGCN import RRGCN
 import numpy as np
-from utils.utils import move_dgl_to_cuda, comp_deg_norm, node_norm_to_edge_norm, cuda
+from utils.utils import move_dgl_to_cuda, comp_deg_norm, node_norm_to_edge_norm, cuda, get_node_ids, local_to_global
 from utils.scores import *
 import dgl
 from utils.DropEdge import DropEdge
@@ -25,22 +25,9 @@ class ImputeDynamicRGCN(DynamicRGCN):
         # all_embeds_g = self.ent_embeds.new_zeros(self.ent_embeds.shape)
         all_embeds_g = self.ent_encoder.forward_isolated_impute(self.ent_embeds, first_prev_graph_embeds, second_prev_graph_embeds, time_diff_tensor.unsqueeze(-1), t, second_embeds_loc)
 
-        keys = np.array(list(g.ids.keys()))
-        values = np.array(list(g.ids.values()))
-        all_embeds_g[values] = convoluted_embeds[keys]
+        all_embeds_g[get_node_ids(g, all_embeds_g.device)] = convoluted_embeds
         return all_embeds_g
 
-    def update_time_diff_hist_embeddings(self, second_local_embeds, first_per_graph_ent_embeds, second_per_graph_ent_embeds, start_time_tensor, g_batched_list_t, cur_t, bsz):
-        loc = start_time_tensor.new_zeros(bsz, self.num_ents, self.embed_size)
-        rec = start_time_tensor.new_zeros(bsz, 2, self.num_ents, self.embed_size)
-        for i in range(len(first_per_graph_ent_embeds)):
-            idx = g_batched_list_t[i].ndata['id'].squeeze()
-            loc[i][idx] = second_local_embeds[i]
-            rec[i][0][idx] = first_per_graph_ent_embeds[i]
-            rec[i][1][idx] = second_per_graph_ent_embeds[i]
-            start_time_tensor[i][idx] = cur_t
-        return loc, rec
-
     def get_per_graph_ent_embeds(self, g_batched_list_t, time_batched_list_t, node_sizes, time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds, full, rate=0.5):
         batched_graph = self.get_batch_graph_embeds(g_batched_list_t, full, rate)
         if self.use_cuda:
@@ -61,9 +48,10 @@ class ImputeDynamicRGCN(DynamicRGCN):
         seq_len = self.test_seq_len if val else self.train_seq_len
         bsz = len(g_batched_list[0])
         target_time_batched_list = time_batched_list[-1]
-        hist_embeddings_loc = self.ent_embeds.new_zeros(bsz, self.num_ents, self.embed_size)
-        hist_embeddings_rec = self.ent_embeds.new_zeros(bsz, 2, self.num_ents, self.embed_size)
-        start_time_tensor = self.ent_embeds.new_zeros(bsz, self.num_ents)
+        # layers 0 and 1 are the recurrent embeddings, layer 2 the local ones
+        hist_embeddings_rec = self.new_history_store(bsz, num_layers=3)
+        hist_embeddings_loc = hist_embeddings_rec.layer(2)
+        start_time_tensor = hist_embeddings_rec.start_time
         full = val or not self.args.random_dropout
         for cur_t in range(seq_len - 1):
             g_batched_list_t, node_sizes = self.get_val_vars(g_batched_list, cur_t)
@@ -75,7 +63,7 @@ class ImputeDynamicRGCN(DynamicRGCN):
             else:
                 second_local_embeds, first_per_graph_ent_embeds, second_per_graph_ent_embeds = self.get_per_graph_ent_embeds(g_batched_list_t, time_batched_list[cur_t], node_sizes,
                                                                                                         time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds, full=full, rate=0.8)
-            hist_embeddings_loc, hist_embeddings_rec = self.update_time_diff_hist_embeddings(second_local_embeds, first_per_graph_ent_embeds, second_per_graph_ent_embeds, start_time_tensor, g_batched_list_t, cur_t, bsz)
+            hist_embeddings_rec.update(g_batched_list_t, cur_t, first_per_graph_ent_embeds, second_per_graph_ent_embeds, second_local_embeds)
         return hist_embeddings_loc, hist_embeddings_rec, start_time_tensor
 
     def forward(self, t_list, reverse=False):
@@ -118,7 +106,7 @@ class ImputeDynamicRGCN(DynamicRGCN):
 
     def calc_metrics(self, per_graph_ent_embeds, g_list, t_list, hist_embeddings_loc, hist_embeddings_rec, start_time_tensor, cur_t):
         mrrs, hit_1s, hit_3s, hit_10s, losses = [], [], [], [], []
-        ranks = []
+        eval_queries = []
         i = 0
         for g, t, ent_embed in zip(g_list, t_list, per_graph_ent_embeds):
             time_diff_tensor = cur_t - start_time_tensor[i]
@@ -130,14 +118,14 @@ class ImputeDynamicRGCN(DynamicRGCN):
                 index_sample = cuda(index_sample)
                 label = cuda(label)
             if index_sample.shape[0] == 0: continue
-            rank = self.evaluater.calc_metrics_single_graph(ent_embed, self.rel_embeds, all_embeds_g, index_sample, g, t)
+            eval_queries.append((ent_embed, all_embeds_g, index_sample, g, t))
             loss = self.link_classification_loss(ent_embed, self.rel_embeds, index_sample, label)
-            ranks.append(rank)
             losses.append(loss.item())
             i += 1
-        try:
-            ranks = torch.cat(ranks)
-        except:
+        if len(eval_queries) > 0:
+            ent_embeds, all_embeds, samples, graphs, times = zip(*eval_queries)
+            ranks = self.evaluater.calc_metrics_batched(ent_embeds, self.rel_embeds, all_embeds, samples, graphs, times)
+        else:
             ranks = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
 
         return ranks, np.mean(losses)
@@ -176,10 +164,8 @@ class PostDynamicRGCN(ImputeDynamicRGCN):
         all_embeds_g_loc, all_embeds_g_rec = self.ent_encoder.forward_post_ensemble_isolated(self.ent_embeds, first_prev_graph_embeds,
                                                                 second_prev_graph_embeds, time_diff_tensor.unsqueeze(-1), t, second_embeds_loc)
 
-        keys = np.array(list(g.ids.keys()))
-        values = np.array(list(g.ids.values()))
-        all_embeds_g_loc[values] = convoluted_embeds_loc[keys]
-        all_embeds_g_rec[values] = convoluted_embeds[keys]
+        all_embeds_g_loc[get_node_ids(g, all_embeds_g_loc.device)] = convoluted_embeds_loc
+        all_embeds_g_rec[get_node_ids(g, all_embeds_g_rec.device)] = convoluted_embeds
 
         # for k, v in g.ids.items():
         #     all_embeds_g_loc[v] = convoluted_embeds_loc[k]
@@ -282,41 +268,14 @@ class PostDynamicRGCN(ImputeDynamicRGCN):
         return predict_loss
 
     def calc_ensemble_ratio(self, triples, t, g):
-        sub_feature_vecs = []
-        obj_feature_vecs = []
-        t = t.item()
-        for s, r, o in triples:
-
-            s = g.ids[s.item()]
-            r = r.item()
-            o = g.ids[o.item()]
-            # triple_freq = self.drop_edge.triple_freq_per_time_step_agg[t][(s, r, o)]
-            # ent_pair_freq = self.drop_edge.ent_pair_freq_per_time_step_agg[t][(s, o)]
-            sub_freq = self.drop_edge.sub_freq_per_time_step_agg[t][s]
-            obj_freq = self.drop_edge.obj_freq_per_time_step_agg[t][o]
-            rel_freq = self.drop_edge.rel_freq_per_time_step_agg[t][r]
-            sub_rel_freq = self.drop_edge.sub_rel_freq_per_time_step_agg[t][(s, r)]
-            obj_rel_freq = self.drop_edge.obj_rel_freq_per_time_step_agg[t][(o, r)]
-            # 0: no local, 1: no temporal
-
-            sub_feature_vecs.append(torch.tensor([obj_freq, rel_freq, obj_rel_freq]))
-            obj_feature_vecs.append(torch.tensor([sub_freq, rel_freq, sub_rel_freq]))
-
-        try:
-            sub_features = torch.stack(sub_feature_vecs).float()
-            obj_features = torch.stack(obj_feature_vecs).float()
-            if self.use_cuda:
-                sub_features = cuda(sub_features)
-                obj_features = cuda(obj_features)
-            weight_subject_query_subject_embed = torch.sigmoid(self.subject_query_subject_embed_linear(sub_features))
-            weight_subject_query_object_embed = torch.sigmoid(self.subject_query_subject_embed_linear(sub_features))
-            weight_object_query_subject_embed = torch.sigmoid(self.object_query_subject_embed_linear(obj_features))
-            weight_object_query_object_embed = torch.sigmoid(self.object_query_subject_embed_linear(obj_features))
-        except:
-            weight_subject_query_subject_embed = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
-            weight_subject_query_object_embed = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
-            weight_object_query_subject_embed = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
-            weight_object_query_object_embed = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
+        sub_features, obj_features = self.drop_edge.get_ensemble_features(local_to_global(g, triples[:, 0]), triples[:, 1], local_to_global(g, triples[:, 2]), t.item())
+        if self.use_cuda:
+            sub_features = cuda(sub_features)
+            obj_features = cuda(obj_features)
+        weight_subject_query_subject_embed = torch.sigmoid(self.subject_query_subject_embed_linear(sub_features))
+        weight_subject_query_object_embed = torch.sigmoid(self.subject_query_subject_embed_linear(sub_features))
+        weight_object_query_subject_embed = torch.sigmoid(self.object_query_subject_embed_linear(obj_features))
+        weight_object_query_object_embed = torch.sigmoid(self.object_query_subject_embed_linear(obj_features))
 
         return weight_subject_query_subject_embed, weight_subject_query_object_embed, weight_object_query_subject_embed, weight_object_query_object_embed
 
@@ -428,35 +387,11 @@ class PostEnsembleDynamicRGCN(PostDynamicRGCN):
         return predict_loss
 
     def calc_ensemble_ratio(self, triples, t, g):
-        sub_feature_vecs = []
-        obj_feature_vecs = []
-        t = t.item()
-        for s, r, o in triples:
-
-            s = g.ids[s.item()]
-            r = r.item()
-            o = g.ids[o.item()]
-            # triple_freq = self.drop_edge.triple_freq_per_time_step_agg[t][(s, r, o)]
-            # ent_pair_freq = self.drop_edge.ent_pair_freq_per_time_step_agg[t][(s, o)]
-            sub_freq = self.drop_edge.sub_freq_per_time_step_agg[t][s]
-            obj_freq = self.drop_edge.obj_freq_per_time_step_agg[t][o]
-            rel_freq = self.drop_edge.rel_freq_per_time_step_agg[t][r]
-            sub_rel_freq = self.drop_edge.sub_rel_freq_per_time_step_agg[t][(s, r)]
-            obj_rel_freq = self.drop_edge.obj_rel_freq_per_time_step_agg[t][(o, r)]
-            # 0: no local, 1: no temporal
-            sub_feature_vecs.append(torch.tensor([obj_freq, rel_freq, obj_rel_freq]))
-            obj_feature_vecs.append(torch.tensor([sub_freq, rel_freq, sub_rel_freq]))
-
-        try:
-            sub_features = torch.stack(sub_feature_vecs).float()
-            obj_features = torch.stack(obj_feature_vecs).float()
-            if self.use_cuda:
-                sub_features = cuda(sub_features)
-                obj_features = cuda(obj_features)
-            weight_subject = torch.sigmoid(self.subject_linear(sub_features))
-            weight_object = torch.sigmoid(self.object_linear(obj_features))
-        except:
-            weight_subject = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
-            weight_object = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
+        sub_features, obj_features = self.drop_edge.get_ensemble_features(local_to_global(g, triples[:, 0]), triples[:, 1], local_to_global(g, triples[:, 2]), t.item())
+        if self.use_cuda:
+            sub_features = cuda(sub_features)
+            obj_features = cuda(obj_features)
+        weight_subject = torch.sigmoid(self.subject_linear(sub_features))
+        weight_object = torch.sigmoid(self.object_linear(obj_features))
 
         return weight_subject, weight_object
\ No newline at end of file
@@ -48,14 +48,21 @@ class SARGCNLayer(RGCNLayer):
 
     def attention(self, q, k, v, local_attn_mask, decay_weight):
         scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.d_k)
-        normalised = F.softmax(scores.squeeze() + local_attn_mask.unsqueeze(1) + decay_weight, dim=-1)
-        output = torch.matmul(normalised.unsqueeze(2), v).squeeze()
+        normalised = F.softmax(scores.squeeze(2) + local_attn_mask.unsqueeze(1) + decay_weight, dim=-1)
+        output = torch.matmul(normalised.unsqueeze(2), v).squeeze(2)
         return output
 
-    def forward_isolated(self, node_repr, prev_embeddings, time_diff, local_attn_mask, time):
+    def calc_active_result(self, cur_embeddings, prev_embeddings, time_diff, local_attn_mask, active_idx):
+        # entities never seen in the window only attend to their current embedding, which leaves its value projection
+        result = self.v_linear(cur_embeddings)
+        if active_idx.shape[0] == 0:
+            return result
+        return result.index_copy(0, active_idx, self.calc_result(cur_embeddings[active_idx], prev_embeddings, time_diff, local_attn_mask))
+
+    def forward_isolated(self, node_repr, prev_embeddings, time_diff, local_attn_mask, time, active_idx):
         cur_embeddings, time_embedding = super().forward_isolated(node_repr, time)
         cur_time_embeddings = cur_embeddings + time_embedding
-        concat = self.calc_result(cur_time_embeddings, prev_embeddings, time_diff, local_attn_mask)
+        concat = self.calc_active_result(cur_time_embeddings, prev_embeddings, time_diff, local_attn_mask, active_idx)
         if self.post_aggregation:
             return cur_time_embeddings, concat
         else:
@@ -116,12 +123,12 @@ class SARGCN(nn.Module):
         # JK max pooling over the first and second layer
         return second_attn_embed if self.rec_only_last_layer else torch.max(torch.stack([first_attn_embed, second_attn_embed], dim=-1), dim=-1)[0]
 
-    def forward_isolated(self, ent_embeds, first_layer_prev_embeddings, second_layer_prev_embeddings, time_diff, local_attn_mask, time):
+    def forward_isolated(self, ent_embeds, first_layer_prev_embeddings, second_layer_prev_embeddings, time_diff, local_attn_mask, time, active_idx):
         if not self.rec_only_last_layer:
-            first_ent_embeds = self.layer_1.forward_isolated(ent_embeds, first_layer_prev_embeddings, time_diff, local_attn_mask, time)
+            first_ent_embeds = self.layer_1.forward_isolated(ent_embeds, first_layer_prev_embeddings, time_diff, local_attn_mask, time, active_idx)
         else:
             first_ent_embeds, _ = self.layer_1.forward_isolated(ent_embeds, time)
-        second_ent_embeds = self.layer_2.forward_isolated(first_ent_embeds, second_layer_prev_embeddings, time_diff, local_attn_mask, time)
+        second_ent_embeds = self.layer_2.forward_isolated(first_ent_embeds, second_layer_prev_embeddings, time_diff, local_attn_mask, time, active_idx)
         return torch.max(torch.stack([first_ent_embeds, second_ent_embeds], dim=-1), dim=-1)[0] if not self.rec_only_last_layer else second_ent_embeds
 
     def forward_ema_isolated(self, ent_embeds, second_layer_prev_embeddings, time, alpha, train_seq_len):
@@ -140,7 +147,7 @@ class SARGCN(nn.Module):
         # JK max pooling over the first and second layer
         return second_local_embeds, second_attn_embed
 
-    def forward_isolated_post_ensemble(self, ent_embeds, second_layer_prev_embeddings, time_diff, local_attn_mask, time):
+    def forward_isolated_post_ensemble(self, ent_embeds, second_layer_prev_embeddings, time_diff, local_attn_mask, time, active_idx):
         first_ent_embeds, _ = self.layer_1.forward_isolated(ent_embeds, time)
-        second_local_embeds, second_ent_embeds = self.layer_2.forward_isolated(first_ent_embeds, second_layer_prev_embeddings, time_diff, local_attn_mask, time)
+        second_local_embeds, second_ent_embeds = self.layer_2.forward_isolated(first_ent_embeds, second_layer_prev_embeddings, time_diff, local_attn_mask, time, active_idx)
         return second_local_embeds, second_ent_embeds
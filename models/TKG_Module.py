@@ -2,17 +2,23 @@ import numpy as np
 from utils.scores import *
 import pytorch_lightning as pl
 from pytorch_lightning.root_module.root_module import LightningModule
-from collections import OrderedDict
+from collections import OrderedDict, ChainMap
+import inspect
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
-from utils.dataset import TimeDataset
+from utils.dataset import TimeDataset, TrainBatch, seed_loader_worker
 from argparse import Namespace
 from utils.CorrptTriples import CorruptTriples
 import torch.nn.functional as F
 from utils.utils import filter_none
 from utils.evaluation import EvaluationFilter
+from utils.metrics import RankAccumulator
+from utils.profiler import profiler, profiled
+from utils.memory import memory_tracker
 from utils.utils import cuda
 from utils.dataset import load_quadruples
+from utils.timeline import get_batch_graph_list
 import pdb
 import gc
 
@@ -33,16 +39,28 @@ class TKG_Module(LightningModule):
         self.use_cuda = args.use_cuda
         self.num_pos_facts = args.num_pos_facts
         self.negative_rate = args.negative_rate
-        self.calc_score = {'distmult': distmult, 'complex': complex, 'transE': transE}[args.score_function]
+        self.calc_score = get_score_function(args.score_function, getattr(args, 'score_kernel', 'broadcast'))
+        # metrics of the running validation or test loop, and an optional callback seeing the ranks of every test batch
+        self.rank_accumulator = None
+        self.rank_listener = None
+        profiler.configure(getattr(args, 'profile', False) or getattr(args, 'profile_trace', None) is not None,
+                           sync=self.use_cuda, trace_path=getattr(args, 'profile_trace', None))
         self.build_model()
+        memory_tracker.checkpoint('encoder')
         self.set_extra_vars()
         if not args.debug:
             self.corrupter = CorruptTriples(self.args, graph_dict_train)
+            memory_tracker.checkpoint('corrupter')
             self.evaluater = evaluater_type(args, self.calc_score, graph_dict_train, graph_dict_val, graph_dict_test)
+            memory_tracker.checkpoint('evaluater')
 
     def training_step(self, batch_time, batch_idx):
         # gc.collect()
+        if isinstance(batch_time, TrainBatch):
+            self.install_train_payload(batch_time.payload)
+            batch_time = batch_time.times
         loss = self.forward(batch_time)
+        memory_tracker.sample_step()
         if self.trainer.use_dp or self.trainer.use_ddp2:
             loss = loss.unsqueeze(0)
         tqdm_dict = {'train_loss': loss}
@@ -63,6 +81,7 @@ class TKG_Module(LightningModule):
         :param batch:
         :return:
         """
+        self.reset_query_keys()
         ranks, loss = self.evaluate(batch_time)
 
         # in DP mode (default) make sure if result is scalar, there's another dim in the beginning
@@ -74,25 +93,25 @@ class TKG_Module(LightningModule):
             'val_loss': loss,
         })
         output = OrderedDict({
-            'ranks': ranks,
             'val_loss': loss
         })
+        self.fold_ranks(output, ranks, batch_time)
         self.logger.experiment.log(log_output)
         return output
 
     def validation_end(self, outputs):
         avg_val_loss = np.mean([x['val_loss'] for x in outputs])
-        all_ranks = torch.cat([x['ranks'] for x in outputs])
-        mrr, hit_1, hit_3, hit_10 = self.get_metrics(all_ranks)
+        metrics = self.collect_ranks(outputs).result()
 
-        return {'mrr': mrr,
+        return {'mrr': metrics['mrr'],
                 'avg_val_loss': avg_val_loss,
-                'hit_10': hit_10,
-                'hit_3': hit_3,
-                'hit_1': hit_1
+                'hit_10': metrics['hit_10'],
+                'hit_3': metrics['hit_3'],
+                'hit_1': metrics['hit_1']
                 }
 
     def test_step(self, batch_time, batch_idx):
+        self.reset_query_keys()
         ranks, loss = self.evaluate(batch_time, val=True)
 
         # in DP mode (default) make sure if result is scalar, there's another dim in the beginning
@@ -105,35 +124,83 @@ class TKG_Module(LightningModule):
         })
 
         output = OrderedDict({
-            'ranks': ranks,
             'test_loss': loss,
-            'batch_time': batch_time
         })
+        self.fold_ranks(output, ranks, batch_time)
+        if self.rank_listener is not None:
+            self.rank_listener(batch_time, ranks)
         self.logger.experiment.log(log_output)
 
         return output
 
     def test_end(self, outputs):
         avg_test_loss = np.mean([x['test_loss'] for x in outputs])
-        all_ranks = torch.cat([x['ranks'] for x in outputs])
-        mrr, hit_1, hit_3, hit_10 = self.get_metrics(all_ranks)
-        test_result = {'mrr': mrr.item(),
+        accumulator = self.collect_ranks(outputs)
+        metrics = accumulator.result()
+        test_result = {'mrr': metrics['mrr'],
                         'avg_test_loss': avg_test_loss.item(),
-                        'hit_10': hit_10.item(),
-                        'hit_3': hit_3.item(),
-                        'hit_1': hit_1.item()
+                        'hit_10': metrics['hit_10'],
+                        'hit_3': metrics['hit_3'],
+                        'hit_1': metrics['hit_1'],
+                        'median_rank': accumulator.quantile(0.5)
                         }
 
         print(test_result)
+        self.log_profile('test')
 
-        test_result['batch_times'] = [x['batch_time'] for x in outputs]
-        test_result['all_ranks'] = [x['ranks'] for x in outputs]
+        for name in accumulator.breakdowns:
+            test_result['{}_breakdown'.format(name)] = accumulator.breakdown(name)
+        if accumulator.keep_ranks:
+            test_result['batch_times'] = [batch_time for batch_time, _ in accumulator.kept]
+            test_result['all_ranks'] = [ranks for _, ranks in accumulator.kept]
         return test_result
 
+    def on_epoch_end(self):
+        epoch = getattr(self.trainer, 'current_epoch', None)
+        self.log_profile('epoch', epoch)
+        memory_peaks = memory_tracker.flush_steps(epoch)
+        if len(memory_peaks) > 0:
+            self.logger.experiment.log(memory_peaks)
+
+    def log_profile(self, phase, step=None):
+        # stage timings and counters since the last summary, see utils/profiler.py
+        summary = profiler.flush(phase, step)
+        if len(summary) > 0:
+            self.logger.experiment.log(summary)
+
+    def new_rank_accumulator(self):
+        breakdowns = [name for name in getattr(self.args, 'metric_breakdowns', '').split(',') if name]
+        if len(breakdowns) > 0 and (self.trainer.use_dp or self.trainer.use_ddp2):
+            # dp folds ranks gathered from the replicas, which carry no query keys
+            raise ValueError("--metric-breakdowns is not supported with the dp and ddp2 backends")
+        return RankAccumulator(self.num_ents, breakdowns, getattr(self.args, 'keep_ranks', False))
+
+    def reset_query_keys(self):
+        if hasattr(self, 'evaluater'):
+            self.evaluater.last_query_keys = None
+
+    def fold_ranks(self, output, ranks, batch_time):
+        # dp steps run on module replicas, so their ranks travel in the outputs and are folded in the end hooks
+        if self.trainer.use_dp or self.trainer.use_ddp2:
+            output.update({'ranks': ranks, 'batch_time': batch_time})
+            return
+        if self.rank_accumulator is None:
+            self.rank_accumulator = self.new_rank_accumulator()
+        query_keys = self.evaluater.last_query_keys if hasattr(self, 'evaluater') else None
+        self.rank_accumulator.add(ranks, batch_time, query_keys)
+
+    def collect_ranks(self, outputs):
+        accumulator = self.rank_accumulator if self.rank_accumulator is not None else self.new_rank_accumulator()
+        self.rank_accumulator = None
+        for x in outputs:
+            if 'ranks' in x:
+                accumulator.add(x['ranks'], x['batch_time'])
+        return accumulator
+
     def set_extra_vars(self):
         if not self.args.dataset_dir == 'extrapolation':
             return
-        self.graph_dict_total = {**self.graph_dict_train, **self.graph_dict_val, **self.graph_dict_test}
+        self.graph_dict_total = ChainMap(self.graph_dict_test, self.graph_dict_val, self.graph_dict_train)
         _, self.train_times = load_quadruples(self.args.dataset, 'train.txt')
         _, self.test_times = load_quadruples(self.args.dataset, 'test.txt')
         if self.args.dataset == 'extrapolation/icews14':
@@ -159,7 +226,29 @@ class TKG_Module(LightningModule):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.args.lr, weight_decay=0.0001)
         return optimizer
 
-    def _dataloader(self, times):
+    def prepare_train_batch(self, t_list):
+        """
+        cpu side of a training step, run in the loader workers while the main process trains on an earlier batch
+        :return: negative samples of every target graph and, with edge dropout, the sampled subgraphs of its window
+        """
+        negatives, subgraphs = {}, {}
+        for t in t_list.tolist():
+            negatives[t] = self.corrupter.sample_negatives(t, self.graph_dict_train[t], self.num_ents)
+            if getattr(self, 'edge_dropout', False):
+                subgraphs.update(self.drop_edge.sample_window_subgraphs(t))
+        return {'negatives': negatives, 'subgraphs': subgraphs}
+
+    def install_train_payload(self, payload):
+        # anything left over from the previous batch is stale
+        self.corrupter.prefetched = payload['negatives']
+        if getattr(self, 'edge_dropout', False):
+            self.drop_edge.prefetched = payload['subgraphs']
+
+    def collate_train_batch(self, times):
+        t_list = default_collate(times)
+        return TrainBatch(t_list, self.prepare_train_batch(t_list))
+
+    def _dataloader(self, times, train=False):
         # when using multi-node (ddp) we need to add the  datasampler
         dataset = TimeDataset(times)
         batch_size = self.args.batch_size
@@ -168,12 +257,20 @@ class TKG_Module(LightningModule):
             train_sampler = DistributedSampler(dataset)
 
         should_shuffle = train_sampler is None
+        num_workers = getattr(self.args, 'num_workers', 0) if train else 0
+        prefetch_kwargs = {}
+        if num_workers > 0:
+            prefetch_kwargs = {'collate_fn': self.collate_train_batch, 'worker_init_fn': seed_loader_worker}
+            # older DataLoaders always keep two batches in flight per worker
+            if 'prefetch_factor' in inspect.signature(DataLoader.__init__).parameters:
+                prefetch_kwargs['prefetch_factor'] = max(1, getattr(self.args, 'prefetch_batches', 2))
         loader = DataLoader(
             dataset=dataset,
             batch_size=batch_size,
             shuffle=should_shuffle,
             sampler=train_sampler,
-            num_workers=0
+            num_workers=num_workers,
+            **prefetch_kwargs
         )
 
         return loader
@@ -181,9 +278,9 @@ class TKG_Module(LightningModule):
     @pl.data_loader
     def train_dataloader(self):
         if self.args.dataset_dir == 'extrapolation':
-            return self._dataloader(self.train_times)
+            return self._dataloader(self.train_times, train=True)
         else:
-            return self._dataloader(self.total_time)
+            return self._dataloader(self.total_time, train=True)
 
     @pl.data_loader
     def val_dataloader(self):
@@ -199,6 +296,7 @@ class TKG_Module(LightningModule):
         else:
             return self._dataloader(self.total_time)
 
+    @profiled('train_scoring')
     def train_link_prediction(self, ent_embed, triplets, neg_samples, labels, all_embeds_g, corrupt_tail=True):
         r = self.rel_embeds[triplets[:, 1]]
         if corrupt_tail:
@@ -230,29 +328,12 @@ class TKG_Module(LightningModule):
         return torch.max(pos_facts, dim=0)[0]
 
     def get_batch_graph_list(self, t_list, seq_len, graph_dict):
-        times = list(graph_dict.keys())
-        # time_unit = times[1] - times[0]  # compute time unit
-        time_list = []
-
-        t_list = t_list.sort(descending=True)[0]
-        g_list = []
-        # s_lst = [t/15 for t in times]
-        # print(s_lst)
-        for tim in t_list:
-            # length = int(tim / time_unit) + 1
-            # cur_seq_len = seq_len if seq_len <= length else length
-            length = times.index(tim) + 1
-            time_seq = times[length - seq_len:length] if seq_len <= length else times[:length]
-            time_list.append(([None] * (seq_len - len(time_seq))) + time_seq)
-            g_list.append(([None] * (seq_len - len(time_seq))) + [graph_dict[t] for t in time_seq])
-        t_batched_list = [list(x) for x in zip(*time_list)]
-        g_batched_list = [list(x) for x in zip(*g_list)]
-        return g_batched_list, t_batched_list
+        return get_batch_graph_list(t_list, seq_len, graph_dict)
 
     # TODO: fix eval so that all nodes including isolated ones are considered in the evaluation
     def calc_metrics(self, g_list, t_list):
         mrrs, hit_1s, hit_3s, hit_10s, losses = [], [], [], [], []
-        ranks = []
+        eval_queries = []
         for g, t in zip(g_list, t_list):
 
             ent_embed = self.get_per_graph_ent_embeds(t, g)
@@ -265,10 +346,13 @@ class TKG_Module(LightningModule):
 
             if index_sample.shape[0] == 0: continue
 
-            rank = self.evaluater.calc_metrics_single_graph(ent_embed, self.rel_embeds, all_embeds_g, index_sample, g, t)
+            eval_queries.append((ent_embed, all_embeds_g, index_sample, g, t))
             loss = self.link_classification_loss(ent_embed, self.rel_embeds, index_sample, label)
-            ranks.append(rank)
             losses.append(loss.item())
-        ranks = torch.cat(ranks)
+        if len(eval_queries) > 0:
+            ent_embeds, all_embeds, samples, graphs, times = zip(*eval_queries)
+            ranks = self.evaluater.calc_metrics_batched(ent_embeds, self.rel_embeds, all_embeds, samples, graphs, times)
+        else:
+            ranks = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
 
         return ranks, np.mean(losses)
@@ -4,7 +4,7 @@ import numpy as np
 from utils.utils import comp_deg_norm, move_dgl_to_cuda
 import torch.nn as nn
 import torch
-from utils.utils import node_norm_to_edge_norm
+from utils.utils import node_norm_to_edge_norm, get_node_ids
 import math
 
 
@@ -38,8 +38,7 @@ class TimeDynamicRGCN(DynamicRGCN):
             all_embeds_g = self.ent_encoder.forward_isolated(input_embeddings, first_prev_graph_embeds,
                                                              second_prev_graph_embeds, time_diff_tensor.unsqueeze(-1))
 
-        for k, v in g.ids.items():
-            all_embeds_g[v] = convoluted_embeds[k]
+        all_embeds_g[get_node_ids(g, all_embeds_g.device)] = convoluted_embeds
         return all_embeds_g
 
     def get_per_graph_ent_embeds(self, g_batched_list_t, time_batched_list_t, node_sizes, time_diff_tensor, first_prev_graph_embeds, second_prev_graph_embeds, val=False):
@@ -59,7 +58,6 @@ class TimeDynamicRGCN(DynamicRGCN):
                 sg.ndata.update({'id': g.ndata['id'], 'norm': torch.from_numpy(node_norm).view(-1, 1)})
                 sg.edata['norm'] = node_norm_to_edge_norm(sg, torch.from_numpy(node_norm).view(-1, 1))
                 sg.edata['type_s'] = rel[total_idx]
-                sg.ids = g.ids
                 sampled_graph_list.append(sg)
 
         ent_embeds = []
@@ -11,9 +11,11 @@ import json
 from models.BiDynamicRGCN import BiDynamicRGCN
 from models.SelfAttentionRGCN import SelfAttentionRGCN
 from models.BiSelfAttentionRGCN import BiSelfAttentionRGCN
-from utils.utils import cuda
-from utils.CorrptTriples import CorruptTriples
+from utils.utils import cuda, local_to_global
+from utils.evaluation import EvaluationFilter
+from utils.true_index import get_true_head_and_tail_per_time
 import torch.nn.functional as F
+from collections import ChainMap
 from models.PostDynamicRGCN import ImputeDynamicRGCN, PostDynamicRGCN, PostEnsembleDynamicRGCN
 from models.PostBiDynamicRGCN import ImputeBiDynamicRGCN, PostBiDynamicRGCN, PostEnsembleBiDynamicRGCN
 from models.PostSelfAttentionRGCN import PostBiSelfAttentionRGCN
@@ -34,7 +36,7 @@ class Aggregator(TKG_Module):
 
         # import pdb; pdb.set_trace()
 
-        self.graph_dict_total = {**self.graph_dict_train, **self.graph_dict_val, **self.graph_dict_test}
+        self.graph_dict_total = ChainMap(self.graph_dict_test, self.graph_dict_val, self.graph_dict_train)
 
         self.get_true_head_and_tail_all()
 
@@ -121,50 +123,15 @@ class Aggregator(TKG_Module):
         pass
 
     def get_true_head_and_tail_all(self):
-        self.true_heads = dict()
-        self.true_tails = dict()
-        for t in self.total_time:
-            triples = []
-            for g in self.graph_dict_train[t], self.graph_dict_val[t], self.graph_dict_test[t]:
-                triples.append(torch.stack([g.edges()[0], g.edata['type_s'], g.edges()[1]]).transpose(0, 1))
-            triples = torch.cat(triples, dim=0)
-            true_head, true_tail = CorruptTriples.get_true_head_and_tail_per_graph(triples)
-            self.true_heads[t] = true_head
-            self.true_tails[t] = true_tail
+        self.true_heads, self.true_tails = get_true_head_and_tail_per_time(self.graph_dict_train, self.graph_dict_val, self.graph_dict_test)
 
     def calc_ensemble_ratio(self, triples, t, g):
-        sub_feature_vecs = []
-        obj_feature_vecs = []
-        t = t.item()
-        for s, r, o in triples:
-
-            s = g.ids[s.item()]
-            r = r.item()
-            o = g.ids[o.item()]
-            # triple_freq = self.drop_edge.triple_freq_per_time_step_agg[t][(s, r, o)]
-            # ent_pair_freq = self.drop_edge.ent_pair_freq_per_time_step_agg[t][(s, o)]
-            sub_freq = self.drop_edge.sub_freq_per_time_step_agg[t][s]
-            obj_freq = self.drop_edge.obj_freq_per_time_step_agg[t][o]
-            rel_freq = self.drop_edge.rel_freq_per_time_step_agg[t][r]
-            sub_rel_freq = self.drop_edge.sub_rel_freq_per_time_step_agg[t][(s, r)]
-            obj_rel_freq = self.drop_edge.obj_rel_freq_per_time_step_agg[t][(o, r)]
-            # 0: no local, 1: no temporal
-
-            sub_feature_vecs.append(torch.tensor([obj_freq, rel_freq, obj_rel_freq]))
-            obj_feature_vecs.append(torch.tensor([sub_freq, rel_freq, sub_rel_freq]))
-        # pdb.set_trace()
-
-        try:
-            sub_features = torch.stack(sub_feature_vecs).float()
-            obj_features = torch.stack(obj_feature_vecs).float()
-            if self.use_cuda:
-                sub_features = cuda(sub_features)
-                obj_features = cuda(obj_features)
-            weight_subject = torch.sigmoid(self.subject_linear(sub_features))
-            weight_object = torch.sigmoid(self.object_linear(obj_features))
-        except:
-            weight_subject = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
-            weight_object = cuda(torch.tensor([]).long()) if self.use_cuda else torch.tensor([]).long()
+        sub_features, obj_features = self.drop_edge.get_ensemble_features(local_to_global(g, triples[:, 0]), triples[:, 1], local_to_global(g, triples[:, 2]), t.item())
+        if self.use_cuda:
+            sub_features = cuda(sub_features)
+            obj_features = cuda(obj_features)
+        weight_subject = torch.sigmoid(self.subject_linear(sub_features))
+        weight_object = torch.sigmoid(self.object_linear(obj_features))
 
         return weight_subject, weight_object
 
@@ -273,6 +240,7 @@ class Aggregator(TKG_Module):
 
             ranks = torch.cat([ranks_s, ranks_o])
             ranks += 1 # change to 1-indexed
+            self.evaluater.record_query_keys([samples], [time])
             # print("Graph {} mean ranks {}".format(time.item(), ranks.float().mean().item()))
         return ranks
 
@@ -292,7 +260,7 @@ class Aggregator(TKG_Module):
             targets.append(target)
         scores = weight * torch.cat(local_scores) + (1 - weight) * torch.cat(temporal_scores)
         targets = torch.cat(targets)
-        ranks.append(self.sort_and_rank(torch.sigmoid(scores), targets))
+        ranks.append(self.sort_and_rank(scores, targets))
         return torch.cat(ranks)
 
     def get_score(self, ent_mean, rel_enc_means, all_ent_embeds, s, r, o, test_size, mask, graph, idx, batch_size=100, mode ='tail'):
@@ -308,33 +276,18 @@ class Aggregator(TKG_Module):
             batch_s = all_ent_embeds
             batch_o = ent_mean[o[batch_start: batch_end]]
             target = s[batch_start: batch_end]
-        target = torch.tensor([graph.ids[i.item()] for i in target])
+        target = local_to_global(graph, target)
 
         if self.args.use_cuda:
             target = cuda(target)
 
         unmasked_score = self.calc_score(batch_s, batch_r, batch_o, mode=mode)
-        masked_score = torch.where(mask[batch_start: batch_end], -10e6 * unmasked_score.new_ones(unmasked_score.shape), unmasked_score)
+        masked_score = self.apply_eval_mask(unmasked_score, mask, batch_start, batch_end)
         return masked_score, target  # bsz, n_ent
 
-    def mask_eval_set(self, test_triplets, test_size, num_ent, time, graph, mode='tail'):
-        time = int(time.item())
-        mask = test_triplets.new_zeros(test_size, num_ent)
-        for i in range(test_size):
-            h, r, t = test_triplets[i]
-            h, r, t = h.item(), r.item(), t.item()
-            if mode == 'tail':
-                tails = self.true_tails[time][(h, r)]
-                tail_idx = np.array(list(map(lambda x: graph.ids[x], tails)))
-                mask[i][tail_idx] = 1
-                mask[i][graph.ids[t]] = 0
-            elif mode == 'head':
-                heads = self.true_heads[time][(r, t)]
-                head_idx = np.array(list(map(lambda x: graph.ids[x], heads)))
-                mask[i][head_idx] = 1
-                mask[i][graph.ids[h]] = 0
-            # pdb.set_trace()
-        return mask.byte()
+    mask_eval_set = EvaluationFilter.mask_eval_set
+    apply_eval_mask = staticmethod(EvaluationFilter.apply_eval_mask)
+    sort_and_rank = EvaluationFilter.sort_and_rank
 
     def combined_scores(self, local_score, temporal_score, labels, weight):
         score = weight * local_score + (1 - weight) * temporal_score
@@ -353,9 +306,3 @@ class Aggregator(TKG_Module):
             score = self.calc_score(neg_s, r, o, mode='head')
         return score
 
-    def sort_and_rank(self, score, target):
-        # pdb.set_trace()
-        _, indices = torch.sort(score, dim=1, descending=True)
-        indices = torch.nonzero(indices == target.view(-1, 1))
-        indices = indices[:, 1].view(-1)
-        return indices
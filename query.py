@@ -0,0 +1,45 @@
+from utils.query_engine import QueryEngine, answer_queries
+import argparse
+import sys
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='TKG link prediction queries')
+    parser.add_argument("store", type=str, help="directory written by export_embeddings.py")
+    parser.add_argument("queries", type=str, nargs='?', default='-', help="file of \"s r o t\" lines with ? for the entity to predict, - for stdin")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dataset", type=str, default=None, help="dataset directory of the store, enables --filtered")
+    parser.add_argument("--filtered", action='store_true', help="leave out entities known to complete a query at its time")
+    parser.add_argument("--score-function", type=str, default=None, help="defaults to the score function of the exported model")
+    parser.add_argument("--score-kernel", type=str, default='matmul', choices=['broadcast', 'matmul'])
+    parser.add_argument("--device", type=str, default='cpu')
+    parser.add_argument("--batch-size", type=int, default=1024, help="queries scored together per timestamp")
+    parser.add_argument("--chunk-size", type=int, default=100000, help="query lines read and answered at a time")
+    return parser.parse_args()
+
+
+def stream_answers(engine, query_file, out, chunk_size, k, filtered):
+    # each output line is the query followed by "entity:score" pairs, best first
+    chunk = []
+    for line in query_file:
+        if line.strip():
+            chunk.append(line)
+        if len(chunk) == chunk_size:
+            write_answers(engine, chunk, out, k, filtered)
+            chunk = []
+    if chunk:
+        write_answers(engine, chunk, out, k, filtered)
+
+
+def write_answers(engine, lines, out, k, filtered):
+    top_entities, top_scores = answer_queries(engine, lines, k, filtered)
+    for line, entities, scores in zip(lines, top_entities.tolist(), top_scores.tolist()):
+        out.write("\t".join(line.split()[:4] + ["{}:{:.4f}".format(e, s) for e, s in zip(entities, scores)]) + "\n")
+    out.flush()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    engine = QueryEngine(args.store, args.score_function, args.score_kernel, args.dataset, args.device, args.batch_size)
+    query_file = sys.stdin if args.queries == '-' else open(args.queries)
+    stream_answers(engine, query_file, sys.stdout, args.chunk_size, args.k, args.filtered)
@@ -1,5 +1,8 @@
 from utils.dataset import *
 from utils.args import process_args
+from utils.utils import get_node_ids
+from utils.timeline import get_batch_graph_list
+from utils.predictions import PredictionWriter, load_predictions
 from previous.TKG_VRE import TKG_VAE
 from baselines.Static import Static
 from baselines.Simple import SimplE
@@ -291,46 +294,21 @@ class MyTrainer(Trainer):
         return eval_results
 
 
-def get_batch_graph_list(t_list, seq_len, graph_dict):
-    times = list(graph_dict.keys())
-    # time_unit = times[1] - times[0]  # compute time unit
-    time_list = []
-
-    t_list = t_list.sort(descending=True)[0]
-    g_list = []
-    # s_lst = [t/15 for t in times]
-    # print(s_lst)
-    for tim in t_list:
-        # length = int(tim / time_unit) + 1
-        # cur_seq_len = seq_len if seq_len <= length else length
-        length = times.index(tim) + 1
-        time_seq = times[length - seq_len:length] if seq_len <= length else times[:length]
-        time_list.append(([None] * (seq_len - len(time_seq))) + time_seq)
-        g_list.append(([None] * (seq_len - len(time_seq))) + [graph_dict[t] for t in time_seq])
-    t_batched_list = [list(x) for x in zip(*time_list)]
-    g_batched_list = [list(x) for x in zip(*g_list)]
-    return g_batched_list, t_batched_list
-
-
-def get_predictions(batch_times, all_ranks, model):
-    predictions = []
+def write_predictions(writer, batch_times, all_ranks, model):
+    # appended batch by batch; per graph, the 's' queries (predicting s given (o, r)) come before the 'o' queries
     for t_list, ranks in zip(batch_times, all_ranks):
         g_batched_list, t_batched_list = get_batch_graph_list(t_list, 1, model.graph_dict_test)
-        batch_five_tuples = []
-        six_tuples = []
+        columns = []
         for g, t in zip(g_batched_list[-1], t_batched_list[-1]):
-            triples = torch.stack([g.edges()[0], g.edata['type_s'], g.edges()[1]]).transpose(0, 1).tolist()
-            # pdb.set_trace()
-            # 's' = 'head', predicting s given (o, r)
-            # 'o' = 'tail', predicting o given (s, r)
-            five_tup_s = [[g.ids[x[0]], x[1], g.ids[x[2]], t, 's'] for x in triples]
-            five_tup_o = [[g.ids[x[0]], x[1], g.ids[x[2]], t, 'o'] for x in triples]
-            batch_five_tuples.extend(five_tup_s)
-            batch_five_tuples.extend(five_tup_o)
-        for five_tup, rank in zip(batch_five_tuples, ranks.tolist()):
-            six_tuples.append(five_tup + [rank])
-        predictions.extend(six_tuples)
-    return predictions
+            node_ids = get_node_ids(g)
+            triples = torch.stack([node_ids[g.edges()[0]], g.edata['type_s'], node_ids[g.edges()[1]]]).transpose(0, 1).cpu().numpy()
+            triples = np.concatenate([triples, triples])
+            sub_query = np.arange(triples.shape[0]) < triples.shape[0] // 2
+            columns.append((triples, np.full(triples.shape[0], t), sub_query))
+        if len(columns) == 0:
+            continue
+        triples, times, sub_query = [np.concatenate(column) for column in zip(*columns)]
+        writer.append(triples[:, 0], triples[:, 1], triples[:, 2], times, sub_query, ranks.cpu().numpy())
 
 
 def inference():
@@ -346,7 +324,7 @@ def inference():
         checkpoint_path = glob.glob(os.path.join(experiment_path, "checkpoints", "*.ckpt"))[0]
         # checkpoint_path = experiment_path
         joined = "-".join(experiment_path.split('/')[1:])
-        prediction_file = os.path.join(experiment_path, joined + "-predictions.pk")
+        prediction_file = os.path.join(experiment_path, joined + "-predictions.cols")
         print(prediction_file)
         config_path = os.path.join(experiment_path, "config.json")
         args_json = json.load(open(config_path))
@@ -404,16 +382,14 @@ def inference():
         # model.test_seq_len = args.test_seq_len
         model.load_state_dict(checkpoint['state_dict'])
         model.on_load_checkpoint(checkpoint)
+    writer = PredictionWriter(prediction_file, meta={'checkpoint': args.checkpoint_path, 'module': args.module, 'dataset': args.dataset,
+                                                     'train_seq_len': args.train_seq_len, 'test_seq_len': args.test_seq_len})
+    # the ranks of every test batch are written out as soon as the batch is scored
+    model.rank_listener = lambda batch_time, ranks: write_predictions(writer, [batch_time], [ranks], model)
     trainer = MyTrainer(gpus=0 if not use_cuda else 1)
-    results = trainer.test(model)
-    all_ranks = results['all_ranks']
-    batch_times = results['batch_times']
-    predictions = get_predictions(batch_times, all_ranks, model)
-
-    with open(prediction_file, 'wb') as filehandle:
-        # store the data as binary data stream
-        pickle.dump(predictions, filehandle)
-    return predictions
+    trainer.test(model)
+    writer.close()
+    return load_predictions(prediction_file)
 
 
 if __name__ == '__main__':
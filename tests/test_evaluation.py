@@ -0,0 +1,32 @@
+from argparse import Namespace
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("dgl")
+pytest.importorskip("pytorch_lightning")
+from utils.evaluation import EvaluationFilter
+
+
+def sort_and_rank(score, target, rank_ties):
+    evaluater = EvaluationFilter.__new__(EvaluationFilter)
+    evaluater.args = Namespace(rank_ties=rank_ties)
+    return evaluater.sort_and_rank(score, target)
+
+
+def test_sort_and_rank_matches_sorting():
+    torch.manual_seed(0)
+    score = torch.randn(20, 50)
+    target = torch.randint(50, (20,))
+    # without ties every mode is the position of the target in the descending sort
+    _, indices = torch.sort(score, dim=1, descending=True)
+    expected = torch.nonzero(indices == target.view(-1, 1))[:, 1]
+    for rank_ties in ['optimistic', 'pessimistic', 'mean']:
+        assert torch.equal(sort_and_rank(score, target, rank_ties).long(), expected)
+
+
+def test_sort_and_rank_ties():
+    score = torch.tensor([[3., 1., 1., 1., 0.], [2., 2., 2., 2., 2.]])
+    target = torch.tensor([2, 0])
+    assert sort_and_rank(score, target, 'optimistic').tolist() == [1, 0]
+    assert sort_and_rank(score, target, 'pessimistic').tolist() == [3, 4]
+    assert sort_and_rank(score, target, 'mean').tolist() == [2., 2.]
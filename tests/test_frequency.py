@@ -0,0 +1,57 @@
+import numpy as np
+from utils.frequency import count_freq_per_time, WindowFrequency, TemporalCountIndex, prediction_frequencies
+
+KEY_TYPES = [('triple', (0, 1, 2)), ('ent_pair', (0, 2)), ('sub', (0,)), ('obj', (2,)), ('rel', (1,)),
+             ('sub_rel', (0, 1)), ('obj_rel', (2, 1))]
+NUM_ENTS, NUM_RELS, NUM_TIMES = 15, 4, 12
+
+
+def random_quadruples(rng, num_quadruples=400):
+    return np.stack([rng.randint(NUM_ENTS, size=num_quadruples), rng.randint(NUM_RELS, size=num_quadruples),
+                     rng.randint(NUM_ENTS, size=num_quadruples), rng.randint(NUM_TIMES, size=num_quadruples)], axis=1)
+
+
+def sizes_of(columns):
+    return [NUM_RELS if c == 1 else NUM_ENTS for c in columns]
+
+
+def window_of(target_time, seq_len, future, max_time):
+    upper = target_time if not future else min(max_time + 1, target_time + seq_len)
+    return [t for t in range(max(0, target_time - seq_len + 1), upper) if t != target_time]
+
+
+def test_window_frequency_matches_dict_loop():
+    rng = np.random.RandomState(0)
+    data = random_quadruples(rng)
+    tables = dict(zip([name for name, _ in KEY_TYPES], count_freq_per_time([tuple(quad) for quad in data.tolist()])))
+    max_time = NUM_TIMES - 1
+    for future in [False, True]:
+        for seq_len in [1, 3, 7]:
+            for name, columns in KEY_TYPES:
+                table = tables[name]
+                window_frequency = WindowFrequency(data, columns, sizes_of(columns), range(NUM_TIMES), seq_len, future, max_time)
+                for target_time in range(NUM_TIMES):
+                    # the aggregation loop of the analysis scripts over the keys at the target time
+                    expected = {}
+                    for key in table[target_time]:
+                        count = sum(table[t][key] for t in window_of(target_time, seq_len, future, max_time) if key in table[t])
+                        if count > 0:
+                            expected[key] = count
+                    assert dict(window_frequency[target_time]) == expected
+
+
+def test_temporal_count_index_matches_dict_loop():
+    rng = np.random.RandomState(1)
+    data = random_quadruples(rng)
+    tables = dict(zip([name for name, _ in KEY_TYPES], count_freq_per_time([tuple(quad) for quad in data.tolist()])))
+    count_index = TemporalCountIndex(data, NUM_ENTS, NUM_RELS)
+    queries = random_quadruples(rng, 100)
+    for seq_len, bidirectional in [(1, False), (4, False), (4, True), (None, False)]:
+        frequencies = prediction_frequencies(count_index, queries, seq_len, bidirectional, NUM_TIMES - 1)
+        for name, columns in KEY_TYPES:
+            for quad, frequency in zip(queries.tolist(), frequencies[name].tolist()):
+                key = tuple(quad[c] for c in columns) if len(columns) > 1 else quad[columns[0]]
+                target_time = quad[3]
+                # without seq_len the whole timeline counts, target time included
+                window = range(NUM_TIMES) if seq_len is None else window_of(target_time, seq_len, bidirectional, NUM_TIMES - 1)
+                assert frequency == sum(tables[name][t][key] for t in window if key in tables[name][t])
@@ -0,0 +1,51 @@
+import pickle
+import numpy as np
+from utils.predictions import PredictionWriter, load_predictions, group_ranks_by_keys
+
+
+def test_prediction_writer_round_trip(tmp_path):
+    rng = np.random.RandomState(0)
+    path = str(tmp_path / 'predictions')
+    writer = PredictionWriter(path, meta={'dataset': 'toy', 'seq_len': 3})
+    batches = []
+    for time in range(3):
+        sub, rel, obj = rng.randint(100, size=20), rng.randint(10, size=20), rng.randint(100, size=20)
+        sub_query, rank = rng.rand(20) < 0.5, rng.randint(1, 100, size=20).astype(np.float32)
+        # scalar columns are broadcast over the batch
+        writer.append(sub, rel, obj, time, sub_query, rank)
+        batches.append((sub, rel, obj, np.full(20, time), sub_query, rank))
+    writer.close()
+
+    predictions = load_predictions(path)
+    assert len(predictions) == 60
+    assert predictions.meta['dataset'] == 'toy' and predictions.meta['num_predictions'] == 60
+    sub, rel, obj, time, sub_query, rank = [np.concatenate(column) for column in zip(*batches)]
+    np.testing.assert_array_equal(predictions.quadruples, np.stack([sub, rel, obj, time], axis=1))
+    np.testing.assert_array_equal(predictions.sub_query, sub_query)
+    np.testing.assert_array_equal(predictions.rank, rank)
+    rows = list(predictions)
+    assert rows[0] == [sub[0], rel[0], obj[0], 0, 's' if sub_query[0] else 'o', rank[0]]
+
+    # a legacy pickled list of rows loads to the same columns
+    pickle_path = str(tmp_path / 'predictions.pk')
+    with open(pickle_path, 'wb') as f:
+        pickle.dump(rows, f)
+    legacy = load_predictions(pickle_path)
+    for name in ['sub', 'rel', 'obj', 'time', 'sub_query', 'rank']:
+        np.testing.assert_array_equal(getattr(legacy, name), getattr(predictions, name))
+
+
+def test_empty_prediction_dump(tmp_path):
+    path = str(tmp_path / 'predictions')
+    PredictionWriter(path).close()
+    predictions = load_predictions(path)
+    assert len(predictions) == 0 and predictions.quadruples.shape == (0, 4)
+
+
+def test_group_ranks_by_keys():
+    rng = np.random.RandomState(1)
+    rel, time, ranks = rng.randint(4, size=50), rng.randint(3, size=50), rng.rand(50)
+    expected = {}
+    for r, t, rank in zip(rel.tolist(), time.tolist(), ranks.tolist()):
+        expected.setdefault((r, t), []).append(rank)
+    assert dict(group_ranks_by_keys(ranks, rel, time)) == expected
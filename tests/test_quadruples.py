@@ -0,0 +1,53 @@
+import numpy as np
+from utils.quadruples import read_quadruples, load_quadruples
+
+
+def parse_lines(path):
+    # the line-by-line parser read_quadruples replaced
+    quadruples = []
+    with open(path, 'r') as fr:
+        for line in fr:
+            line_split = line.split()
+            quadruples.append([int(line_split[0]), int(line_split[1]), int(line_split[2]), int(line_split[3])])
+    return np.array(quadruples, dtype=np.int32).reshape(-1, 4)
+
+
+def write_quadruples(path, rows):
+    with open(path, 'w') as f:
+        for row in rows:
+            f.write('\t'.join(str(x) for x in row) + '\n')
+
+
+def test_read_quadruples_matches_line_parser(tmp_path):
+    rng = np.random.RandomState(0)
+    rows = np.stack([rng.randint(1000, size=300), rng.randint(50, size=300), rng.randint(1000, size=300),
+                     rng.randint(100, size=300) * 24], axis=1)
+    path = str(tmp_path / 'train.txt')
+    write_quadruples(path, rows)
+    parsed = read_quadruples(path)
+    assert parsed.dtype == np.int32
+    np.testing.assert_array_equal(parsed, parse_lines(path))
+
+    # extra columns after the time are ignored
+    path = str(tmp_path / 'valid.txt')
+    write_quadruples(path, np.concatenate([rows, rng.randint(5, size=(300, 1))], axis=1))
+    np.testing.assert_array_equal(read_quadruples(path), parse_lines(path))
+
+
+def test_read_quadruples_empty_file(tmp_path):
+    path = str(tmp_path / 'test.txt')
+    open(path, 'w').close()
+    assert read_quadruples(path).shape == (0, 4)
+
+
+def test_load_quadruples_sorted_by_time(tmp_path):
+    rng = np.random.RandomState(1)
+    rows = [np.stack([rng.randint(100, size=50), rng.randint(10, size=50), rng.randint(100, size=50),
+                      rng.randint(20, size=50)], axis=1) for _ in range(2)]
+    write_quadruples(str(tmp_path / 'train.txt'), rows[0])
+    write_quadruples(str(tmp_path / 'valid.txt'), rows[1])
+    quadruples, times = load_quadruples(str(tmp_path), 'train.txt', 'valid.txt')
+    expected = np.concatenate(rows)
+    # stable sort by time keeps the file order within a timestamp
+    np.testing.assert_array_equal(quadruples, expected[np.argsort(expected[:, 3], kind='stable')])
+    np.testing.assert_array_equal(times, np.unique(expected[:, 3]))
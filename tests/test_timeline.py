@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from utils.timeline import Timeline, get_timeline
+
+
+def sliced_windows(times, t_list, seq_len, backward=False):
+    # the list slicing the timeline windows replaced
+    windows = []
+    for tim in t_list:
+        if not backward:
+            length = times.index(tim) + 1
+            time_seq = times[length - seq_len:length] if seq_len <= length else times[:length]
+        else:
+            length = times.index(tim)
+            time_seq = times[length:length + seq_len] if seq_len <= len(times) - length else times[length:]
+            time_seq.reverse()
+        windows.append(([None] * (seq_len - len(time_seq))) + time_seq)
+    return [list(x) for x in zip(*windows)]
+
+
+@pytest.mark.parametrize("backward", [False, True])
+def test_windows_match_list_slicing(backward):
+    rng = np.random.RandomState(0)
+    times = sorted(rng.choice(200, size=30, replace=False).tolist())
+    graph_dict = {t: 'g{}'.format(t) for t in times}
+    timeline = get_timeline(graph_dict)
+    t_list = torch.tensor(rng.choice(times, size=12).tolist())
+    for seq_len in [1, 3, 10, 40]:
+        g_batched_list, t_batched_list = timeline.get_batch_windows(t_list, seq_len, graph_dict, backward)
+        sorted_times = t_list.sort(descending=not backward)[0].tolist()
+        expected = sliced_windows(times, sorted_times, seq_len, backward)
+        assert t_batched_list == expected
+        assert g_batched_list == [[graph_dict[t] if t is not None else None for t in step] for step in expected]
+
+
+def test_timeline_cache():
+    graph_dict = {t: None for t in range(0, 50, 5)}
+    timeline = get_timeline(graph_dict)
+    assert get_timeline(graph_dict) is timeline
+    assert list(timeline.positions([0, 25, 45])) == [0, 5, 9]
+    # a changed graph dict gets a new timeline
+    graph_dict[50] = None
+    assert len(get_timeline(graph_dict)) == 11
+    assert len(Timeline([])) == 0
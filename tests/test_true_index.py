@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+from utils.true_index import TrueIndex
+
+
+def random_triples(rng, num_triples=500, num_ents=30, num_rels=5):
+    return np.stack([rng.randint(num_ents, size=num_triples), rng.randint(num_rels, size=num_triples),
+                     rng.randint(num_ents, size=num_triples)], axis=1)
+
+
+def brute_force_tails(triples):
+    tails = {}
+    for s, r, o in triples:
+        tails.setdefault((s, r), set()).add(o)
+    return tails
+
+
+def test_lookup_matches_brute_force():
+    rng = np.random.RandomState(0)
+    triples = random_triples(rng)
+    true_head, true_tail = TrueIndex.build_head_and_tail(triples)
+    tails = brute_force_tails(triples)
+    heads = brute_force_tails(triples[:, [2, 1, 0]])
+    # unseen entities and relations past the indexed ones as well
+    entities, relations = rng.randint(35, size=200), rng.randint(7, size=200)
+    for index, expected in [(true_tail, tails), (true_head, heads)]:
+        ptr, values = index.lookup(entities, relations)
+        assert ptr.shape[0] == entities.shape[0] + 1
+        for i, (e, r) in enumerate(zip(entities, relations)):
+            assert list(values[ptr[i]: ptr[i + 1]]) == sorted(expected.get((e, r), ()))
+            assert list(index.get(e, r)) == sorted(expected.get((e, r), ()))
+
+
+def test_contains_matches_brute_force():
+    rng = np.random.RandomState(1)
+    triples = random_triples(rng)
+    _, true_tail = TrueIndex.build_head_and_tail(triples)
+    tails = brute_force_tails(triples)
+    entities, relations = rng.randint(35, size=100), rng.randint(7, size=100)
+    candidates = rng.randint(40, size=(100, 12))
+    expected = np.array([[c in tails.get((e, r), ()) for c in row] for e, r, row in zip(entities, relations, candidates)])
+    np.testing.assert_array_equal(true_tail.contains(entities, relations, candidates), expected)
+
+
+def test_empty_inputs():
+    rng = np.random.RandomState(2)
+    _, true_tail = TrueIndex.build_head_and_tail(random_triples(rng))
+    empty = np.zeros(0, dtype=np.int64)
+    ptr, values = true_tail.lookup(empty, empty)
+    assert list(ptr) == [0] and values.shape == (0,)
+    assert true_tail.contains(empty, empty, np.zeros((0, 5), dtype=np.int64)).shape == (0, 0)
+    assert true_tail.contains([0, 1], [0, 1], np.zeros((2, 0), dtype=np.int64)).shape == (2, 0)
+
+    _, empty_index = TrueIndex.build_head_and_tail(np.zeros((0, 3), dtype=np.int64))
+    ptr, values = empty_index.lookup([0, 1], [0, 1])
+    assert list(ptr) == [0, 0, 0] and values.shape == (0,)
+    assert not empty_index.contains([0, 1], [0, 1], [[0, 1], [2, 3]]).any()
@@ -1,20 +1,24 @@
-from utils.dataset import load_quadruples
-from utils.frequency import count_freq_per_time, calc_aggregated_statistics, temp_func
+from utils.dataset import load_quadruples, get_total_number
+from utils.frequency import WindowFrequency, encode_keys, lookup_counts
 import os
 from collections import defaultdict
 import numpy as np
 import torch
-from utils.utils import comp_deg_norm, node_norm_to_edge_norm
+from utils.utils import comp_deg_norm, node_norm_to_edge_norm, local_to_global
 import pdb
 from utils.args import process_args
 import time
 from utils.dataset import build_interpolation_graphs
+from utils.profiler import profiled
 
 class DropEdge():
     def __init__(self, args, graph_dict_train, graph_dict_val, graph_dict_test):
         self.args = args
         self.train_seq_len = self.args.train_seq_len
         self.train_data, self.train_times = load_quadruples(args.dataset, 'train.txt')
+        self.num_ents, num_rels = get_total_number(args.dataset, 'stat.txt')
+        # graphs may carry inverse relations
+        self.num_rels = 2 * num_rels
         self.future = "Bi" in args.module
         self.graph_dict_train = graph_dict_train
         self.graph_dict_val = graph_dict_val
@@ -28,115 +32,139 @@ class DropEdge():
         self.lambda_1 = self.args.lambda_1
         self.lambda_2 = self.args.lambda_2
         self.lambda_3 = self.args.lambda_3
+        # subgraphs sampled ahead of time by the loader workers, keyed by (cur_time, target_time)
+        self.prefetched = {}
         # self.drop_rate_cache = defaultdict(lambda: defaultdict(list))
         # self.pre_cal_drop_rate()
 
     def count_frequency(self):
-        self.triple_freq_per_time_step, self.ent_pair_freq_per_time_step, self.sub_freq_per_time_step, self.obj_freq_per_time_step, \
-            self.rel_freq_per_time_step, self.sub_rel_freq_per_time_step, self.obj_rel_freq_per_time_step = count_freq_per_time(self.train_data)
-
-        # self.triple_freq_per_time_step = defaultdict(lambda: defaultdict(int))
-        # self.ent_pair_freq_per_time_step = defaultdict(lambda: defaultdict(int))
-        # self.sub_freq_per_time_step = defaultdict(lambda: defaultdict(int))
-        # self.obj_freq_per_time_step = defaultdict(lambda: defaultdict(int))
-        # self.rel_freq_per_time_step = defaultdict(lambda: defaultdict(int))
-        # self.sub_rel_freq_per_time_step = defaultdict(lambda: defaultdict(int))
-        # self.obj_rel_freq_per_time_step = defaultdict(lambda: defaultdict(int))
-        #
-        # for quad in self.train_data:
-        #     sub, rel, obj, tim = tuple(quad)
-        #     self.triple_freq_per_time_step[tim][(sub, rel, obj)] += 1
-        #     self.ent_pair_freq_per_time_step[tim][(sub, obj)] += 1
-        #     self.sub_freq_per_time_step[tim][sub] += 1
-        #     self.obj_freq_per_time_step[tim][obj] += 1
-        #     self.rel_freq_per_time_step[tim][rel] += 1
-        #     self.sub_rel_freq_per_time_step[tim][(sub, rel)] += 1
-        #     self.obj_rel_freq_per_time_step[tim][(obj, rel)] += 1
-
-        self.triple_freq_per_time_step_agg = defaultdict(temp_func)
-        self.ent_pair_freq_per_time_step_agg = defaultdict(temp_func)
-        self.sub_freq_per_time_step_agg = defaultdict(temp_func)
-        self.obj_freq_per_time_step_agg = defaultdict(temp_func)
-        self.rel_freq_per_time_step_agg = defaultdict(temp_func)
-        self.sub_rel_freq_per_time_step_agg = defaultdict(temp_func)
-        self.obj_rel_freq_per_time_step_agg = defaultdict(temp_func)
+        # windowed statistics of each training target time, in the same (target, cur) windows as pre_cal_drop_rate
+        def window_frequency(columns, sizes):
+            return WindowFrequency(self.train_data, columns, sizes, self.train_times, self.train_seq_len, future=self.future, max_time=self.max_time_step)
 
-        for target_time in self.train_times:
-            triples = list(self.triple_freq_per_time_step[target_time].keys())
-            ent_pairs = list(self.ent_pair_freq_per_time_step[target_time].keys())
-            subs = list(self.sub_freq_per_time_step[target_time].keys())
-            objs = list(self.obj_freq_per_time_step[target_time].keys())
-            rels = list(self.rel_freq_per_time_step[target_time].keys())
-            sub_rels = list(self.sub_rel_freq_per_time_step[target_time].keys())
-            obj_rels = list(self.obj_rel_freq_per_time_step[target_time].keys())
-            upper = target_time if not self.future else min(self.max_time_step + 1, target_time + self.train_seq_len)
-            for cur_time in range(max(0, target_time - self.train_seq_len + 1), upper):
+        self.triple_freq_per_time_step_agg = window_frequency((0, 1, 2), (self.num_ents, self.num_rels, self.num_ents))
+        self.ent_pair_freq_per_time_step_agg = window_frequency((0, 2), (self.num_ents, self.num_ents))
+        self.sub_freq_per_time_step_agg = window_frequency((0,), (self.num_ents,))
+        self.obj_freq_per_time_step_agg = window_frequency((2,), (self.num_ents,))
+        self.rel_freq_per_time_step_agg = window_frequency((1,), (self.num_rels,))
+        self.sub_rel_freq_per_time_step_agg = window_frequency((0, 1), (self.num_ents, self.num_rels))
+        self.obj_rel_freq_per_time_step_agg = window_frequency((2, 1), (self.num_ents, self.num_rels))
 
-                if cur_time == target_time: continue
-                calc_aggregated_statistics(self.triple_freq_per_time_step_agg, triples, self.triple_freq_per_time_step, target_time, cur_time)
-                calc_aggregated_statistics(self.ent_pair_freq_per_time_step_agg, ent_pairs, self.ent_pair_freq_per_time_step, target_time, cur_time)
-                calc_aggregated_statistics(self.sub_freq_per_time_step_agg, subs, self.sub_freq_per_time_step, target_time, cur_time)
-                calc_aggregated_statistics(self.obj_freq_per_time_step_agg, objs, self.obj_freq_per_time_step, target_time, cur_time)
-                calc_aggregated_statistics(self.rel_freq_per_time_step_agg, rels, self.rel_freq_per_time_step, target_time, cur_time)
-                calc_aggregated_statistics(self.sub_rel_freq_per_time_step_agg, sub_rels, self.sub_rel_freq_per_time_step, target_time, cur_time)
-                calc_aggregated_statistics(self.obj_rel_freq_per_time_step_agg, obj_rels, self.obj_rel_freq_per_time_step, target_time, cur_time)
-
-    def calc_dropout_prob(self, t_src, rel, t_dst, cur_time, target_time):
-        target_triple_freq = self.triple_freq_per_time_step_agg[target_time]
-        target_ent_pair_freq = self.ent_pair_freq_per_time_step_agg[target_time]
-        target_sub_rel_freq = self.sub_rel_freq_per_time_step_agg[target_time]
-        target_obj_rel_freq = self.obj_rel_freq_per_time_step_agg[target_time]
-
-        target_triple_lst = list(target_triple_freq.keys())
-        target_ent_pair_lst = list(target_ent_pair_freq.keys())
-        target_sub_rel_lst = list(target_sub_rel_freq.keys())
-        target_obj_rel_lst = list(target_obj_rel_freq.keys())
-        drop_rate_lst = self.drop_rate_cache[target_time][cur_time]
-        for s, r, o in zip(t_src, rel, t_dst):
-            s = s.item(); r = r.item(); o = o.item()
-            if (s, r, o) in target_triple_lst:
-                rate = self.lower + self.diff * (1 - self.lambda_1 / (target_triple_freq[(s, r, o)] + self.lambda_1))
-            elif (s, o) in target_ent_pair_lst:
-                rate = self.lower + self.diff * (1 - self.lambda_2 / (target_ent_pair_freq[(s, o)] + self.lambda_2))
-            elif (s, r) in target_sub_rel_lst:
-                rate = self.lower + self.diff * (1 - self.lambda_3 / (target_sub_rel_freq[(s, r)] + self.lambda_3))
-            elif (o, r) in target_obj_rel_lst:
-                rate = self.lower + self.diff * (1 - self.lambda_3 / (target_obj_rel_freq[(o, r)] + self.lambda_3))
-            else:
-                rate = self.lower
-            drop_rate_lst.append(rate)
+    def get_target_freq_arrays(self, target_time):
+        # aggregated triple, entity pair, subject-relation and object-relation counts of target_time as sorted key arrays
+        return [freq.get_arrays(target_time) for freq in [self.triple_freq_per_time_step_agg, self.ent_pair_freq_per_time_step_agg,
+                                                           self.sub_rel_freq_per_time_step_agg, self.obj_rel_freq_per_time_step_agg]]
+
+    def get_ensemble_features(self, s, r, o, target_time):
+        """
+        windowed frequency features of a batch of triples in global ids
+        :return: (num_triples, 3) features of the subject queries (object, relation and object-relation frequencies)
+        and of the object queries (subject, relation and subject-relation frequencies)
+        """
+        s, r, o = s.cpu().numpy(), r.cpu().numpy(), o.cpu().numpy()
+        rel_freq = self.rel_freq_per_time_step_agg.lookup(target_time, r)
+        sub_features = np.stack([self.obj_freq_per_time_step_agg.lookup(target_time, o), rel_freq,
+                                 self.obj_rel_freq_per_time_step_agg.lookup(target_time, o, r)], axis=1)
+        obj_features = np.stack([self.sub_freq_per_time_step_agg.lookup(target_time, s), rel_freq,
+                                 self.sub_rel_freq_per_time_step_agg.lookup(target_time, s, r)], axis=1)
+        return torch.from_numpy(sub_features).float(), torch.from_numpy(obj_features).float()
+
+    def calc_dropout_prob(self, t_src, rel, t_dst, target_freq_arrays):
+        s, r, o = t_src.cpu().numpy(), rel.cpu().numpy(), t_dst.cpu().numpy()
+        queries = [(encode_keys([s, r, o], (self.num_ents, self.num_rels, self.num_ents)), self.lambda_1),
+                   (encode_keys([s, o], (self.num_ents, self.num_ents)), self.lambda_2),
+                   (encode_keys([s, r], (self.num_ents, self.num_rels)), self.lambda_3),
+                   (encode_keys([o, r], (self.num_ents, self.num_rels)), self.lambda_3)]
+        drop_rates = np.full(s.shape[0], self.lower)
+        # the first matching statistic in triple, entity pair, subject-relation, object-relation order decides the rate
+        for (query, lam), (keys, counts) in reversed(list(zip(queries, target_freq_arrays))):
+            freq, found = lookup_counts(keys, counts, query)
+            drop_rates = np.where(found, self.lower + self.diff * (1 - lam / (freq + lam)), drop_rates)
+        return torch.from_numpy(drop_rates.astype(np.float32))
+
+    def get_drop_rate_path(self):
+        return os.path.join(self.args.dataset, 'drop_rates_{}_{}_{}_{}_{}_{}{}.npz'.format(
+            self.lower, self.upper, self.lambda_1, self.lambda_2, self.lambda_3, self.train_seq_len, '_future' if self.future else ''))
+
+    def get_edge_counts(self):
+        # (time, number of edges) of every training snapshot; rates saved for other snapshots do not line up with their edges
+        graph_dict = self.graph_dict_train
+        times = sorted(graph_dict.keys())
+        if hasattr(graph_dict, 'number_of_edges'):
+            counts = [graph_dict.number_of_edges(t) for t in times]
+        else:
+            counts = [graph_dict[t].number_of_edges() for t in times]
+        return np.array([times, counts], dtype=np.int64).reshape(2, -1).T
+
+    def save_drop_rate(self, path):
+        pairs = [(target_time, cur_time) for target_time, rates in self.drop_rate_cache.items() for cur_time in rates]
+        drop_rates = [self.drop_rate_cache[target_time][cur_time].numpy() for target_time, cur_time in pairs]
+        offsets = np.cumsum([0] + [rates.shape[0] for rates in drop_rates])
+        np.savez(path, pairs=np.array(pairs, dtype=np.int64).reshape(-1, 2), offsets=offsets, edge_counts=self.get_edge_counts(),
+                 drop_rates=np.concatenate(drop_rates) if len(drop_rates) > 0 else np.zeros(0, dtype=np.float32))
+
+    def load_drop_rate(self, path):
+        """
+        :return: whether the saved rates were loaded; files from before edge counts were saved, or saved for
+        snapshots with other edge counts, are left to be rebuilt
+        """
+        data = np.load(path)
+        if 'edge_counts' not in data.files or not np.array_equal(data['edge_counts'], self.get_edge_counts()):
+            return False
+        drop_rates = torch.from_numpy(data['drop_rates'])
+        offsets = data['offsets']
+        for i, (target_time, cur_time) in enumerate(data['pairs'].tolist()):
+            self.drop_rate_cache[target_time][cur_time] = drop_rates[offsets[i]: offsets[i + 1]]
+        return True
 
     def pre_cal_drop_rate(self):
-        self.drop_rate_cache = defaultdict(lambda: defaultdict(list))
+        """
+        drop rate of every edge of the graphs in the window of each training target time, one flat tensor per
+        (target_time, cur_time) pair. Rates are cached next to the dataset for the current rate and lambda settings
+        and rebuilt when the edge counts of the training snapshots changed
+        """
+        self.drop_rate_cache = defaultdict(dict)
+        path = self.get_drop_rate_path()
+        if os.path.isfile(path) and self.load_drop_rate(path):
+            return
         for target_time in self.train_times:
+            target_freq_arrays = self.get_target_freq_arrays(target_time)
             upper = target_time if not self.future else min(self.max_time_step, target_time + self.train_seq_len)
             for cur_time in range(max(0, target_time - self.train_seq_len + 1), upper):
-                # pdb.set_trace()
                 if cur_time == target_time: continue
                 cur_g = self.graph_dict_train[cur_time]
                 src, rel, dst = cur_g.edges()[0], cur_g.edata['type_s'], cur_g.edges()[1]
-                t_src = torch.tensor([cur_g.ids[s.item()] for s in src])
-                t_dst = torch.tensor([cur_g.ids[d.item()] for d in dst])
-                self.calc_dropout_prob(t_src, rel, t_dst, cur_time, target_time)
+                t_src = local_to_global(cur_g, src)
+                t_dst = local_to_global(cur_g, dst)
+                self.drop_rate_cache[int(target_time)][cur_time] = self.calc_dropout_prob(t_src, rel, t_dst, target_freq_arrays)
+        self.save_drop_rate(path)
 
+    @profiled('edge_dropout')
     def sample_subgraph(self, cur_time, target_time):
         # sampled_graph_list = []
         # upper = target_time if not self.future else min(self.max_time_step, target_time + self.train_seq_len)
         # for cur_time in range(max(0, target_time - self.train_seq_len + 1), upper):
+        if (cur_time, target_time) in self.prefetched:
+            return self.prefetched.pop((cur_time, target_time))
+        return self.draw_subgraph(cur_time, target_time)
+
+    def draw_subgraph(self, cur_time, target_time):
         cur_g = self.graph_dict_train[cur_time]
         src, rel, dst = cur_g.edges()[0], cur_g.edata['type_s'], cur_g.edges()[1]
         drop_rates = self.drop_rate_cache[target_time][cur_time]
         # pdb.set_trace()
-        mask = torch.bernoulli(1 - torch.tensor(drop_rates)) == 1
+        mask = torch.bernoulli(1 - drop_rates) == 1
         sampled_idx = torch.arange(src.shape[0])[mask]
         sg = cur_g.edge_subgraph(sampled_idx, preserve_nodes=True)
         node_norm = comp_deg_norm(sg)
         sg.ndata.update({'id': cur_g.ndata['id'], 'norm': torch.from_numpy(node_norm).view(-1, 1)})
         sg.edata['norm'] = node_norm_to_edge_norm(sg, torch.from_numpy(node_norm).view(-1, 1))
         sg.edata['type_s'] = rel[sampled_idx]
-        sg.ids = cur_g.ids
         return sg
 
+    def sample_window_subgraphs(self, target_time):
+        return {(cur_time, target_time): self.draw_subgraph(cur_time, target_time) for cur_time in self.drop_rate_cache.get(target_time, {})}
+
 
 if __name__ == '__main__':
     args = process_args()
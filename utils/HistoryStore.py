@@ -0,0 +1,185 @@
+import torch
+
+
+class HistoryStore:
+    """
+    Sparse history of the latest per-sample entity embeddings used by the recurrent models.
+    Only the rows of the entities active at the latest step are kept; every other entity reads as zeros,
+    which matches the dense (bsz, num_layers, num_ents, embed_size) history that was rebuilt at every step.
+    """
+    def __init__(self, bsz, num_layers, num_ents, embed_size, like):
+        self.num_layers = num_layers
+        self.num_ents = num_ents
+        self.embed_size = embed_size
+        self.node_ids = [None] * bsz
+        self.embeds = [None] * bsz
+        # slot[i][e] is the row of entity e in embeds[i], or -1 if e was not active at the latest step of sample i
+        self.slot = like.new_full((bsz, num_ents), -1, dtype=torch.long)
+        self.start_time = like.new_zeros(bsz, num_ents)
+
+    def __len__(self):
+        return len(self.embeds)
+
+    def __getitem__(self, i):
+        return HistoryView(self, i)
+
+    def clear(self, i):
+        if self.node_ids[i] is not None:
+            self.slot[i][self.node_ids[i]] = -1
+        self.node_ids[i] = None
+        self.embeds[i] = None
+
+    def update(self, g_batched_list_t, cur_t, *per_layer_embeds):
+        """
+        replace the history of every sample with the embeddings of the entities active at cur_t
+        :param per_layer_embeds: one sequence of per-graph embeddings for each layer
+        """
+        for i in range(len(self.embeds)):
+            self.clear(i)
+            if i >= len(g_batched_list_t):
+                continue
+            idx = g_batched_list_t[i].ndata['id'].view(-1).to(self.slot.device)
+            self.slot[i][idx] = torch.arange(idx.shape[0], device=idx.device)
+            self.start_time[i][idx] = cur_t
+            self.node_ids[i] = idx
+            self.embeds[i] = [layer_embeds[i] for layer_embeds in per_layer_embeds]
+
+    def gather(self, i, layer, node_idx):
+        node_idx = node_idx.view(-1)
+        if self.embeds[i] is None:
+            return self.start_time.new_zeros(node_idx.shape[0], self.embed_size)
+        pos = self.slot[i][node_idx]
+        embeds = self.embeds[i][layer][pos.clamp(min=0)]
+        return embeds * (pos >= 0).unsqueeze(-1).to(embeds.dtype)
+
+    def dense(self, i, layer):
+        all_embeds = self.start_time.new_zeros(self.num_ents, self.embed_size)
+        if self.embeds[i] is None:
+            return all_embeds
+        return all_embeds.index_copy(0, self.node_ids[i], self.embeds[i][layer])
+
+    def layer(self, layer):
+        return HistoryLayer(self, layer)
+
+    def flip(self):
+        self.node_ids.reverse()
+        self.embeds.reverse()
+        self.slot = torch.flip(self.slot, [0])
+        self.start_time = torch.flip(self.start_time, [0])
+        return self
+
+
+class HistoryView:
+    # history of a single sample, hist[i][layer] gives the dense (num_ents, embed_size) embeddings
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+
+    def __getitem__(self, layer):
+        return self.store.dense(self.i, layer)
+
+
+class HistoryLayer:
+    # dense view over one layer of every sample, hist.layer(k)[i] == hist[i][k]
+    def __init__(self, store, layer):
+        self.store = store
+        self.layer = layer
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        return self.store.dense(i, self.layer)
+
+
+class WindowHistory:
+    """
+    Compact window history of the self-attention models. Only the entities active at some step of the window of a
+    sample are kept: entities[i] holds their ids, embeds[i] their (num_active, num_steps, num_layers, embed_size)
+    embeddings and mask[i] is 0 at the steps where an entity was active and -10e9 elsewhere.
+    Every other entity has an all -10e9 mask, so its attention reduces to its current embedding
+    """
+    def __init__(self, bsz, num_steps, num_ents, embed_size, like, num_layers=2):
+        self.num_steps = num_steps
+        self.num_ents = num_ents
+        self.embed_size = embed_size
+        self.num_layers = num_layers
+        self.like = like
+        # (step, node ids, per-layer embeddings) of every graph of a sample, compacted on first access
+        self.records = [[] for _ in range(bsz)]
+        self.slot = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def update(self, g_batched_list_t, cur_t, *per_layer_embeds):
+        for i in range(len(per_layer_embeds[0])):
+            idx = g_batched_list_t[i].ndata['id'].view(-1).to(self.like.device)
+            self.records[i].append((cur_t, idx, [layer_embeds[i] for layer_embeds in per_layer_embeds]))
+
+    def flip(self):
+        assert self.slot is None, "flip the history before reading from it"
+        self.records.reverse()
+        return self
+
+    @staticmethod
+    def cat(histories):
+        # one history whose steps are the steps of each of the histories in turn
+        first = histories[0]
+        joined = WindowHistory(len(first), sum(h.num_steps for h in histories), first.num_ents, first.embed_size, first.like, first.num_layers)
+        offset = 0
+        for history in histories:
+            for i, records in enumerate(history.records):
+                joined.records[i].extend((offset + step, idx, embeds) for step, idx, embeds in records)
+            offset += history.num_steps
+        return joined
+
+    def compact(self):
+        bsz = len(self.records)
+        self.slot = self.like.new_full((bsz, self.num_ents), -1, dtype=torch.long)
+        self.entities, self.embeds, self.mask = [], [], []
+        for i, records in enumerate(self.records):
+            entities = torch.unique(torch.cat([idx for _, idx, _ in records])) if len(records) > 0 else self.slot.new_zeros(0)
+            self.slot[i][entities] = torch.arange(entities.shape[0], device=entities.device)
+            embeds = self.like.new_zeros(entities.shape[0], self.num_steps, self.num_layers, self.embed_size)
+            mask = self.like.new_full((entities.shape[0], self.num_steps), -10e9)
+            for step, idx, layer_embeds in records:
+                pos = self.slot[i][idx]
+                mask[pos, step] = 0
+                for layer, layer_embed in enumerate(layer_embeds):
+                    embeds[pos, step, layer] = layer_embed
+            self.entities.append(entities)
+            self.embeds.append(embeds)
+            self.mask.append(mask)
+
+    def with_current_step(self, mask):
+        # the current step closes every window and is always attended to
+        return torch.cat([mask, mask.new_zeros(mask.shape[0], 1)], dim=1)
+
+    def active(self, i):
+        """
+        :return: the entities of sample i seen in the window, their per-layer (num_active, num_steps, embed_size)
+        embeddings and their (num_active, num_steps + 1) attention mask
+        """
+        if self.slot is None:
+            self.compact()
+        embeds = self.embeds[i]
+        return (self.entities[i],) + tuple(embeds[:, :, layer] for layer in range(self.num_layers)) + (self.with_current_step(self.mask[i]),)
+
+    def gather(self, i, node_idx):
+        # same as active, for the given entities of sample i; entities not seen in the window read as zeros
+        if self.slot is None:
+            self.compact()
+        pos = self.slot[i][node_idx.view(-1).to(self.slot.device)]
+        seen = (pos >= 0).unsqueeze(-1)
+        embeds = self.embeds[i][pos.clamp(min=0)] if self.embeds[i].shape[0] > 0 else self.like.new_zeros(pos.shape[0], self.num_steps, self.num_layers, self.embed_size)
+        embeds = embeds * seen.unsqueeze(-1).unsqueeze(-1).to(embeds.dtype)
+        mask = self.mask[i][pos.clamp(min=0)] if self.mask[i].shape[0] > 0 else self.like.new_full((pos.shape[0], self.num_steps), -10e9)
+        mask = torch.where(seen, mask, torch.full_like(mask, -10e9))
+        return tuple(embeds[:, :, layer] for layer in range(self.num_layers)) + (self.with_current_step(mask),)
+
+    def dense(self, i, layer):
+        # (num_ents, num_steps, embed_size) embeddings of one layer of sample i
+        active = self.active(i)
+        entities, embeds = active[0], active[1 + layer]
+        return embeds.new_zeros(self.num_ents, self.num_steps, self.embed_size).index_copy(0, entities, embeds)
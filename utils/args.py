@@ -7,6 +7,7 @@ def get_args():
     parser.add_argument("--dataset-dir", type=str, default='interpolation')
     parser.add_argument("-d", "--dataset", type=str, default='icews14')
     parser.add_argument("--score-function", type=str, default='complex')
+    parser.add_argument("--score-kernel", type=str, default='broadcast', choices=['broadcast', 'matmul'], help="matmul scores 1-vs-all queries as matrix products, transE in chunks")
     parser.add_argument("--module", type=str, default='GRRGCN')
     parser.add_argument("--n-gpu", type=int, default=0)
     parser.add_argument("--distributed_backend", type=str, default='ddp')
@@ -29,6 +30,7 @@ def get_args():
     parser.add_argument("--patience", type=int, default=10)
     parser.add_argument("--n-bases", type=int, default=128, help="number of weight blocks for each relation")
     parser.add_argument("--rgcn-layers", type=int, default=2, help="number of propagation rounds")
+    parser.add_argument("--rgcn-engine", type=str, default='bmm', choices=['bmm', 'grouped'], help="per-edge weight bmm or relation-grouped message passing")
     parser.add_argument("--train-seq-len", type=int, default=15)
     parser.add_argument("--test-seq-len", type=int, default=30)
     parser.add_argument("--batch-size", type=int, default=8)
@@ -54,6 +56,17 @@ def get_args():
     parser.add_argument("--vote", type=str, default='recency')
     parser.add_argument("--future", action='store_true')
     parser.add_argument("--filtered", action='store_true')
+    parser.add_argument("--eval-memory-budget", type=int, default=512, help="MB of scoring temporaries per evaluation chunk")
+    parser.add_argument("--metric-breakdowns", type=str, default='', help="comma separated evaluation breakdowns out of time, relation and mode")
+    parser.add_argument("--keep-ranks", action='store_true', help="keep the ranks of every test batch in the test results")
+    parser.add_argument("--profile", action='store_true', help="time the training and evaluation stages and log a summary per epoch")
+    parser.add_argument("--profile-trace", type=str, default=None, help="json lines file the stage summaries are appended to, implies --profile")
+    parser.add_argument("--memory-diagnostics", action='store_true', help="report memory growth after every preprocessing phase, the largest structures of the model and training step peaks")
+    parser.add_argument("--memory-report", type=str, default=None, help="json lines file the memory records are appended to, implies --memory-diagnostics")
+    parser.add_argument("--memory-sample-every", type=int, default=50, help="training steps between memory peak samples")
+    parser.add_argument("--num-workers", type=int, default=0, help="loader processes preparing training batches ahead, 0 to prepare them in forward")
+    parser.add_argument("--prefetch-batches", type=int, default=2, help="training batches prepared ahead per loader process")
+    parser.add_argument("--rank-ties", type=str, default='optimistic', choices=['optimistic', 'pessimistic', 'mean'], help="rank of a target tied with other entities")
     parser.add_argument("--all", action='store_true')
     parser.add_argument("--resume", action='store_true')
     parser.add_argument("--model-name", type=str, default=None)
@@ -61,6 +74,7 @@ def get_args():
 
     parser.add_argument('--config', '-c', type=str, default=None, help='JSON file with argument for the run.')
     parser.add_argument("--checkpoint-path", type=str, default=None)
+    parser.add_argument("--export-path", type=str, default=None, help="directory of the exported embedding store, <checkpoint-path>/embeddings by default")
 
     parser.add_argument("--spatial-checkpoint", type=str, default=None)
     parser.add_argument("--temporal-checkpoint", type=str, default=None)
@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import glob
 import pickle
 import dgl
 from torch.utils.data import Dataset
@@ -7,57 +8,11 @@ import torch
 from utils.args import process_args
 from utils.utils import node_norm_to_edge_norm, comp_deg_norm
 from collections import defaultdict
+from collections.abc import Mapping
+from utils.memory import memory_tracker
+from utils.quadruples import read_quadruples, QuadrupleSet, load_quadruple_set, load_quadruples, get_total_number
 
-
-def load_quadruples(dataset_path, fileName, fileName2=None, fileName3=None):
-    with open(os.path.join(dataset_path, fileName), 'r') as fr:
-        quadrupleList = []
-        times = set()
-        for line in fr:
-            line_split = line.split()
-            head = int(line_split[0])
-            tail = int(line_split[2])
-            rel = int(line_split[1])
-            time = int(line_split[3])
-            quadrupleList.append([head, rel, tail, time])
-            times.add(time)
-
-    if fileName2 is not None:
-        with open(os.path.join(dataset_path, fileName2), 'r') as fr:
-            for line in fr:
-                line_split = line.split()
-                head = int(line_split[0])
-                tail = int(line_split[2])
-                rel = int(line_split[1])
-                time = int(line_split[3])
-                quadrupleList.append([head, rel, tail, time])
-                times.add(time)
-
-    if fileName3 is not None:
-        with open(os.path.join(dataset_path, fileName3), 'r') as fr:
-            for line in fr:
-                line_split = line.split()
-                head = int(line_split[0])
-                tail = int(line_split[2])
-                rel = int(line_split[1])
-                time = int(line_split[3])
-                quadrupleList.append([head, rel, tail, time])
-                times.add(time)
-    times = list(times)
-    times.sort()
-    return np.asarray(quadrupleList), np.asarray(times)
-
-
-def get_data_with_t(data, tim):
-    triples = [[quad[0], quad[1], quad[2]] for quad in data if quad[3] == tim]
-    return np.array(triples)
-
-
-def get_total_number(dataset_path, fileName="stat.txt"):
-    with open(os.path.join(dataset_path, fileName), 'r') as fr:
-        for line in fr:
-            line_split = line.split()
-            return int(line_split[0]), int(line_split[1])
+GRAPH_STORE_NAMES = ['train_graphs', 'dev_graphs', 'test_graphs']
 
 
 def get_big_graph(data, num_rels):
@@ -83,12 +38,6 @@ def get_big_graph(data, num_rels):
         g.ndata.update({'id': torch.from_numpy(uniq_v).long().view(-1, 1), 'norm': torch.from_numpy(norm).view(-1, 1)})
         g.edata['type_s'] = torch.LongTensor(rel_s)
         g.edata['type_o'] = torch.LongTensor(rel_o)
-        g.ids = {}
-        in_graph_idx = 0
-        # graph.ids: node id in the entire node set -> node index
-        for id in uniq_v:
-            g.ids[in_graph_idx] = id
-            in_graph_idx += 1
     else:
         src, rel, dst = data.transpose() # node ids
         # uniq_v: range from 0 to the number of nodes acting as g.nodes();
@@ -102,50 +51,149 @@ def get_big_graph(data, num_rels):
         norm = comp_deg_norm(g)
         g.ndata.update({'id': torch.from_numpy(uniq_v).long().view(-1, 1), 'norm': torch.from_numpy(norm).view(-1, 1)})
         g.edata['type_s'] = torch.LongTensor(rel)
-        g.ids = {}
-        in_graph_idx = 0
-        for id in uniq_v:
-            g.ids[in_graph_idx] = id
-            in_graph_idx += 1
     return g
 
 
 def build_extrapolation_time_stamp_graph(args):
-    train_graph_dict_path = os.path.join(args.dataset, 'train_graphs.txt')
-    dev_graph_dict_path = os.path.join(args.dataset, 'dev_graphs.txt')
-    test_graph_dict_path = os.path.join(args.dataset, 'test_graphs.txt')
-
-    graph_dict_train = {}
-    graph_dict_dev = {}
-    graph_dict_test = {}
-    if not os.path.isfile(train_graph_dict_path) or not os.path.isfile(dev_graph_dict_path) or not os.path.isfile(test_graph_dict_path):
-        train_data, train_times = load_quadruples(args.dataset, 'train.txt')
-        test_data, test_times = load_quadruples(args.dataset, 'test.txt')
+    def build_graph_dicts():
+        train_set = load_quadruple_set(args.dataset, 'train.txt')
+        test_set = load_quadruple_set(args.dataset, 'test.txt')
         if args.dataset == 'extrapolation/icews14':
-            dev_data, dev_times = load_quadruples(args.dataset, 'test.txt')
+            dev_set = load_quadruple_set(args.dataset, 'test.txt')
         else:
-            dev_data, dev_times = load_quadruples(args.dataset, 'valid.txt')
+            dev_set = load_quadruple_set(args.dataset, 'valid.txt')
         num_e, num_r = get_total_number(args.dataset, 'stat.txt')
+        memory_tracker.checkpoint('quadruples')
 
-        for times, datas, path, graph_dict in zip([
-            train_times, dev_times, test_times],
-                [train_data, dev_data, test_data],
-                [train_graph_dict_path, dev_graph_dict_path, test_graph_dict_path],
-                [graph_dict_train, graph_dict_dev, graph_dict_test]
-        ):
-            for tim in times:
-                print(str(tim) + '\t' + str(max(times)))
-                data = get_data_with_t(datas, tim)
+        graph_dicts = []
+        for quadruple_set in train_set, dev_set, test_set:
+            graph_dict = {}
+            for tim in quadruple_set.times:
+                print(str(tim) + '\t' + str(quadruple_set.times[-1]))
+                data = quadruple_set.get_triples(tim).astype(np.int64)
                 graph_dict[tim] = get_big_graph(data, num_r)
-            with open(path, 'wb') as fp:
-                pickle.dump(graph_dict, fp)
-    else:
+            graph_dicts.append(graph_dict)
+        return graph_dicts
+
+    return load_graph_dicts(args.dataset, build_graph_dicts)
+
+
+def stack_graph_field(tensors, sizes):
+    arrays = [x.cpu().numpy() for x in tensors]
+    # graphs without nodes / edges may carry a field of shape (0,), so take the feature shape from non-empty ones
+    feature_shape = max([a.shape[1:] for a in arrays if a.shape[0] > 0], key=len, default=())
+    return np.concatenate([a.reshape((n,) + feature_shape) for a, n in zip(arrays, sizes)])
+
+
+def save_graph_dict(graph_dict, path):
+    """
+    flatten a time -> snapshot graph dict into one .npy file per field, with per-timestamp node / edge offsets
+    """
+    os.makedirs(path, exist_ok=True)
+    times = sorted(graph_dict.keys())
+    graphs = [graph_dict[t] for t in times]
+    num_nodes = [g.number_of_nodes() for g in graphs]
+    num_edges = [g.number_of_edges() for g in graphs]
+    edges = [g.all_edges(order='eid') for g in graphs]
+
+    arrays = {
+        'node_offsets': np.cumsum([0] + num_nodes),
+        'edge_offsets': np.cumsum([0] + num_edges),
+        'src': stack_graph_field([e[0] for e in edges], num_edges),
+        'dst': stack_graph_field([e[1] for e in edges], num_edges),
+    }
+    for key in graphs[0].ndata.keys():
+        arrays['ndata_' + key] = stack_graph_field([g.ndata[key] for g in graphs], num_nodes)
+    for key in graphs[0].edata.keys():
+        arrays['edata_' + key] = stack_graph_field([g.edata[key] for g in graphs], num_edges)
+    # times.npy is written last and marks the store as complete
+    arrays['times'] = np.array(times)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), array)
+
+
+class GraphSnapshotDict(Mapping):
+    """
+    read-only time -> DGLGraph mapping over a store written by save_graph_dict.
+    The arrays are memory-mapped and each snapshot graph is built on first access; get_global_triples reads the
+    facts of a snapshot straight from the arrays, so indexing the store builds no graphs
+    """
+    def __init__(self, path):
+        self.path = path
+        self.times = np.load(os.path.join(path, 'times.npy')).tolist()
+        self.position = {t: i for i, t in enumerate(self.times)}
+        self.arrays = {}
+        for file in glob.glob(os.path.join(path, '*.npy')):
+            name = os.path.basename(file)[:-len('.npy')]
+            if name != 'times':
+                self.arrays[name] = np.load(file, mmap_mode='r')
+        self.graphs = {}
+
+    def __getitem__(self, t):
+        if t not in self.graphs:
+            self.graphs[t] = self.build_graph(self.position[t])
+        return self.graphs[t]
+
+    def __iter__(self):
+        return iter(self.times)
+
+    def __len__(self):
+        return len(self.times)
+
+    def build_graph(self, i):
+        node_start, node_end = self.arrays['node_offsets'][i: i + 2]
+        edge_start, edge_end = self.arrays['edge_offsets'][i: i + 2]
+        g = dgl.DGLGraph()
+        g.add_nodes(int(node_end - node_start))
+        g.add_edges(np.array(self.arrays['src'][edge_start: edge_end]), np.array(self.arrays['dst'][edge_start: edge_end]))
+        for name, array in self.arrays.items():
+            if name.startswith('ndata_'):
+                g.ndata[name[len('ndata_'):]] = torch.from_numpy(np.array(array[node_start: node_end]))
+            elif name.startswith('edata_'):
+                g.edata[name[len('edata_'):]] = torch.from_numpy(np.array(array[edge_start: edge_end]))
+        return g
+
+    def number_of_edges(self, t):
+        i = self.position[t]
+        return int(self.arrays['edge_offsets'][i + 1] - self.arrays['edge_offsets'][i])
+
+    def get_global_triples(self, t):
+        # (s, r, o) rows of the snapshot at t in global entity ids
+        i = self.position[t]
+        node_start, node_end = self.arrays['node_offsets'][i: i + 2]
+        edge_start, edge_end = self.arrays['edge_offsets'][i: i + 2]
+        node_ids = np.asarray(self.arrays['ndata_id'][node_start: node_end]).reshape(-1)
+        src, dst = self.arrays['src'][edge_start: edge_end], self.arrays['dst'][edge_start: edge_end]
+        rel = np.asarray(self.arrays['edata_type_s'][edge_start: edge_end]).reshape(-1)
+        return np.stack([node_ids[src], rel, node_ids[dst]], axis=1).astype(np.int64)
+
+
+def load_graph_dicts(dataset_path, build_graph_dicts):
+    """
+    snapshot graphs are cached as memory-mapped arrays under <dataset>/{train,dev,test}_graphs/;
+    pickled train_graphs.txt / dev_graphs.txt / test_graphs.txt caches from older runs are converted once
+    """
+    store_paths = [os.path.join(dataset_path, name) for name in GRAPH_STORE_NAMES]
+    if all(os.path.isfile(os.path.join(path, 'times.npy')) for path in store_paths):
+        # the stores hold the facts of every snapshot, so opening them is the quadruple loading phase of a cached run
+        graph_dicts = tuple(GraphSnapshotDict(path) for path in store_paths)
+        memory_tracker.checkpoint('quadruples')
+        return graph_dicts
+
+    pickle_paths = [path + '.txt' for path in store_paths]
+    if all(os.path.isfile(path) for path in pickle_paths):
+        # the pickled graphs are loaded whole, no quadruples are read before them
+        memory_tracker.checkpoint('quadruples')
         graph_dicts = []
-        for path in train_graph_dict_path, dev_graph_dict_path, test_graph_dict_path:
+        for path in pickle_paths:
             with open(path, 'rb') as f:
                 graph_dicts.append(pickle.load(f))
-        graph_dict_train, graph_dict_dev, graph_dict_test = graph_dicts
-    return graph_dict_train, graph_dict_dev, graph_dict_test
+    else:
+        graph_dicts = build_graph_dicts()
+
+    for graph_dict, path in zip(graph_dicts, store_paths):
+        save_graph_dict(graph_dict, path)
+    return tuple(graph_dicts)
 
 
 def get_train_val_test_graph_at_t(triples, num_rels):
@@ -196,11 +244,6 @@ def get_train_val_test_graph_at_t(triples, num_rels):
         g_train.ndata.update({'id': torch.from_numpy(uniq_v).long().view(-1, 1), 'norm': norm.view(-1, 1)})
         g_train.edata['type_s'] = torch.LongTensor(rel_s)
         g_train.edata['type_o'] = torch.LongTensor(rel_o)
-        g_train.ids = {}
-        in_graph_idx = 0
-        for id in uniq_v:
-            g_train.ids[id] = in_graph_idx
-            in_graph_idx += 1
 
         g_list, src_list, rel_list, dst_list = [g_test, g_val], [src_test, src_val], [rel_test, rel_val], [dst_test, dst_val]
     else:
@@ -223,31 +266,15 @@ def get_train_val_test_graph_at_t(triples, num_rels):
         # import pdb; pdb.set_trace()
         graph.edata['norm'] = node_norm_to_edge_norm(graph, torch.from_numpy(node_norm).view(-1, 1))
         graph.edata['type_s'] = torch.LongTensor(cur_rel)
-        graph.ids = {}
-        in_graph_idx = 0
-        # graph.ids: node id in the entire node set -> node index
-        for id in uniq_v:
-            graph.ids[in_graph_idx] = id
-            in_graph_idx += 1
     return g_train, g_val, g_test
 
 
 def load_quadruples_interpolation(dataset_path, train_fname, valid_fname, test_fname, total_times):
     time2triples = {}
-
+    quadruple_sets = [load_quadruple_set(dataset_path, fname) for fname in [train_fname, valid_fname, test_fname]]
     for tim in total_times:
-        time2triples[tim] = {"train": [], "valid": [], "test": []}
-
-    for fname, mode in zip([train_fname, valid_fname, test_fname], ["train", "valid", "test"]):
-        with open(os.path.join(dataset_path, fname), 'r') as fr:
-            for line in fr:
-                line_split = line.split()
-                head = int(line_split[0])
-                rel = int(line_split[1])
-                tail = int(line_split[2])
-                time = int(line_split[3])
-                time2triples[time][mode].append((head, rel, tail))
-
+        time2triples[tim] = {mode: quadruple_set.get_triples(tim).astype(np.int64)
+                             for quadruple_set, mode in zip(quadruple_sets, ["train", "valid", "test"])}
     return time2triples
 
 
@@ -266,15 +293,11 @@ def get_per_entity_time_sequence(time2triples):
 
 
 def build_interpolation_graphs(args):
-    train_graph_dict_path = os.path.join(args.dataset, 'train_graphs.txt')
-    dev_graph_dict_path = os.path.join(args.dataset, 'dev_graphs.txt')
-    test_graph_dict_path = os.path.join(args.dataset, 'test_graphs.txt')
-    # time_sequence = os.path.join(args.dataset, 'interaction_time_sequence.txt')
-    if not os.path.isfile(train_graph_dict_path) or not os.path.isfile(dev_graph_dict_path) or not os.path.isfile(test_graph_dict_path):
-
+    def build_graph_dicts():
         total_data, total_times = load_quadruples(args.dataset, 'train.txt', 'valid.txt', 'test.txt')
         time2triples = load_quadruples_interpolation(args.dataset, 'train.txt', 'valid.txt', 'test.txt', total_times)
         num_e, num_r = get_total_number(args.dataset, 'stat.txt')
+        memory_tracker.checkpoint('quadruples')
 
         # interaction_time_sequence = get_per_entity_time_sequence(time2triples)
 
@@ -287,22 +310,9 @@ def build_interpolation_graphs(args):
             graph_dict_train[tim] = g_train
             graph_dict_dev[tim] = g_val
             graph_dict_test[tim] = g_test
+        return graph_dict_train, graph_dict_dev, graph_dict_test
 
-        for graph_dict, path in zip(
-            [graph_dict_train, graph_dict_dev, graph_dict_test],
-            [train_graph_dict_path, dev_graph_dict_path, test_graph_dict_path]
-        ):
-            with open(path, 'wb') as fp:
-                pickle.dump(graph_dict, fp)
-
-    else:
-        graph_dicts = []
-        for path in train_graph_dict_path, dev_graph_dict_path, test_graph_dict_path:
-            with open(path, 'rb') as f:
-                graph_dicts.append(pickle.load(f))
-        graph_dict_train, graph_dict_dev, graph_dict_test = graph_dicts
-
-    return graph_dict_train, graph_dict_dev, graph_dict_test
+    return load_graph_dicts(args.dataset, build_graph_dicts)
 
 
 def id2entrel(dataset_path, num_rels):
@@ -334,6 +344,18 @@ class TimeDataset(Dataset):
         return len(self.times)
 
 
+class TrainBatch:
+    # time batch together with the training payload prepared for it by a loader worker
+    def __init__(self, times, payload):
+        self.times = times
+        self.payload = payload
+
+
+def seed_loader_worker(worker_id):
+    # forked workers inherit the numpy state of the main process, so give each one the seed torch picked for it
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
 if __name__ == '__main__':
     args = process_args()
     build_interpolation_graphs(args)
\ No newline at end of file
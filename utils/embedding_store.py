@@ -0,0 +1,68 @@
+import json
+import os
+import numpy as np
+
+ENTITY_FILE = 'entities.npy'
+RELATION_FILE = 'relations.npy'
+TIME_FILE = 'times.npy'
+META_FILE = 'meta.json'
+
+
+class EmbeddingStoreWriter:
+    """
+    Writes the entity embeddings of every timestamp into a memory-mapped (num_times, num_ents, embed_size) array,
+    with the timestamps, the relation embeddings and a json description of the model next to it
+    """
+    def __init__(self, path, times, num_ents, embed_size, dtype=np.float32):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.times = np.asarray(times, dtype=np.int64)
+        self.position = {t: i for i, t in enumerate(self.times.tolist())}
+        self.written = np.zeros(self.times.shape[0], dtype=bool)
+        self.entities = np.lib.format.open_memmap(os.path.join(path, ENTITY_FILE), mode='w+', dtype=dtype,
+                                                  shape=(self.times.shape[0], num_ents, embed_size))
+        np.save(os.path.join(path, TIME_FILE), self.times)
+
+    def write(self, t, embeds):
+        pos = self.position[int(t)]
+        self.entities[pos] = embeds
+        self.written[pos] = True
+
+    def close(self, relation_embeds, meta=None):
+        assert self.written.all(), "missing embeddings for times {}".format(self.times[~self.written].tolist())
+        self.entities.flush()
+        np.save(os.path.join(self.path, RELATION_FILE), np.asarray(relation_embeds, dtype=self.entities.dtype))
+        meta = dict(meta or {})
+        meta.update({'num_times': int(self.times.shape[0]), 'num_ents': int(self.entities.shape[1]), 'embed_size': int(self.entities.shape[2])})
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+        del self.entities
+
+
+class EmbeddingStore:
+    """
+    Read-only view of an exported store; needs neither the model nor the graphs.
+    store[t] is the (num_ents, embed_size) embedding matrix of timestamp t, read lazily from the memory map
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entities = np.load(os.path.join(path, ENTITY_FILE), mmap_mode='r')
+        self.relations = np.load(os.path.join(path, RELATION_FILE))
+        self.times = np.load(os.path.join(path, TIME_FILE))
+        self.position = {t: i for i, t in enumerate(self.times.tolist())}
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return self.times.shape[0]
+
+    def __contains__(self, t):
+        return int(t) in self.position
+
+    def __getitem__(self, t):
+        return self.entities[self.position[int(t)]]
+
+    def get_batch(self, times, entities=None):
+        # (len(times), num_ents or len(entities), embed_size) embeddings, copied out of the memory map
+        rows = self.entities[[self.position[int(t)] for t in times]]
+        return rows if entities is None else rows[:, np.asarray(entities)]
@@ -1,7 +1,9 @@
 import torch
-from utils.CorrptTriples import CorruptTriples
-from utils.utils import cuda
+from utils.true_index import get_true_head_and_tail_per_time
+from utils.utils import cuda, get_node_ids, local_to_global
 import numpy as np
+from collections import ChainMap
+from utils.profiler import profiler, profiled
 
 class EvaluationFilter:
     def __init__(self, args, calc_score, graph_dict_train, graph_dict_val, graph_dict_test):
@@ -10,26 +12,16 @@ class EvaluationFilter:
         self.graph_dict_train = graph_dict_train
         self.graph_dict_val = graph_dict_val
         self.graph_dict_test = graph_dict_test
-        self.graph_dict_total = {**self.graph_dict_train, **self.graph_dict_val, **self.graph_dict_test}
+        self.graph_dict_total = ChainMap(self.graph_dict_test, self.graph_dict_val, self.graph_dict_train)
+        self.last_query_keys = None
         self.get_true_head_and_tail_all()
 
     def get_true_head_and_tail_all(self):
-        self.true_heads = dict()
-        self.true_tails = dict()
-        times = list(self.graph_dict_total.keys())
-        for t in times:
-            if self.args.dataset_dir == 'extrapolation':
-                g = self.graph_dict_total[t]
-                triples = torch.stack([g.edges()[0], g.edata['type_s'], g.edges()[1]]).transpose(0, 1)
-            else:
-                triples = []
-                for g in self.graph_dict_train[t], self.graph_dict_val[t], self.graph_dict_test[t]:
-                    triples.append(torch.stack([g.edges()[0], g.edata['type_s'], g.edges()[1]]).transpose(0, 1))
-                triples = torch.cat(triples, dim=0)
-            # pdb.set_trace()
-            true_head, true_tail = CorruptTriples.get_true_head_and_tail_per_graph(triples)
-            self.true_heads[t] = true_head
-            self.true_tails[t] = true_tail
+        # the filter index is keyed by global entity ids so that masks can be scattered directly into score rows
+        if self.args.dataset_dir == 'extrapolation':
+            self.true_heads, self.true_tails = get_true_head_and_tail_per_time(self.graph_dict_total)
+        else:
+            self.true_heads, self.true_tails = get_true_head_and_tail_per_time(self.graph_dict_train, self.graph_dict_val, self.graph_dict_test)
 
     def calc_metrics_single_graph(self, ent_mean, rel_enc_means, all_ent_embeds, samples, graph, time, eval_bz=100):
         with torch.no_grad():
@@ -47,13 +39,93 @@ class EvaluationFilter:
             ranks_s = self.perturb_and_get_rank(ent_mean, rel_enc_means, all_ent_embeds, s, r, o, test_size, s_mask, graph, eval_bz, mode='head')
             ranks = torch.cat([ranks_s, ranks_o])
             ranks += 1 # change to 1-indexed
+            self.record_query_keys([samples], [time])
             # print("Graph {} mean ranks {}".format(time.item(), ranks.float().mean().item()))
         return ranks
 
+    def calc_metrics_batched(self, ent_means, rel_enc_means, all_ent_embeds, samples, graphs, times):
+        """
+        rank the queries of several graphs together: queries are concatenated graph by graph and every graph's run
+        is scored against that graph's entity embeddings in chunks sized by args.eval_memory_budget. Ranks keep the
+        order of calc_metrics_single_graph over the graphs, so the ranks of each graph are the consecutive
+        2 * len(samples[i]) entries
+        """
+        with torch.no_grad():
+            num_queries = [sample.shape[0] for sample in samples]
+            num_ent = all_ent_embeds[0].shape[0]
+            r = torch.cat([sample[:, 1] for sample in samples])
+            o_mask = self.merge_eval_masks([self.mask_eval_set(sample, sample.shape[0], num_ent, time, graph, mode="tail")
+                                            for sample, graph, time in zip(samples, graphs, times)], num_queries)
+            s_mask = self.merge_eval_masks([self.mask_eval_set(sample, sample.shape[0], num_ent, time, graph, mode="head")
+                                            for sample, graph, time in zip(samples, graphs, times)], num_queries)
+            s = torch.cat([ent_mean[sample[:, 0]] for ent_mean, sample in zip(ent_means, samples)])
+            o = torch.cat([ent_mean[sample[:, 2]] for ent_mean, sample in zip(ent_means, samples)])
+            s_target = torch.cat([local_to_global(graph, sample[:, 0]) for graph, sample in zip(graphs, samples)])
+            o_target = torch.cat([local_to_global(graph, sample[:, 2]) for graph, sample in zip(graphs, samples)])
+            if self.args.use_cuda:
+                s_target, o_target = cuda(s_target), cuda(o_target)
+
+            ranks_o = self.perturb_and_get_rank_batched(s, rel_enc_means[r], all_ent_embeds, num_queries, o_target, o_mask, mode='tail')
+            ranks_s = self.perturb_and_get_rank_batched(o, rel_enc_means[r], all_ent_embeds, num_queries, s_target, s_mask, mode='head')
+            ranks = torch.cat([torch.cat([rank_s, rank_o]) for rank_s, rank_o in zip(ranks_s.split(num_queries), ranks_o.split(num_queries))])
+            ranks += 1 # change to 1-indexed
+            self.record_query_keys(samples, times)
+        return ranks
+
+    def record_query_keys(self, samples, times):
+        """
+        with metric breakdowns, append the query keys of the ranks just computed to last_query_keys, so that the keys
+        of the calls of one evaluation step line up with their concatenated ranks. Steps reset last_query_keys to None
+        """
+        if not getattr(self.args, 'metric_breakdowns', ''):
+            return
+        keys = self.get_query_keys(samples, times)
+        if self.last_query_keys is not None:
+            keys = tuple(np.concatenate([recorded, new]) for recorded, new in zip(self.last_query_keys, keys))
+        self.last_query_keys = keys
+
+    def get_query_keys(self, samples, times):
+        # (times, relations, sub_query) of every rank of calc_metrics_batched, for the metric breakdowns
+        relations = [sample[:, 1].cpu().numpy() for sample in samples]
+        return (np.concatenate([np.full(2 * r.shape[0], int(t)) for r, t in zip(relations, times)]),
+                np.concatenate([np.concatenate([r, r]) for r in relations]),
+                np.concatenate([np.arange(2 * r.shape[0]) < r.shape[0] for r in relations]))
+
+    def get_eval_chunk_size(self, num_ent, embed_size, element_size):
+        # a chunk holds its score block and a few score-sized temporaries; the broadcast kernels also materialize
+        # one (num_ent, embed_size) product per query
+        budget = getattr(self.args, 'eval_memory_budget', 512) * 1024 ** 2
+        per_query = 3 * num_ent * element_size
+        if getattr(self.args, 'score_kernel', 'broadcast') == 'broadcast':
+            per_query += num_ent * embed_size * element_size
+        return max(1, int(budget // per_query))
+
+    @profiled('scoring')
+    def perturb_and_get_rank_batched(self, query, batch_r, all_ent_embeds, num_queries, target, mask, mode='tail'):
+        # query and batch_r are the embeddings of the known entity and the relation of every query, num_queries[i] of
+        # them in a row for graph i, which are all scored against the same (num_ent, d) candidates all_ent_embeds[i]
+        chunk_size = self.get_eval_chunk_size(all_ent_embeds[0].shape[0], all_ent_embeds[0].shape[1], all_ent_embeds[0].element_size())
+        profiler.count('queries_scored', query.shape[0])
+        ranks = []
+        graph_start = 0
+        for candidates, n in zip(all_ent_embeds, num_queries):
+            for batch_start in range(graph_start, graph_start + n, chunk_size):
+                batch_end = min(graph_start + n, batch_start + chunk_size)
+                if mode == 'tail':
+                    unmasked_score = self.calc_score(query[batch_start: batch_end], batch_r[batch_start: batch_end], candidates, mode=mode)
+                else:
+                    unmasked_score = self.calc_score(candidates, batch_r[batch_start: batch_end], query[batch_start: batch_end], mode=mode)
+                masked_score = self.apply_eval_mask(unmasked_score, mask, batch_start, batch_end)  # bsz, n_ent
+                ranks.append(self.sort_and_rank(masked_score, target[batch_start: batch_end]))
+            graph_start += n
+        return torch.cat(ranks) if len(ranks) > 0 else target.new_zeros(0)
+
+    @profiled('scoring')
     def perturb_and_get_rank(self, ent_mean, rel_enc_means, all_ent_embeds, s, r, o, test_size, mask, graph, batch_size=100, mode ='tail'):
         """ Perturb one element in the triplets
         """
         n_batch = (test_size + batch_size - 1) // batch_size
+        profiler.count('queries_scored', test_size)
         ranks = []
         for idx in range(n_batch):
             batch_start = idx * batch_size
@@ -68,39 +140,78 @@ class EvaluationFilter:
                 batch_s = all_ent_embeds
                 batch_o = ent_mean[o[batch_start: batch_end]]
                 target = s[batch_start: batch_end]
-            target = torch.tensor([graph.ids[i.item()] for i in target])
+            target = local_to_global(graph, target)
 
             if self.args.use_cuda:
                 target = cuda(target)
 
             unmasked_score = self.calc_score(batch_s, batch_r, batch_o, mode=mode)
-            masked_score = torch.where(mask[batch_start: batch_end], -10e6 * unmasked_score.new_ones(unmasked_score.shape), unmasked_score)
-            score = torch.sigmoid(masked_score)  # bsz, n_ent
-            ranks.append(self.sort_and_rank(score, target))
+            masked_score = self.apply_eval_mask(unmasked_score, mask, batch_start, batch_end)  # bsz, n_ent
+            ranks.append(self.sort_and_rank(masked_score, target))
         return torch.cat(ranks)
 
+    @profiled('eval_masks')
     def mask_eval_set(self, test_triplets, test_size, num_ent, time, graph, mode='tail'):
+        """
+        collect the other true entities of every query as sparse (row, entity) coordinates in global ids
+        :return: CSR row pointer (numpy), row and column index tensors; consumed by apply_eval_mask
+        """
         time = int(time.item())
-        mask = test_triplets.new_zeros(test_size, num_ent)
-        for i in range(test_size):
-            h, r, t = test_triplets[i]
-            h, r, t = h.item(), r.item(), t.item()
-            if mode == 'tail':
-                tails = self.true_tails[time][(h, r)]
-                tail_idx = np.array(list(map(lambda x: graph.ids[x], tails)))
-                mask[i][tail_idx] = 1
-                mask[i][graph.ids[t]] = 0
-            elif mode == 'head':
-                heads = self.true_heads[time][(r, t)]
-                head_idx = np.array(list(map(lambda x: graph.ids[x], heads)))
-                mask[i][head_idx] = 1
-                mask[i][graph.ids[h]] = 0
-            # pdb.set_trace()
-        return mask.byte()
+        node_ids = get_node_ids(graph, 'cpu')
+        test_triplets = test_triplets.cpu()
+        h, r, t = node_ids[test_triplets[:, 0]], test_triplets[:, 1], node_ids[test_triplets[:, 2]]
+        if mode == 'tail':
+            ptr, cols = self.true_tails[time].lookup(h, r)
+            target = t.numpy()
+        elif mode == 'head':
+            ptr, cols = self.true_heads[time].lookup(t, r)
+            target = h.numpy()
+        rows = np.repeat(np.arange(test_size), np.diff(ptr))
+        # the answer of the query itself stays unmasked
+        keep = cols != target[rows]
+        rows, cols = rows[keep], cols[keep]
+        ptr = np.zeros(test_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=test_size), out=ptr[1:])
+        rows, cols = torch.from_numpy(rows), torch.from_numpy(cols)
+        if self.args.use_cuda:
+            rows, cols = cuda(rows), cuda(cols)
+        return ptr, rows, cols
+
+    @staticmethod
+    def merge_eval_masks(masks, num_queries):
+        # concatenate the masks of consecutive query blocks into one mask over all queries
+        ptrs, rows, cols = [], [], []
+        query_offset = nnz_offset = 0
+        for (ptr, row, col), n in zip(masks, num_queries):
+            ptrs.append(ptr[:-1] + nnz_offset)
+            rows.append(row + query_offset)
+            cols.append(col)
+            query_offset += n
+            nnz_offset += ptr[-1]
+        ptrs.append(np.array([nnz_offset], dtype=np.int64))
+        return np.concatenate(ptrs), torch.cat(rows), torch.cat(cols)
+
+    @staticmethod
+    def apply_eval_mask(score, mask, batch_start, batch_end):
+        # masks the score block of queries [batch_start, batch_end) in place
+        ptr, rows, cols = mask
+        lo, hi = ptr[batch_start], ptr[batch_end]
+        if hi > lo:
+            score[rows[lo: hi] - batch_start, cols[lo: hi]] = -10e6
+        return score
 
     def sort_and_rank(self, score, target):
-        # pdb.set_trace()
-        _, indices = torch.sort(score, dim=1, descending=True)
-        indices = torch.nonzero(indices == target.view(-1, 1))
-        indices = indices[:, 1].view(-1)
-        return indices
+        """
+        0-based rank of the target of every row, counted from the scores above the target score instead of sorting.
+        Ties with other entities rank the target first (optimistic, the default, integer ranks), last (pessimistic)
+        or in between (mean, fractional ranks)
+        """
+        target_score = score.gather(1, target.view(-1, 1))
+        greater = (score > target_score).sum(dim=1)
+        rank_ties = getattr(self.args, 'rank_ties', 'optimistic')
+        if rank_ties == 'optimistic':
+            return greater
+        equal = (score == target_score).sum(dim=1) - 1
+        if rank_ties == 'pessimistic':
+            return greater + equal
+        return greater.float() + equal.float() / 2
@@ -1,4 +1,6 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
+import numpy as np
 
 def count_entity_freq_per_train_graph(train_data):
     # train_graph_dict, _, _ = build_interpolation_graphs(args)
@@ -27,6 +29,28 @@ def count_entity_freq_per_train_graph(train_data):
 def temp_func():
     return defaultdict(int)
 
+
+def encode_keys(columns, sizes):
+    """
+    encode integer key columns into a single int64 key, where column i takes values in [0, sizes[i])
+    """
+    key = np.zeros(np.asarray(columns[0]).shape, dtype=np.int64)
+    for column, size in zip(columns, sizes):
+        key = key * size + np.asarray(column, dtype=np.int64)
+    return key
+
+
+def lookup_counts(keys, counts, query):
+    """
+    sorted-key join of query keys against sorted keys with their counts
+    :return: the count of every query key, and whether the key exists
+    """
+    if keys.shape[0] == 0:
+        return np.zeros(query.shape, dtype=counts.dtype), np.zeros(query.shape, dtype=bool)
+    pos = np.minimum(np.searchsorted(keys, query), keys.shape[0] - 1)
+    found = keys[pos] == query
+    return np.where(found, counts[pos], 0), found
+
 def count_freq_per_time(train_data):
     # train_graph_dict, _, _ = build_interpolation_graphs(args)
     triple_freq_per_time_step = defaultdict(temp_func)
@@ -49,6 +73,198 @@ def count_freq_per_time(train_data):
 
     return triple_freq_per_time_step, ent_pair_freq_per_time_step, sub_freq_per_time_step, obj_freq_per_time_step, rel_freq_per_time_step, sub_rel_freq_per_time_step, obj_rel_freq_per_time_step
 
+class WindowFrequency:
+    """
+    count of every key over the sliding window of each target time, excluding the target time itself and restricted
+    to the keys occurring at the target time. The window total is kept as one integer array over the key vocabulary
+    and moved incrementally, adding the entering time step and subtracting the leaving one.
+    The window of target_time is [target_time - seq_len + 1, target_time), or up to target_time + seq_len - 1
+    (at most max_time) when future is set
+    """
+    def __init__(self, data, columns, sizes, target_times, seq_len, future=False, max_time=None):
+        self.sizes = tuple(sizes)
+        keys = encode_keys([data[:, c] for c in columns], self.sizes)
+        vocab, key_ids = np.unique(keys, return_inverse=True)
+        # per time step counts, sorted by (time, key)
+        step_keys, step_counts = np.unique(data[:, 3].astype(np.int64) * vocab.shape[0] + key_ids, return_counts=True)
+        step_times, step_key_ids = step_keys // vocab.shape[0], step_keys % vocab.shape[0]
+        self.step_times, step_starts = np.unique(step_times, return_index=True)
+        self.step_offsets = np.append(step_starts, step_keys.shape[0])
+
+        max_time = int(self.step_times[-1]) if max_time is None and self.step_times.shape[0] > 0 else max_time
+        window = np.zeros(vocab.shape[0], dtype=np.int64)
+        lower = upper = 0
+
+        def step(time):
+            pos = np.searchsorted(self.step_times, time)
+            if pos == self.step_times.shape[0] or self.step_times[pos] != time:
+                return step_key_ids[:0], step_counts[:0]
+            return step_key_ids[self.step_offsets[pos]: self.step_offsets[pos + 1]], step_counts[self.step_offsets[pos]: self.step_offsets[pos + 1]]
+
+        def move(time, sign):
+            key_ids_t, counts_t = step(time)
+            window[key_ids_t] += sign * counts_t
+
+        self.targets = np.unique(np.asarray(target_times, dtype=np.int64))
+        agg_keys, agg_counts, agg_sizes = [], [], []
+        for target_time in self.targets.tolist():
+            new_lower = max(0, target_time - seq_len + 1)
+            new_upper = target_time if not future else min(max_time + 1, target_time + seq_len)
+            if new_lower >= upper or new_lower < lower:
+                window[:] = 0
+                lower = upper = new_lower
+            while lower < new_lower:
+                move(lower, -1)
+                lower += 1
+            while upper < new_upper:
+                move(upper, 1)
+                upper += 1
+            while upper > max(new_upper, lower):
+                upper -= 1
+                move(upper, -1)
+
+            key_ids_t, counts_t = step(target_time)
+            counts = window[key_ids_t]
+            if lower <= target_time < upper:
+                counts = counts - counts_t
+            present = counts > 0
+            agg_keys.append(vocab[key_ids_t[present]])
+            agg_counts.append(counts[present])
+            agg_sizes.append(int(present.sum()))
+        self.offsets = np.cumsum([0] + agg_sizes).astype(np.int64)
+        self.keys = np.concatenate(agg_keys) if len(agg_keys) > 0 else np.zeros(0, dtype=np.int64)
+        self.counts = np.concatenate(agg_counts) if len(agg_counts) > 0 else np.zeros(0, dtype=np.int64)
+
+    def get_arrays(self, target_time):
+        # sorted keys and their window counts at target_time
+        pos = np.searchsorted(self.targets, target_time)
+        if pos == self.targets.shape[0] or self.targets[pos] != target_time:
+            return self.keys[:0], self.counts[:0]
+        return self.keys[self.offsets[pos]: self.offsets[pos + 1]], self.counts[self.offsets[pos]: self.offsets[pos + 1]]
+
+    def lookup(self, target_time, *columns):
+        # vectorized window counts of the keys given as columns, 0 for absent keys
+        keys, counts = self.get_arrays(target_time)
+        return lookup_counts(keys, counts, encode_keys(columns, self.sizes))[0]
+
+    def decode(self, key):
+        items = []
+        for size in reversed(self.sizes):
+            key, item = divmod(key, size)
+            items.append(item)
+        return tuple(reversed(items)) if len(items) > 1 else items[0]
+
+    def __getitem__(self, target_time):
+        return WindowCounts(self, target_time)
+
+
+class WindowCounts(Mapping):
+    # read-only view of the window counts of one target time, absent keys count 0 like the defaultdict tables
+    def __init__(self, window_frequency, target_time):
+        self.window_frequency = window_frequency
+        self.item_keys, self.counts = window_frequency.get_arrays(target_time)
+
+    def find(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        query = int(encode_keys(key, self.window_frequency.sizes))
+        pos = np.searchsorted(self.item_keys, query)
+        return pos if pos < self.item_keys.shape[0] and self.item_keys[pos] == query else None
+
+    def __getitem__(self, key):
+        pos = self.find(key)
+        return 0 if pos is None else int(self.counts[pos])
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __iter__(self):
+        return (self.window_frequency.decode(int(key)) for key in self.item_keys)
+
+    def __len__(self):
+        return self.item_keys.shape[0]
+
+
+class TemporalCounts:
+    """
+    per-key cumulative counts over time for one key type. Entries are sorted by (key, time) so that
+    prefix[searchsorted(key_times, key * span + time)] is the count of the key before time; the count of any
+    window [lower, upper) is the difference of two such reads
+    """
+    def __init__(self, data, columns, sizes, span=None):
+        self.sizes = tuple(sizes)
+        times = data[:, 3].astype(np.int64)
+        self.span = int(times.max()) + 1 if span is None and times.shape[0] > 0 else (span or 0)
+        self.vocab, key_ids = np.unique(encode_keys([data[:, c] for c in columns], self.sizes), return_inverse=True)
+        self.key_times, counts = np.unique(key_ids * self.span + times, return_counts=True)
+        self.prefix = np.append(0, np.cumsum(counts)).astype(np.int64)
+
+    def count(self, lower, upper, *columns):
+        # vectorized counts of the keys given as columns over [lower, upper), 0 for keys never seen
+        columns = [np.asarray(column, dtype=np.int64) for column in columns]
+        in_range = np.ones(columns[0].shape, dtype=bool)
+        for column, size in zip(columns, self.sizes):
+            in_range &= (column >= 0) & (column < size)
+        query = encode_keys([np.where(in_range, column, 0) for column in columns], self.sizes)
+        if self.vocab.shape[0] == 0:
+            return np.zeros(query.shape, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.vocab, query), self.vocab.shape[0] - 1)
+        found = in_range & (self.vocab[pos] == query)
+        lower = np.clip(lower, 0, self.span)
+        upper = np.clip(upper, lower, self.span)
+        counts = self.prefix[np.searchsorted(self.key_times, pos * self.span + upper)] - \
+            self.prefix[np.searchsorted(self.key_times, pos * self.span + lower)]
+        return np.where(found, counts, 0)
+
+
+class TemporalCountIndex:
+    """
+    TemporalCounts of every key type of the analysis scripts over the quadruples [head, rel, tail, time]
+    """
+    KEY_COLUMNS = OrderedDict([('triple', (0, 1, 2)), ('ent_pair', (0, 2)), ('sub_rel', (0, 1)), ('obj_rel', (2, 1)),
+                               ('sub', (0,)), ('obj', (2,)), ('rel', (1,))])
+
+    def __init__(self, data, num_ents, num_rels, span=None):
+        data = np.asarray(data, dtype=np.int64)
+        sizes = {0: num_ents, 1: num_rels, 2: num_ents}
+        self.counts = {name: TemporalCounts(data, columns, [sizes[c] for c in columns], span)
+                       for name, columns in self.KEY_COLUMNS.items()}
+
+    def count(self, name, lower, upper, quadruples):
+        return self.counts[name].count(lower, upper, *[quadruples[:, c] for c in self.KEY_COLUMNS[name]])
+
+
+def prediction_frequencies(count_index, quadruples, seq_len=None, bidirectional=False, max_time=None, exclude_target=True):
+    """
+    frequency of every key type of every prediction within its window, in one pass over a whole predictions array.
+    The window of a prediction at time t starts at t - seq_len + 1 and ends at t, or at t + seq_len - 1 (at most
+    max_time) when bidirectional; exclude_target leaves t itself out. Without seq_len the whole timeline is counted
+    :return: dict from key type to the (N,) counts
+    """
+    times = quadruples[:, 3].astype(np.int64)
+    if seq_len is None:
+        lower, upper = np.zeros_like(times), np.full_like(times, np.iinfo(np.int64).max)
+        exclude_target = False
+    else:
+        lower = np.maximum(0, times - seq_len + 1)
+        upper = times + 1 if not bidirectional else np.minimum(max_time + 1, times + seq_len)
+    frequencies = OrderedDict()
+    for name in count_index.KEY_COLUMNS:
+        frequencies[name] = count_index.count(name, lower, upper, quadruples)
+        if exclude_target:
+            frequencies[name] -= count_index.count(name, times, np.minimum(times + 1, upper), quadruples)
+    return frequencies
+
+
+def group_ranks_by_frequency(frequencies, ranks):
+    # {frequency: list of ranks}, the layout of the per-prediction loops of the analysis scripts
+    grouped = defaultdict(list)
+    order = np.argsort(frequencies, kind='stable')
+    values, starts = np.unique(frequencies[order], return_index=True)
+    for value, group in zip(values.tolist(), np.split(ranks[order], starts[1:])):
+        grouped[value] = group.tolist()
+    return grouped
+
+
 def calc_aggregated_statistics(stats_per_time_agg, items, stats_per_time, target_time, cur_time):
     for item in items:
         if item in stats_per_time[cur_time].keys():
@@ -0,0 +1,205 @@
+import json
+import resource
+import sys
+import types
+from collections import OrderedDict, defaultdict, deque
+import numpy as np
+import torch
+from utils import objgraph
+
+MB = 1024 ** 2
+# kinds of objects whose size is not theirs to report
+SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+def read_rss():
+    """
+    :return: (resident set size, peak resident set size) of the process in bytes
+    """
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(status['VmRSS'].split()[0]) * 1024, int(status['VmHWM'].split()[0]) * 1024
+    except (IOError, KeyError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        return peak, peak
+
+
+def reset_peak_rss():
+    # linux only; elsewhere the peak stays the peak of the whole run
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def is_graph(obj):
+    return hasattr(obj, 'ndata') and hasattr(obj, 'edata') and hasattr(obj, 'number_of_edges')
+
+
+def is_container(obj):
+    return isinstance(obj, (dict, list, tuple, set, frozenset, deque)) or is_graph(obj) or \
+           isinstance(obj, (np.ndarray, torch.Tensor))
+
+
+def deep_sizeof(obj, seen):
+    """
+    bytes held by obj and everything it references, by type of the holder. Tensors count their storage, arrays
+    their buffer; memory-mapped arrays are file-backed and left out. Objects already in seen are not counted again
+    :return: {type name: bytes}
+    """
+    sizes = defaultdict(int)
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, torch.Tensor):
+            storage = obj.storage()
+            if ('storage', storage.data_ptr()) not in seen:
+                seen.add(('storage', storage.data_ptr()))
+                sizes['Tensor'] += storage.size() * storage.element_size()
+        elif isinstance(obj, np.ndarray):
+            if isinstance(obj, np.memmap):
+                continue
+            if obj.base is not None:
+                stack.append(obj.base)
+            else:
+                sizes['ndarray'] += obj.nbytes
+        elif is_graph(obj):
+            # node and edge features; the graph structure itself holds two ids per edge
+            sizes['DGLGraph'] += 16 * obj.number_of_edges()
+            stack.extend(obj.ndata.values())
+            stack.extend(obj.edata.values())
+        else:
+            sizes[type(obj).__name__] += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+                stack.extend(obj)
+            elif hasattr(obj, '__dict__'):
+                stack.append(vars(obj))
+    return sizes
+
+
+def get_children(obj):
+    # named attributes of obj; the parameters, buffers and submodules of a torch module are its attributes too
+    attrs = OrderedDict()
+    for name in ['_parameters', '_buffers', '_modules']:
+        attrs.update(getattr(obj, name, None) or {})
+    attrs.update((name, value) for name, value in vars(obj).items() if name not in ['_parameters', '_buffers', '_modules'])
+    return attrs
+
+
+def owner_sizes(roots, depth=3):
+    """
+    breadth-first walk of the attributes of the root objects down to depth, sizing every container, array, tensor
+    and graph at the shortest attribute path that reaches it, so caches shared by several owners are counted once
+    :param roots: {name: object}
+    :return: list of (owner path, {type name: bytes})
+    """
+    seen = set()
+    owners = []
+    queue = deque((name, obj, 0) for name, obj in roots.items())
+    while queue:
+        path, obj, level = queue.popleft()
+        if obj is None or id(obj) in seen or isinstance(obj, SKIPPED_TYPES):
+            continue
+        if is_container(obj) or not hasattr(obj, '__dict__') or level == depth:
+            owners.append((path, deep_sizeof(obj, seen)))
+            continue
+        seen.add(id(obj))
+        for name, child in get_children(obj).items():
+            queue.append(('{}.{}'.format(path, name), child, level + 1))
+    return owners
+
+
+class MemoryTracker:
+    """
+    Memory diagnostics of a run. A checkpoint after every preprocessing phase reports the resident set and its
+    growth with the python object types that grew (from the vendored objgraph). Training steps are sampled for the
+    peak resident set and the peak cuda allocation between samples, and report_owners sizes the structures held
+    by the model. Records are printed and, with a report path, appended as json lines. Disabled, every call
+    returns at once
+    """
+    def __init__(self):
+        self.enabled = False
+        self.report_path = None
+        self.sample_every = 0
+        self.type_peaks = {}
+        self.last_rss = 0
+        self.step = 0
+        self.step_samples = []
+
+    def configure(self, enabled, report_path=None, sample_every=50, limit=10):
+        self.enabled = enabled
+        self.report_path = report_path
+        self.sample_every = sample_every
+        self.limit = limit
+        if enabled:
+            # the baseline every later growth is measured against
+            objgraph.growth(limit=None, peak_stats=self.type_peaks)
+            self.last_rss = read_rss()[0]
+
+    def write(self, record):
+        if self.report_path is not None:
+            with open(self.report_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+
+    def checkpoint(self, phase):
+        if not self.enabled:
+            return
+        rss, peak_rss = read_rss()
+        growth = objgraph.growth(limit=self.limit, peak_stats=self.type_peaks)
+        record = OrderedDict([('phase', phase), ('rss_mb', rss / MB), ('rss_growth_mb', (rss - self.last_rss) / MB),
+                              ('peak_rss_mb', peak_rss / MB), ('object_growth', [[name, total, delta] for name, total, delta in growth])])
+        self.last_rss = rss
+        print("memory after {}: rss {:.1f} MB ({:+.1f} MB), peak {:.1f} MB; grown types {}".format(
+            phase, record['rss_mb'], record['rss_growth_mb'], record['peak_rss_mb'],
+            ", ".join("{} +{}".format(name, delta) for name, _, delta in growth)))
+        self.write(record)
+
+    def report_owners(self, roots, depth=3):
+        """
+        largest structures by owner attribute path and type, e.g. model.drop_edge.drop_rate_cache
+        """
+        if not self.enabled:
+            return
+        rows = [(path, name, size) for path, sizes in owner_sizes(roots, depth) for name, size in sizes.items()]
+        rows = sorted(rows, key=lambda row: row[2], reverse=True)[:self.limit]
+        print("largest structures:")
+        for path, name, size in rows:
+            print("  {:.1f} MB\t{}\t{}".format(size / MB, name, path))
+        self.write(OrderedDict([('phase', 'owners'), ('structures', [[path, name, size / MB] for path, name, size in rows])]))
+
+    def sample_step(self):
+        # every sample_every training steps, the peaks since the previous sample
+        if not self.enabled or self.sample_every <= 0:
+            return
+        self.step += 1
+        if self.step % self.sample_every != 0:
+            return
+        rss, peak_rss = read_rss()
+        sample = OrderedDict([('step', self.step), ('rss_mb', rss / MB), ('peak_rss_mb', peak_rss / MB)])
+        if torch.cuda.is_available():
+            sample['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / MB
+            torch.cuda.reset_max_memory_allocated()
+        reset_peak_rss()
+        self.step_samples.append(sample)
+
+    def flush_steps(self, epoch=None):
+        """
+        :return: flat {'memory/...': value} dict of the highest step peaks since the last flush, for the experiment log
+        """
+        if not self.enabled or len(self.step_samples) == 0:
+            return {}
+        samples, self.step_samples = self.step_samples, []
+        self.write(OrderedDict([('phase', 'train_steps'), ('epoch', epoch), ('samples', samples)]))
+        return OrderedDict(('memory/{}'.format(name), max(sample[name] for sample in samples))
+                           for name in samples[0] if name != 'step')
+
+
+memory_tracker = MemoryTracker()
@@ -0,0 +1,73 @@
+import numpy as np
+import torch
+
+HITS = (1, 3, 10)
+BREAKDOWNS = ('time', 'relation', 'mode')
+
+
+class RankAccumulator:
+    """
+    Online link prediction metrics. Every batch of ranks is folded into running sums of reciprocal ranks and hit
+    counts and into a rank histogram, so MRR, Hits@k and exact rank quantiles need no concatenated rank tensor.
+    With breakdowns, the same sums are kept per timestamp, per relation and per mode ('s' for subject queries, 'o'
+    for object queries); keep_ranks also retains the rank tensor of every batch
+    """
+    def __init__(self, num_ents, breakdowns=(), keep_ranks=False, hits=HITS):
+        self.hits = tuple(hits)
+        self.breakdowns = {name: {} for name in breakdowns}
+        # ranks are counted in half steps, mean tie ranks fall on them
+        self.histogram = np.zeros(2 * num_ents + 3, dtype=np.int64)
+        self.sums = np.zeros(2 + len(self.hits))
+        self.keep_ranks = keep_ranks
+        self.kept = []
+
+    def stats(self, ranks):
+        # per query [1, reciprocal rank, hit@k...], the rows that are summed
+        return np.stack([np.ones_like(ranks), 1.0 / ranks] + [(ranks <= k).astype(np.float64) for k in self.hits], axis=1)
+
+    def add(self, ranks, batch_time=None, query_keys=None):
+        """
+        :param query_keys: (times, relations, sub_query) arrays aligned with ranks, needed for the breakdowns
+        """
+        if self.keep_ranks:
+            self.kept.append((batch_time, ranks))
+        ranks = ranks.cpu().numpy().astype(np.float64) if isinstance(ranks, torch.Tensor) else np.asarray(ranks, dtype=np.float64)
+        if ranks.shape[0] == 0:
+            return
+        stats = self.stats(ranks)
+        self.sums += stats.sum(axis=0)
+        half_steps = np.minimum(np.rint(2 * ranks).astype(np.int64), self.histogram.shape[0] - 1)
+        self.histogram += np.bincount(half_steps, minlength=self.histogram.shape[0])
+        if len(self.breakdowns) == 0:
+            return
+        if query_keys is None or len(query_keys[0]) != ranks.shape[0]:
+            raise ValueError("metric breakdowns need the query keys of every rank, got {} keys for {} ranks".format(
+                None if query_keys is None else len(query_keys[0]), ranks.shape[0]))
+        times, relations, sub_query = query_keys
+        keys = {'time': times, 'relation': relations, 'mode': np.where(sub_query, 's', 'o')}
+        for name, table in self.breakdowns.items():
+            uniq, inverse = np.unique(keys[name], return_inverse=True)
+            group_stats = np.zeros((uniq.shape[0], stats.shape[1]))
+            np.add.at(group_stats, inverse.reshape(-1), stats)
+            for key, row in zip(uniq.tolist(), group_stats):
+                table[key] = table[key] + row if key in table else row
+
+    def summarize(self, sums):
+        count = max(sums[0], 1)
+        result = {'mrr': sums[1] / count}
+        result.update({'hit_{}'.format(k): sums[2 + i] / count for i, k in enumerate(self.hits)})
+        result['count'] = int(sums[0])
+        return result
+
+    def result(self):
+        return self.summarize(self.sums)
+
+    def breakdown(self, name):
+        return {key: self.summarize(sums) for key, sums in sorted(self.breakdowns[name].items())}
+
+    def quantile(self, q):
+        # exact rank quantile read off the histogram
+        cumulative = np.cumsum(self.histogram)
+        if cumulative[-1] == 0:
+            return float('nan')
+        return np.searchsorted(cumulative, q * cumulative[-1]) / 2
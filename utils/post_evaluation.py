@@ -1,8 +1,9 @@
 import torch
 from utils.CorrptTriples import CorruptTriples
-from utils.utils import cuda
+from utils.utils import cuda, local_to_global
 import numpy as np
 from utils.evaluation import EvaluationFilter
+from utils.profiler import profiler, profiled
 
 class PostEvaluationFilter(EvaluationFilter):
     def __init__(self, args, calc_score, graph_dict_train, graph_dict_val, graph_dict_test):
@@ -26,13 +27,16 @@ class PostEvaluationFilter(EvaluationFilter):
 
             ranks = torch.cat([ranks_s, ranks_o])
             ranks += 1 # change to 1-indexed
+            self.record_query_keys([samples], [time])
             # print("Graph {} mean ranks {}".format(time.item(), ranks.float().mean().item()))
         return ranks
 
+    @profiled('scoring')
     def emsemble_and_get_rank(self, ent_embed_loc, ent_embed_rec, rel_enc_means, all_embeds_g_loc, all_embeds_g_rec, weight_subject, weight_object, s, r, o, test_size, mask, graph, batch_size=100, mode ='tail'):
         """ Perturb one element in the triplets
         """
         n_batch = (test_size + batch_size - 1) // batch_size
+        profiler.count('queries_scored', test_size)
         ranks = []
         for idx in range(n_batch):
             batch_start = idx * batch_size
@@ -57,15 +61,14 @@ class PostEvaluationFilter(EvaluationFilter):
                 batch_o = batch_weight_object * batch_o_loc + (1 - batch_weight_object) * batch_o_rec
                 target = s[batch_start: batch_end]
 
-            target = torch.tensor([graph.ids[i.item()] for i in target])
+            target = local_to_global(graph, target)
 
             if self.args.use_cuda:
                 target = cuda(target)
 
             unmasked_score = self.calc_score(batch_s, batch_r, batch_o, mode=mode)
-            masked_score = torch.where(mask[batch_start: batch_end], -10e6 * unmasked_score.new_ones(unmasked_score.shape), unmasked_score)
-            score = torch.sigmoid(masked_score)  # bsz, n_ent
-            ranks.append(self.sort_and_rank(score, target))
+            masked_score = self.apply_eval_mask(unmasked_score, mask, batch_start, batch_end)  # bsz, n_ent
+            ranks.append(self.sort_and_rank(masked_score, target))
         return torch.cat(ranks)
 
 
@@ -89,13 +92,16 @@ class PostEnsembleEvaluationFilter(EvaluationFilter):
 
             ranks = torch.cat([ranks_s, ranks_o])
             ranks += 1 # change to 1-indexed
+            self.record_query_keys([samples], [time])
             # print("Graph {} mean ranks {}".format(time.item(), ranks.float().mean().item()))
         return ranks
 
+    @profiled('scoring')
     def emsemble_and_get_rank(self, ent_embed_loc, ent_embed_temporal, rel_enc_mean, all_embeds_g_local, all_embeds_g_temporal, weight, s, r, o, test_size, mask, graph, batch_size=100, mode ='tail'):
         """ Perturb one element in the triplets
         """
         n_batch = (test_size + batch_size - 1) // batch_size
+        profiler.count('queries_scored', test_size)
         ranks = []
         local_scores = []
         temporal_scores = []
@@ -108,7 +114,7 @@ class PostEnsembleEvaluationFilter(EvaluationFilter):
             targets.append(target)
         scores = weight * torch.cat(local_scores) + (1 - weight) * torch.cat(temporal_scores)
         targets = torch.cat(targets)
-        ranks.append(self.sort_and_rank(torch.sigmoid(scores), targets))
+        ranks.append(self.sort_and_rank(scores, targets))
         return torch.cat(ranks)
 
     def get_score(self, ent_mean, rel_enc_means, all_ent_embeds, s, r, o, test_size, mask, graph, idx, batch_size=100, mode ='tail'):
@@ -124,11 +130,11 @@ class PostEnsembleEvaluationFilter(EvaluationFilter):
             batch_s = all_ent_embeds
             batch_o = ent_mean[o[batch_start: batch_end]]
             target = s[batch_start: batch_end]
-        target = torch.tensor([graph.ids[i.item()] for i in target])
+        target = local_to_global(graph, target)
 
         if self.args.use_cuda:
             target = cuda(target)
 
         unmasked_score = self.calc_score(batch_s, batch_r, batch_o, mode=mode)
-        masked_score = torch.where(mask[batch_start: batch_end], -10e6 * unmasked_score.new_ones(unmasked_score.shape), unmasked_score)
+        masked_score = self.apply_eval_mask(unmasked_score, mask, batch_start, batch_end)
         return masked_score, target  # bsz, n_ent
@@ -0,0 +1,118 @@
+import json
+import os
+import pickle
+import numpy as np
+from collections import defaultdict, OrderedDict
+
+# one raw binary file per column, appended batch by batch and memory-mapped on load
+PREDICTION_COLUMNS = OrderedDict([('sub', np.int32), ('rel', np.int32), ('obj', np.int32), ('time', np.int32),
+                                  ('sub_query', np.bool_), ('rank', np.float32)])
+META_FILE = 'meta.json'
+
+
+class PredictionWriter:
+    """
+    Writes test predictions as typed columns: the query triple and time, whether the subject ('s' mode) or the
+    object ('o' mode) is predicted, and the filtered rank of the answer. meta holds a json header such as the
+    checkpoint, dataset and seq_len of the run
+    """
+    def __init__(self, path, meta=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = dict(meta or {})
+        self.num_predictions = 0
+        self.files = OrderedDict((name, open(os.path.join(path, name + '.bin'), 'wb')) for name in PREDICTION_COLUMNS)
+        self.write_meta()
+
+    def write_meta(self):
+        meta = dict(self.meta, num_predictions=self.num_predictions,
+                    columns=OrderedDict((name, np.dtype(dtype).str) for name, dtype in PREDICTION_COLUMNS.items()))
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def append(self, sub, rel, obj, time, sub_query, rank):
+        columns = [sub, rel, obj, time, sub_query, rank]
+        size = len(columns[-1])
+        for (name, dtype), column in zip(PREDICTION_COLUMNS.items(), columns):
+            column = np.broadcast_to(np.asarray(column, dtype=dtype), (size,))
+            self.files[name].write(np.ascontiguousarray(column).tobytes())
+        self.num_predictions += size
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.write_meta()
+
+
+class Predictions:
+    """
+    Columns of a prediction dump, memory-mapped. Iterating yields the legacy [s, r, o, t, mode, rank] rows
+    """
+    def __init__(self, columns, meta=None):
+        self.columns = columns
+        self.meta = meta or {}
+
+    def __getattr__(self, name):
+        if name in PREDICTION_COLUMNS:
+            return self.columns[name]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self.columns['rank'].shape[0]
+
+    @property
+    def quadruples(self):
+        return np.stack([self.columns[name].astype(np.int64) for name in ['sub', 'rel', 'obj', 'time']], axis=1)
+
+    def arrays(self):
+        # (N, 4) quadruples, subject query mask and ranks, the inputs of the vectorized analysis
+        return self.quadruples, np.asarray(self.columns['sub_query']), self.columns['rank'].astype(np.float64)
+
+    def __iter__(self):
+        rows = zip(*[self.columns[name].tolist() for name in PREDICTION_COLUMNS])
+        return ([s, r, o, t, 's' if sub_query else 'o', rank] for s, r, o, t, sub_query, rank in rows)
+
+    @staticmethod
+    def from_list(predictions):
+        # legacy pickled [s, r, o, t, mode, rank] rows
+        rows = np.array([list(pred[:4]) for pred in predictions], dtype=np.int64).reshape(-1, 4)
+        columns = OrderedDict([('sub', rows[:, 0]), ('rel', rows[:, 1]), ('obj', rows[:, 2]), ('time', rows[:, 3]),
+                               ('sub_query', np.array([pred[4] == 's' for pred in predictions], dtype=bool)),
+                               ('rank', np.array([pred[5] for pred in predictions], dtype=np.float64))])
+        return Predictions(OrderedDict((name, column.astype(PREDICTION_COLUMNS[name])) for name, column in columns.items()))
+
+
+def group_ranks_by_keys(ranks, *columns):
+    """
+    vectorized group-by of ranks on one or more key columns
+    :return: {key: list of ranks}, keys are tuples for several columns
+    """
+    rows = np.stack([np.asarray(column, dtype=np.int64) for column in columns], axis=1)
+    grouped = defaultdict(list)
+    if rows.shape[0] == 0:
+        return grouped
+    keys, inverse = np.unique(rows, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[order], np.arange(keys.shape[0]))
+    for key, group in zip(keys.tolist(), np.split(np.asarray(ranks)[order], starts[1:])):
+        grouped[tuple(key) if len(columns) > 1 else key[0]] = group.tolist()
+    return grouped
+
+
+def load_predictions(path):
+    """
+    memory-map a prediction dump; a pickled list of prediction rows is converted on the fly
+    """
+    if not os.path.isdir(path):
+        with open(path, 'rb') as filehandle:
+            return Predictions.from_list(pickle.load(filehandle))
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    columns = OrderedDict()
+    for name, dtype in PREDICTION_COLUMNS.items():
+        column_path = os.path.join(path, name + '.bin')
+        size = os.path.getsize(column_path) // np.dtype(dtype).itemsize
+        columns[name] = np.memmap(column_path, dtype=dtype, mode='r', shape=(size,)) if size > 0 else np.zeros(0, dtype=dtype)
+    assert len(set(column.shape[0] for column in columns.values())) == 1, "truncated prediction columns in {}".format(path)
+    return Predictions(columns, meta)
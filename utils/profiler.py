@@ -0,0 +1,115 @@
+import json
+import time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+import torch
+
+
+class NullScope:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SCOPE = NullScope()
+
+
+class Scope:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.synchronize()
+        self.profiler.times[self.name] += time.perf_counter() - self.start
+        self.profiler.calls[self.name] += 1
+        return False
+
+
+class StageProfiler:
+    """
+    Named timing scopes and counters of the training and evaluation stages, accumulated until the next summary.
+    Disabled, a scope is a shared no-op context and a count returns at once. Nested scopes are timed inclusively,
+    and with sync the cuda stream is drained at every scope boundary so that gpu stages are charged to their scope.
+    Stages run in loader worker processes are only seen with --num-workers 0
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sync = False
+        self.trace_path = None
+        self.reset()
+
+    def configure(self, enabled, sync=False, trace_path=None):
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.trace_path = trace_path
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.start = time.perf_counter()
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def scope(self, name):
+        return Scope(self, name) if self.enabled else NULL_SCOPE
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += int(n)
+
+    def summary(self):
+        wall = time.perf_counter() - self.start
+        return OrderedDict([
+            ('wall', wall),
+            ('stages', OrderedDict((name, {'seconds': self.times[name], 'calls': self.calls[name]}) for name in sorted(self.times))),
+            ('counters', OrderedDict((name, self.counters[name]) for name in sorted(self.counters))),
+            ('throughput', OrderedDict((name, self.counters[name] / wall if wall > 0 else 0.0) for name in sorted(self.counters))),
+        ])
+
+    def flush(self, phase, step=None):
+        """
+        summary of everything since the last flush, appended to the json lines trace; the counters start over
+        :return: flat {'profile/...': value} dict for the experiment log, empty when disabled
+        """
+        if not self.enabled:
+            return {}
+        summary = self.summary()
+        self.reset()
+        if self.trace_path is not None:
+            with open(self.trace_path, 'a') as f:
+                f.write(json.dumps(OrderedDict([('phase', phase), ('step', step)] + list(summary.items()))) + "\n")
+        flat = OrderedDict([('profile/wall', summary['wall'])])
+        for name, stage in summary['stages'].items():
+            flat['profile/{}_seconds'.format(name)] = stage['seconds']
+        for name in summary['counters']:
+            flat['profile/{}'.format(name)] = summary['counters'][name]
+            flat['profile/{}_per_second'.format(name)] = summary['throughput'][name]
+        return flat
+
+
+profiler = StageProfiler()
+
+
+def profiled(name):
+    # times every call of the decorated function under name; disabled, it costs one flag check
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with Scope(profiler, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
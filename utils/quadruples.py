@@ -0,0 +1,48 @@
+import os
+import numpy as np
+
+
+def read_quadruples(path):
+    # bulk parse of "head rel tail time [...]" lines into an int32 (N, 4) array
+    with open(path, 'r') as fr:
+        num_columns = len(fr.readline().split())
+    if num_columns == 0:
+        return np.zeros((0, 4), dtype=np.int32)
+    data = np.fromfile(path, dtype=np.int64, sep=' ')
+    return data.reshape(-1, num_columns)[:, :4].astype(np.int32)
+
+
+class QuadrupleSet:
+    """
+    quadruples [head, rel, tail, time] sorted by time, with per-timestamp slices given by offsets
+    """
+    def __init__(self, quadruples):
+        # stable sort keeps the file order of the triples within a timestamp
+        order = np.argsort(quadruples[:, 3], kind='stable')
+        self.quadruples = quadruples[order]
+        self.times, starts = np.unique(self.quadruples[:, 3], return_index=True)
+        self.offsets = np.append(starts, self.quadruples.shape[0])
+        self.position = {t: i for i, t in enumerate(self.times.tolist())}
+
+    def get_triples(self, tim):
+        if tim not in self.position:
+            return self.quadruples[:0, :3]
+        i = self.position[tim]
+        return self.quadruples[self.offsets[i]: self.offsets[i + 1], :3]
+
+
+def load_quadruple_set(dataset_path, *fileNames):
+    return QuadrupleSet(np.concatenate([read_quadruples(os.path.join(dataset_path, fileName))
+                                        for fileName in fileNames if fileName is not None], axis=0))
+
+
+def load_quadruples(dataset_path, fileName, fileName2=None, fileName3=None):
+    quadruple_set = load_quadruple_set(dataset_path, fileName, fileName2, fileName3)
+    return quadruple_set.quadruples, quadruple_set.times
+
+
+def get_total_number(dataset_path, fileName="stat.txt"):
+    with open(os.path.join(dataset_path, fileName), 'r') as fr:
+        for line in fr:
+            line_split = line.split()
+            return int(line_split[0]), int(line_split[1])
@@ -0,0 +1,113 @@
+import numpy as np
+import torch
+from collections import OrderedDict
+from utils.scores import get_score_function
+from utils.embedding_store import EmbeddingStore
+from utils.quadruples import load_quadruple_set
+from utils.true_index import TrueIndex
+
+
+class QueryEngine:
+    """
+    Answers (s, r, ?, t) and (?, r, o, t) queries from an embedding store written by export_embeddings.py, without the
+    model or the graphs. Queries are grouped by timestamp and every group is scored against all entities in batches.
+    With a dataset path, the known true entities of each query at its timestamp can be filtered out of the answers
+    """
+    def __init__(self, store_path, score_function=None, score_kernel='matmul', dataset=None, device='cpu',
+                 batch_size=1024, cache_size=16):
+        self.store = EmbeddingStore(store_path)
+        self.device = torch.device(device)
+        self.calc_score = get_score_function(score_function or self.store.meta['score_function'], score_kernel)
+        self.rel_embeds = torch.from_numpy(self.store.relations).to(self.device)
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        # entity embeddings of the most recently queried timestamps, moved to the device once
+        self.embeds_cache = OrderedDict()
+        self.quadruple_set = load_quadruple_set(dataset, 'train.txt', 'valid.txt', 'test.txt') if dataset else None
+        # filter indices of the most recently filtered timestamps
+        self.true_index = OrderedDict()
+
+    def get_embeds(self, t):
+        if t in self.embeds_cache:
+            self.embeds_cache.move_to_end(t)
+        else:
+            self.embeds_cache[t] = torch.from_numpy(np.array(self.store[t])).to(self.device)
+            if len(self.embeds_cache) > self.cache_size:
+                self.embeds_cache.popitem(last=False)
+        return self.embeds_cache[t]
+
+    def get_true_index(self, t):
+        # (true_head, true_tail) of the facts at time t
+        if t in self.true_index:
+            self.true_index.move_to_end(t)
+        else:
+            self.true_index[t] = TrueIndex.build_head_and_tail(self.quadruple_set.get_triples(t).astype(np.int64))
+            if len(self.true_index) > self.cache_size:
+                self.true_index.popitem(last=False)
+        return self.true_index[t]
+
+    def score(self, entities, relations, t, mode='tail'):
+        # (len(entities), num_ents) scores of every candidate completing the queries at time t
+        all_embeds = self.get_embeds(t)
+        entities = torch.from_numpy(entities).to(self.device)
+        r = self.rel_embeds[torch.from_numpy(relations).to(self.device)]
+        if mode == 'tail':
+            return self.calc_score(all_embeds[entities], r, all_embeds, mode='tail')
+        return self.calc_score(all_embeds, r, all_embeds[entities], mode='head')
+
+    def answer(self, entities, relations, times, mode='tail', k=10, filtered=False):
+        """
+        :param entities: the known entity of every query, the subject for mode tail and the object for mode head
+        :return: (num_queries, k) top-k entity ids and their scores, in the order of the queries
+        """
+        if filtered and self.quadruple_set is None:
+            raise ValueError("filtered answers need the dataset the store was exported from")
+        entities, relations, times = [np.asarray(x, dtype=np.int64).reshape(-1) for x in (entities, relations, times)]
+        k = min(k, self.store.meta['num_ents'])
+        top_entities = np.zeros((entities.shape[0], k), dtype=np.int64)
+        top_scores = np.zeros((entities.shape[0], k), dtype=np.float32)
+        for t in np.unique(times).tolist():
+            if t not in self.store:
+                raise KeyError("no embeddings exported for time {}".format(t))
+            group = np.nonzero(times == t)[0]
+            for start in range(0, group.shape[0], self.batch_size):
+                idx = group[start: start + self.batch_size]
+                with torch.no_grad():
+                    scores = self.score(entities[idx], relations[idx], t, mode)
+                if filtered:
+                    true_head, true_tail = self.get_true_index(t)
+                    ptr, values = (true_tail if mode == 'tail' else true_head).lookup(entities[idx], relations[idx])
+                    rows = np.repeat(np.arange(idx.shape[0]), np.diff(ptr))
+                    scores[torch.from_numpy(rows).to(self.device), torch.from_numpy(values).to(self.device)] = -float('inf')
+                values, indices = torch.topk(scores, k, dim=1)
+                top_scores[idx] = values.cpu().numpy()
+                top_entities[idx] = indices.cpu().numpy()
+        return top_entities, top_scores
+
+
+def parse_queries(lines):
+    """
+    queries are "s r o t" lines with ? in place of the entity to predict
+    :return: (known entities, relations, times, tail mask) arrays, the tail mask is True for (s, r, ?, t) queries
+    """
+    entities, relations, times, tail = [], [], [], []
+    for line in lines:
+        s, r, o, t = line.split()[:4]
+        if (s == '?') == (o == '?'):
+            raise ValueError("exactly one of subject and object must be ?: {}".format(line.strip()))
+        entities.append(int(s) if o == '?' else int(o))
+        relations.append(int(r))
+        times.append(int(t))
+        tail.append(o == '?')
+    return np.array(entities, dtype=np.int64), np.array(relations, dtype=np.int64), np.array(times, dtype=np.int64), np.array(tail, dtype=bool)
+
+
+def answer_queries(engine, lines, k=10, filtered=False):
+    # top-k answers of a chunk of query lines, tail and head queries answered in one batch each
+    entities, relations, times, tail = parse_queries(lines)
+    top_entities = np.zeros((entities.shape[0], min(k, engine.store.meta['num_ents'])), dtype=np.int64)
+    top_scores = np.zeros(top_entities.shape, dtype=np.float32)
+    for mode, mask in [('tail', tail), ('head', ~tail)]:
+        if mask.any():
+            top_entities[mask], top_scores[mask] = engine.answer(entities[mask], relations[mask], times[mask], mode, k, filtered)
+    return top_entities, top_scores
@@ -53,3 +53,85 @@ def transE(head, relation, tail, mode='single'):
         score = head + relation - tail
     score = - torch.norm(score, p=1, dim=-1)
     return score
+
+
+def one_vs_all(query, candidates):
+    # dot products of (bsz, d) queries with shared (num_candidates, d) or per-query (bsz, num_candidates, d) candidates
+    if candidates.dim() == 2:
+        return torch.mm(query, candidates.t())
+    return torch.bmm(candidates, query.unsqueeze(2)).squeeze(2)
+
+
+def distmult_matmul(s, r, o, mode='single'):
+    if mode == 'tail':
+        return one_vs_all(s * r, o)
+    elif mode == 'head':
+        return one_vs_all(r * o, s)
+    else:
+        return distmult(s, r, o)
+
+
+def complex_matmul(head, relation, tail, mode='single'):
+    # the real and imaginary parts of the query are packed so that they meet the halves of the candidates in one product
+    re_relation, im_relation = torch.chunk(relation, 2, dim=-1)
+    if mode == 'tail':
+        re_head, im_head = torch.chunk(head, 2, dim=-1)
+        query = torch.cat([re_head * re_relation - im_head * im_relation, re_head * im_relation + im_head * re_relation], dim=-1)
+        return one_vs_all(query, tail)
+    elif mode == 'head':
+        re_tail, im_tail = torch.chunk(tail, 2, dim=-1)
+        query = torch.cat([re_relation * re_tail + im_relation * im_tail, re_relation * im_tail - im_relation * re_tail], dim=-1)
+        return one_vs_all(query, head)
+    else:
+        return complex(head, relation, tail)
+
+
+def transE_chunked(head, relation, tail, mode='single', chunk_elements=2 ** 24):
+    # L1 distances to the candidates, at most chunk_elements differences at a time
+    if mode == 'tail':
+        query, candidates = head + relation, tail
+    elif mode == 'head':
+        query, candidates = tail - relation, head
+    else:
+        return transE(head, relation, tail)
+    num_candidates = candidates.shape[-2]
+    if num_candidates == 0:
+        return query.new_zeros(query.shape[0], 0)
+    chunk_size = max(1, chunk_elements // (query.shape[0] * query.shape[1]))
+    scores = []
+    for start in range(0, num_candidates, chunk_size):
+        scores.append(- torch.norm(query.unsqueeze(1) - candidates[..., start: start + chunk_size, :], p=1, dim=-1))
+    return torch.cat(scores, dim=1)
+
+
+SCORE_KERNELS = {
+    'broadcast': {'distmult': distmult, 'complex': complex, 'transE': transE},
+    'matmul': {'distmult': distmult_matmul, 'complex': complex_matmul, 'transE': transE_chunked},
+}
+
+
+def get_score_function(score_function, kernel='broadcast'):
+    return SCORE_KERNELS[kernel][score_function]
+
+
+def check_score_kernels(num_queries=16, num_candidates=100, embed_size=32, atol=1e-5):
+    """
+    compare the matmul kernels against the broadcast functions on random inputs, for shared and per-query candidates
+    :return: largest absolute difference of each (score function, mode, candidate layout), raises if one is not close
+    """
+    diffs = {}
+    queries = [torch.randn(num_queries, embed_size) for _ in range(2)]
+    for name in SCORE_KERNELS['broadcast']:
+        reference, kernel = SCORE_KERNELS['broadcast'][name], SCORE_KERNELS['matmul'][name]
+        for layout, candidates in [('shared', torch.randn(num_candidates, embed_size)), ('per_query', torch.randn(num_queries, num_candidates, embed_size))]:
+            for mode in ['tail', 'head']:
+                args = (queries[0], queries[1], candidates) if mode == 'tail' else (candidates, queries[0], queries[1])
+                expected, actual = reference(*args, mode=mode), kernel(*args, mode=mode)
+                assert expected.shape == actual.shape and torch.allclose(expected, actual, atol=atol), "{} {} {}".format(name, mode, layout)
+                diffs[(name, mode, layout)] = (expected - actual).abs().max().item()
+    return diffs
+
+
+if __name__ == '__main__':
+    for key, diff in check_score_kernels().items():
+        print(key, diff)
@@ -0,0 +1,86 @@
+import numpy as np
+import weakref
+import torch
+from collections import OrderedDict
+from utils.profiler import profiled
+
+# (graph dict reference, timeline) keyed by the id of the graph dict the timeline was built from, least recently used
+# first. Graph dicts that support weak references are held weakly; plain dicts are held by their entry, which keeps
+# their id from being reused while it is cached
+_timeline_cache = OrderedDict()
+TIMELINE_CACHE_SIZE = 8
+
+
+class Timeline:
+    """
+    Positions of the timestamps of a graph dict, in key order, with the window index matrices built on top of them.
+    windows(seq_len)[p] holds the positions of the seq_len steps ending at position p, -1 where the window runs off
+    the timeline; the padding always comes first, as in the None padded graph windows of the models
+    """
+    def __init__(self, times):
+        self.times = list(times)
+        time_array = np.asarray(self.times, dtype=np.int64).reshape(-1)
+        self.position = np.full(time_array.max() + 1 if time_array.shape[0] > 0 else 0, -1, dtype=np.int64)
+        self.position[time_array] = np.arange(time_array.shape[0])
+        self.window_cache = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def positions(self, t_list):
+        if isinstance(t_list, torch.Tensor):
+            t_list = t_list.cpu().numpy()
+        pos = self.position[np.asarray(t_list, dtype=np.int64).reshape(-1)]
+        assert (pos >= 0).all(), "timestamps not in the timeline"
+        return pos
+
+    def windows(self, seq_len, backward=False):
+        """
+        :return: (num_times, seq_len) positions of the window of every timestamp. Forward windows end at the
+        timestamp, backward windows start from it and run in reverse
+        """
+        key = (seq_len, backward)
+        if key not in self.window_cache:
+            num_times = len(self.times)
+            offsets = np.arange(seq_len - 1, -1, -1)
+            pos = np.arange(num_times).reshape(-1, 1)
+            window = pos + offsets if backward else pos - offsets
+            window[(window < 0) | (window >= num_times)] = -1
+            self.window_cache[key] = window
+        return self.window_cache[key]
+
+    @profiled('graph_windows')
+    def get_batch_windows(self, t_list, seq_len, graph_dict, backward=False):
+        """
+        :return: per-step lists of graphs and timestamps of the windows of t_list, sorted descending for forward
+        and ascending for backward windows; steps before the start of the timeline are None
+        """
+        t_list = t_list.sort(descending=not backward)[0]
+        window = self.windows(seq_len, backward)[self.positions(t_list)]
+        t_batched_list = [[self.times[p] if p >= 0 else None for p in step] for step in window.T.tolist()]
+        g_batched_list = [[graph_dict[t] if t is not None else None for t in step] for step in t_batched_list]
+        return g_batched_list, t_batched_list
+
+
+def get_timeline(graph_dict):
+    key = id(graph_dict)
+    ref, timeline = _timeline_cache.get(key, (None, None))
+    if ref is None or (ref() if isinstance(ref, weakref.ref) else ref) is not graph_dict or len(timeline) != len(graph_dict):
+        try:
+            ref = weakref.ref(graph_dict)
+        except TypeError:
+            ref = graph_dict
+        timeline = Timeline(graph_dict.keys())
+        _timeline_cache[key] = ref, timeline
+        while len(_timeline_cache) > TIMELINE_CACHE_SIZE:
+            _timeline_cache.popitem(last=False)
+    _timeline_cache.move_to_end(key)
+    return timeline
+
+
+def clear_timeline_cache():
+    _timeline_cache.clear()
+
+
+def get_batch_graph_list(t_list, seq_len, graph_dict):
+    return get_timeline(graph_dict).get_batch_windows(t_list, seq_len, graph_dict)
@@ -0,0 +1,153 @@
+import numpy as np
+import weakref
+from collections import ChainMap
+import torch
+
+# (true_head, true_tail) keyed by the snapshots the index was built from. Only ids are kept: the entries of a graph
+# or graph store are evicted when it is collected, so the cache never keeps snapshots alive
+_true_index_cache = {}
+# cache keys of every live snapshot owner, by owner id
+_owner_keys = {}
+
+
+def _evict_owner(owner_id):
+    for keys in _owner_keys.pop(owner_id, ()):
+        _true_index_cache.pop(keys, None)
+
+
+def _track_owner(owner, keys):
+    if id(owner) not in _owner_keys:
+        _owner_keys[id(owner)] = []
+        weakref.finalize(owner, _evict_owner, id(owner))
+    _owner_keys[id(owner)].append(keys)
+
+
+def clear_true_index_cache():
+    _true_index_cache.clear()
+    _owner_keys.clear()
+
+
+class TrueIndex:
+    """
+    Sorted-key CSR index from an (entity, relation) pair to the set of entities completing it.
+    keys[i] = entity * num_key_rels + relation, and the true entities of keys[i] are values[offsets[i]: offsets[i + 1]]
+    """
+    def __init__(self, entities, relations, values):
+        entities, relations, values = self.to_numpy(entities), self.to_numpy(relations), self.to_numpy(values)
+        self.num_key_rels = int(relations.max()) + 1 if relations.size > 0 else 0
+        keys = entities * self.num_key_rels + relations
+
+        order = np.lexsort((values, keys))
+        keys, values = keys[order], values[order]
+        # drop repeated (key, value) pairs
+        uniq = np.ones(keys.shape[0], dtype=bool)
+        uniq[1:] = (keys[1:] != keys[:-1]) | (values[1:] != values[:-1])
+        keys, values = keys[uniq], values[uniq]
+
+        self.keys, starts = np.unique(keys, return_index=True)
+        self.offsets = np.append(starts, keys.shape[0]).astype(np.int64)
+        self.values = values
+
+    @staticmethod
+    def to_numpy(x):
+        if isinstance(x, torch.Tensor):
+            x = x.cpu().numpy()
+        return np.asarray(x, dtype=np.int64).reshape(-1)
+
+    def find(self, entities, relations):
+        # position of each query key in self.keys, and whether the key exists
+        entities, relations = self.to_numpy(entities), self.to_numpy(relations)
+        if self.keys.shape[0] == 0:
+            return np.zeros(entities.shape[0], dtype=np.int64), np.zeros(entities.shape[0], dtype=bool)
+        query = entities * self.num_key_rels + relations
+        pos = np.minimum(np.searchsorted(self.keys, query), self.keys.shape[0] - 1)
+        found = (self.keys[pos] == query) & (relations < self.num_key_rels)
+        return pos, found
+
+    def lookup(self, entities, relations):
+        """
+        batched lookup of the true entities of every query pair
+        :return: CSR row pointer of size num_queries + 1 and the concatenated true entities
+        """
+        pos, found = self.find(entities, relations)
+        starts = self.offsets[pos]
+        counts = np.where(found, self.offsets[np.minimum(pos + 1, self.offsets.shape[0] - 1)] - starts, 0)
+        ptr = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=ptr[1:])
+        rows = np.repeat(np.arange(counts.shape[0]), counts)
+        values = self.values[starts[rows] + np.arange(ptr[-1]) - ptr[rows]]
+        return ptr, values
+
+    def contains(self, entities, relations, candidates):
+        """
+        vectorized membership test
+        :return: bool array, True where candidates[i, j] is a true entity of query pair i
+        """
+        if len(entities) == 0:
+            return np.zeros((0, 0), dtype=bool)
+        candidates = self.to_numpy(candidates).reshape(len(entities), -1)
+        ptr, values = self.lookup(entities, relations)
+        if values.shape[0] == 0 or candidates.size == 0:
+            return np.zeros(candidates.shape, dtype=bool)
+        width = max(int(values.max()), int(candidates.max())) + 1
+        # values are sorted within each query, so the encoded (query, entity) keys are globally sorted
+        true_keys = np.repeat(np.arange(ptr.shape[0] - 1), np.diff(ptr)) * width + values
+        keys = np.arange(candidates.shape[0]).reshape(-1, 1) * width + candidates
+        pos = np.minimum(np.searchsorted(true_keys, keys), true_keys.shape[0] - 1)
+        return true_keys[pos] == keys
+
+    def get(self, entity, relation):
+        pos, found = self.find([entity], [relation])
+        if not found[0]:
+            return self.values[:0]
+        return self.values[self.offsets[pos[0]]: self.offsets[pos[0] + 1]]
+
+    @staticmethod
+    def build_head_and_tail(triples):
+        # triples: (s, r, o) rows; returns the (r, o) -> heads and (s, r) -> tails indices
+        triples = TrueIndex.to_numpy(triples).reshape(-1, 3)
+        true_head = TrueIndex(triples[:, 2], triples[:, 1], triples[:, 0])
+        true_tail = TrueIndex(triples[:, 0], triples[:, 1], triples[:, 2])
+        return true_head, true_tail
+
+
+def get_global_triples(g):
+    # imported here, utils.utils pulls in dgl and the training stack that the query engine does without
+    from utils.utils import get_node_ids
+    node_ids = get_node_ids(g, 'cpu')
+    src, dst = g.edges()
+    return torch.stack([node_ids[src.cpu()], g.edata['type_s'].cpu(), node_ids[dst.cpu()]]).transpose(0, 1)
+
+
+def get_snapshot(graph_dict, t):
+    """
+    :return: cache key, owning object and a loader of the global triples of the snapshot at t. Snapshots of a
+    memory-mapped graph store are read from its arrays, without building their graphs
+    """
+    if isinstance(graph_dict, ChainMap):
+        return get_snapshot(next(m for m in graph_dict.maps if t in m), t)
+    if hasattr(graph_dict, 'get_global_triples'):
+        return (id(graph_dict), t), graph_dict, lambda: graph_dict.get_global_triples(t)
+    g = graph_dict[t]
+    return id(g), g, lambda: get_global_triples(g).numpy()
+
+
+def get_true_head_and_tail_per_time(*graph_dicts):
+    """
+    per-time true head / tail indices in global entity ids over the union of the graphs at each time.
+    Built indices are cached by snapshot identity, so the same snapshots are only indexed once per process
+    """
+    true_heads = dict()
+    true_tails = dict()
+    times = set()
+    for graph_dict in graph_dicts:
+        times.update(graph_dict.keys())
+    for t in sorted(times):
+        keys, owners, loaders = zip(*[get_snapshot(graph_dict, t) for graph_dict in graph_dicts if t in graph_dict])
+        if keys not in _true_index_cache:
+            triples = np.concatenate([load() for load in loaders], axis=0)
+            _true_index_cache[keys] = TrueIndex.build_head_and_tail(triples)
+            for owner in owners:
+                _track_owner(owner, keys)
+        true_heads[t], true_tails[t] = _true_index_cache[keys]
+    return true_heads, true_tails
@@ -20,6 +20,25 @@ def cuda(tensor):
         return tensor
 
 
+def get_node_ids(g, device=None):
+    # g.ndata['id'] is the single source of truth for node index -> global entity id
+    node_ids = g.ndata['id'].view(-1)
+    return node_ids if device is None else node_ids.to(device)
+
+
+def local_to_global(g, local_idx):
+    # batched node index -> global entity id, on the device of local_idx
+    return get_node_ids(g, local_idx.device)[local_idx]
+
+
+def global_to_local(g, global_idx, num_ents):
+    # batched global entity id -> node index of g, -1 for entities that are not in g
+    node_ids = get_node_ids(g, global_idx.device)
+    lookup = node_ids.new_full((num_ents,), -1)
+    lookup[node_ids] = torch.arange(node_ids.shape[0], device=node_ids.device)
+    return lookup[global_idx]
+
+
 def node_norm_to_edge_norm(g, node_norm):
     g = g.local_var()
     # convert to edge norm